@@ -1,5 +1,12 @@
 from django.contrib import admin
-from .models import Conversation, Message
+from .models import Conversation, ConversationMember, Message
+
+
+class ConversationMemberInline(admin.TabularInline):
+    model = ConversationMember
+    extra = 0
+    raw_id_fields = ['user']
+    readonly_fields = ['last_read_message_id', 'unread_count']
 
 
 class MessageInline(admin.TabularInline):
@@ -11,8 +18,8 @@ class MessageInline(admin.TabularInline):
 @admin.register(Conversation)
 class ConversationAdmin(admin.ModelAdmin):
     list_display = ['id', 'get_participants', 'created_at', 'updated_at']
-    filter_horizontal = ['participants']
-    inlines = [MessageInline]
+    readonly_fields = ['last_message', 'last_message_preview', 'last_message_at', 'message_count', 'last_seq', 'archived_seq', 'dm_key']
+    inlines = [ConversationMemberInline, MessageInline]
     
     def get_participants(self, obj):
         return ", ".join([u.username for u in obj.participants.all()])
@@ -21,6 +28,6 @@ class ConversationAdmin(admin.ModelAdmin):
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
-    list_display = ['id', 'conversation', 'sender', 'message_type', 'content', 'is_read', 'created_at']
-    list_filter = ['message_type', 'is_read', 'created_at']
+    list_display = ['id', 'conversation', 'sender', 'message_type', 'content', 'created_at']
+    list_filter = ['message_type', 'created_at']
     search_fields = ['sender__username', 'content']
@@ -0,0 +1,274 @@
+"""
+Cold storage for old messages.
+
+archive_conversation() moves a conversation's oldest messages out of
+chat_message into compressed segment files under CHAT_ARCHIVE_ROOT:
+
+    <root>/<conversation id>/index.json
+    <root>/<conversation id>/<first seq>-<last seq>.jsonl.gz
+
+Segments are written once and never changed. Each archiving run only
+appends new segments and rewrites the small index that lists them.
+Conversation.archived_seq records how far the move has gone. Every message
+with a seq up to that number lives in a segment, and every later one is
+still in the table. The get_messages view reads across that boundary with
+page().
+
+A run writes the segments and the index first, and deletes the rows
+afterwards. If it is interrupted in between, the next run finds segments
+past archived_seq and finishes the delete instead of writing them again.
+Run one archiver at a time.
+"""
+
+import functools
+import gzip
+import json
+import os
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from chatapp.pagination import paginate_keyset
+from uploads.signals import retain_files
+from users.models import User
+from .models import Conversation, Message
+
+
+INDEX_NAME = 'index.json'
+
+
+def _conversation_dir(conversation_id):
+    return Path(settings.CHAT_ARCHIVE_ROOT) / str(conversation_id)
+
+
+def _write_atomic(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def read_index(conversation_id):
+    """Segments of a conversation, oldest first"""
+    try:
+        with open(_conversation_dir(conversation_id) / INDEX_NAME) as f:
+            return json.load(f)['segments']
+    except FileNotFoundError:
+        return []
+
+
+def _to_record(message):
+    return {
+        'id': message.id,
+        'seq': message.seq,
+        'sender_id': message.sender_id,
+        'message_type': message.message_type,
+        'content': message.content,
+        'image': message.image.name or '',
+        'image_variants': message.image_variants,
+        'video': message.video.name or '',
+        'file': message.file.name or '',
+        'created_at': message.created_at.isoformat(),
+    }
+
+
+def _write_segment(conversation_id, records):
+    name = f"{records[0]['seq']}-{records[-1]['seq']}.jsonl.gz"
+    body = '\n'.join(json.dumps(record, separators=(',', ':')) for record in records).encode()
+    _write_atomic(_conversation_dir(conversation_id) / name, gzip.compress(body))
+    created = [datetime.fromisoformat(record['created_at']) for record in records]
+    return {
+        'file': name,
+        'first_seq': records[0]['seq'],
+        'last_seq': records[-1]['seq'],
+        'min_created_at': min(created).isoformat(),
+        'max_created_at': max(created).isoformat(),
+        'count': len(records),
+    }
+
+
+@functools.lru_cache(maxsize=64)
+def _load_segment(path):
+    # Segments never change once written, so caching them is safe
+    with gzip.open(path, 'rt') as f:
+        return tuple(json.loads(line) for line in f)
+
+
+def _delete_archived(conversation, through_seq):
+    # The archive still refers to the messages' attachments
+    with transaction.atomic(), retain_files():
+        Message.objects.filter(
+            conversation=conversation, seq__gt=conversation.archived_seq, seq__lte=through_seq
+        ).delete()
+        Conversation.objects.filter(pk=conversation.pk).update(archived_seq=through_seq)
+    conversation.archived_seq = through_seq
+
+
+def archive_conversation(conversation, cutoff):
+    """
+    Archive the conversation's messages created before ``cutoff``.
+
+    Only a gap-free run of seqs right after archived_seq is moved. The
+    conversation's latest message always stays in the table. Returns the
+    number of messages archived.
+    """
+    segments = read_index(conversation.pk)
+    if segments and segments[-1]['last_seq'] > conversation.archived_seq:
+        # A previous run stopped after writing its segments
+        _delete_archived(conversation, segments[-1]['last_seq'])
+
+    hot = Message.objects.filter(conversation=conversation, seq__gt=conversation.archived_seq)
+    through_seq = conversation.last_seq - 1
+    first_recent = hot.filter(created_at__gte=cutoff).order_by('seq').values_list('seq', flat=True).first()
+    if first_recent is not None:
+        through_seq = min(through_seq, first_recent - 1)
+    if conversation.last_message_id is not None:
+        last_seq = Message.objects.filter(pk=conversation.last_message_id).values_list('seq', flat=True).first()
+        if last_seq is not None:
+            through_seq = min(through_seq, last_seq - 1)
+    if through_seq <= conversation.archived_seq:
+        return 0
+
+    batch_size = settings.CHAT_ARCHIVE_SEGMENT_MESSAGES
+    archived = 0
+    records = []
+    for message in hot.filter(seq__lte=through_seq).order_by('seq').iterator(chunk_size=batch_size):
+        records.append(_to_record(message))
+        if len(records) == batch_size:
+            segments.append(_write_segment(conversation.pk, records))
+            archived += len(records)
+            records = []
+    if records:
+        segments.append(_write_segment(conversation.pk, records))
+        archived += len(records)
+
+    _write_atomic(
+        _conversation_dir(conversation.pk) / INDEX_NAME,
+        json.dumps({'segments': segments}).encode()
+    )
+    _delete_archived(conversation, through_seq)
+    return archived
+
+
+def archive_messages(older_than_days, conversation_ids=None):
+    """Archive old messages in every conversation; returns {conversation id: count}"""
+    cutoff = timezone.now() - timezone.timedelta(days=older_than_days)
+    conversations = Conversation.objects.filter(last_seq__gt=0)
+    if conversation_ids:
+        conversations = conversations.filter(pk__in=conversation_ids)
+    results = {}
+    for conversation in conversations.order_by('pk').iterator():
+        count = archive_conversation(conversation, cutoff)
+        if count:
+            results[conversation.pk] = count
+    return results
+
+
+def _key(record):
+    return (datetime.fromisoformat(record['created_at']), record['id'])
+
+
+def _to_message(record, conversation_id):
+    return Message(
+        id=record['id'],
+        conversation_id=conversation_id,
+        sender_id=record['sender_id'],
+        seq=record['seq'],
+        message_type=record['message_type'],
+        content=record['content'],
+        image=record['image'],
+        image_variants=record.get('image_variants') or {},
+        video=record['video'],
+        file=record['file'],
+        created_at=datetime.fromisoformat(record['created_at']),
+    )
+
+
+def _collect(conversation_id, segments, limit, newest_first, bound):
+    """
+    The first ``limit`` records past ``bound`` in the requested direction.
+    Segments are skipped using only their index entry when they cannot hold
+    a better record than the ones already found.
+    """
+    directory = _conversation_dir(conversation_id)
+    found = []
+    for segment in (reversed(segments) if newest_first else segments):
+        low = datetime.fromisoformat(segment['min_created_at'])
+        high = datetime.fromisoformat(segment['max_created_at'])
+        if bound is not None and (low > bound[0] if newest_first else high < bound[0]):
+            continue
+        if len(found) >= limit and (high < found[-1][0][0] if newest_first else low > found[-1][0][0]):
+            continue
+        for record in _load_segment(str(directory / segment['file'])):
+            key = _key(record)
+            if bound is None or (key < bound if newest_first else key > bound):
+                found.append((key, record))
+        found.sort(key=lambda item: item[0], reverse=newest_first)
+        del found[limit:]
+    return [record for _, record in found]
+
+
+def page(conversation_id, page_size, before=None, after=None):
+    """
+    Archived counterpart of chatapp.pagination.paginate_keyset.
+
+    ``before``/``after`` are decoded (created_at, id) cursors. Returns
+    ``(messages, has_more)`` with unsaved Message instances, newest first.
+    """
+    segments = read_index(conversation_id)
+    if after is not None:
+        records = _collect(conversation_id, segments, page_size + 1, False, after)
+    else:
+        records = _collect(conversation_id, segments, page_size + 1, True, before)
+
+    has_more = len(records) > page_size
+    records = records[:page_size]
+    if after is not None:
+        records.reverse()
+
+    senders = User.objects.in_bulk({record['sender_id'] for record in records})
+    messages = []
+    for record in records:
+        sender = senders.get(record['sender_id'])
+        if sender is None:
+            continue
+        message = _to_message(record, conversation_id)
+        message.sender = sender
+        messages.append(message)
+    return messages, has_more
+
+
+def paginate_history(conversation, page_size, before=None, after=None):
+    """
+    paginate_keyset over the conversation's messages that carries on into
+    the archive once the rows still in the table run out.
+    """
+    hot = conversation.messages.select_related('sender')
+    if not conversation.archived_seq:
+        return paginate_keyset(hot, page_size, before=before, after=after)
+
+    if after is not None:
+        # Oldest first: archived messages come before anything in the table
+        archived, has_more = page(conversation.pk, page_size, after=after)
+        if has_more:
+            return archived, True
+        rows, has_more = paginate_keyset(hot, page_size - len(archived), after=after)
+        return rows + archived, has_more
+
+    rows, has_more = paginate_keyset(hot, page_size, before=before)
+    if has_more:
+        return rows, True
+    edge = (rows[-1].created_at, rows[-1].id) if rows else before
+    archived, has_more = page(conversation.pk, page_size - len(rows), before=edge)
+    return rows + archived, has_more
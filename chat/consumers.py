@@ -1,13 +1,282 @@
-import json
+import asyncio
+import logging
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from .models import Conversation, Message
-from users.models import User
+from django.conf import settings
+from django.db import transaction
+from chatapp import metrics
+from .ids import WorkerIdUnavailable, next_message_id
+from .limits import OutboundQueue, TokenBucket
+from .models import Conversation, ConversationMember, Message
+from .protocol import DECODE_ERRORS, JSON, choose_protocol, decode_frame, encode_frame, encode_frames, send_kwargs
+from .receipts import get_receipts
+from .replay import get_buffers
+from .services import message_payload, record_message
+from .writebehind import get_writer
+from users import presence
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+logger = logging.getLogger(__name__)
+
+# Frame types that create a message
+MESSAGE_TYPES = {value for value, _ in Message.MESSAGE_TYPE_CHOICES}
+
+
+class BaseChatConsumer(AsyncWebsocketConsumer):
+    """Frame handling shared by the per-conversation and per-user sockets"""
+    
+    replayed_ids = frozenset()
+    sender = None
+    
+    def setup_connection(self):
+        self.protocol = choose_protocol(self.scope.get('subprotocols', []))
+        self.frame_bucket = TokenBucket(settings.CHAT_WS_FRAME_RATE, settings.CHAT_WS_FRAME_BURST)
+        self.message_bucket = TokenBucket(settings.CHAT_WS_MESSAGE_RATE, settings.CHAT_WS_MESSAGE_BURST)
+    
+    async def accept_with_protocol(self):
+        await self.accept(subprotocol=self.protocol)
+        self.protocol = self.protocol or JSON
+        self.outbound = OutboundQueue(settings.CHAT_WS_OUTBOUND_QUEUE, settings.CHAT_WS_SLOW_CONSUMER_POLICY)
+        self.sender = asyncio.get_running_loop().create_task(self.drain_outbound())
+    
+    async def websocket_disconnect(self, message):
+        if self.sender is not None:
+            self.sender.cancel()
+        await super().websocket_disconnect(message)
+    
+    async def decode_client_frame(self, text_data, bytes_data):
+        """Apply the size and rate limits and decode; None means the frame was rejected"""
+        size = len(text_data.encode()) if text_data is not None else len(bytes_data or b'')
+        if size > settings.CHAT_WS_MAX_FRAME_BYTES:
+            metrics.increment('chat.ws.frame_too_large')
+            await self.close(code=1009)
+            return None
+        
+        if not self.frame_bucket.allow():
+            metrics.increment('chat.ws.rate_limited')
+            await self.send_event({'type': 'error', 'message': 'Rate limit exceeded'})
+            return None
+        
+        try:
+            return decode_frame(self.protocol, text_data, bytes_data)
+        except DECODE_ERRORS:
+            metrics.increment('chat.ws.invalid_frame')
+            await self.send_event({'type': 'error', 'message': 'Invalid frame'})
+            return None
+    
+    async def handle_frame(self, conversation_id, data):
+        """Act on a decoded client frame addressed to ``conversation_id``"""
+        message_type = data.get('type', 'text')
+        
+        # Control frames never touch the database
+        if message_type == 'heartbeat':
+            presence.heartbeat(self.user.id)
+            await database_sync_to_async(presence.maybe_flush_last_seen)()
+            return
+        
+        if message_type == 'read':
+            # Coalesced and written in the next receipt flush
+            message_id = data.get('message_id')
+            if isinstance(message_id, int) and message_id > 0:
+                get_receipts().submit(conversation_id, self.user.id, message_id)
+            return
+        
+        if message_type == 'typing':
+            await self.channel_layer.group_send(
+                f'chat_{conversation_id}',
+                {
+                    'type': 'chat_typing',
+                    'conversation_id': conversation_id,
+                    'user_id': self.user.id,
+                    'frames': encode_frames({
+                        'type': 'typing',
+                        'conversation_id': conversation_id,
+                        'user_id': self.user.id,
+                        'username': self.user.username,
+                        'is_typing': bool(data.get('is_typing', True)),
+                    }),
+                }
+            )
+            return
+        
+        if not isinstance(message_type, str) or message_type not in MESSAGE_TYPES:
+            await self.send_event({
+                'type': 'error',
+                'conversation_id': conversation_id,
+                'message': 'Unknown message type',
+            })
+            return
+        
+        content = data.get('content', '')
+        
+        if not isinstance(content, str) or len(content) > settings.CHAT_MESSAGE_MAX_LENGTH:
+            metrics.increment('chat.ws.content_too_long')
+            await self.send_event({
+                'type': 'error',
+                'conversation_id': conversation_id,
+                'message': f'Messages are limited to {settings.CHAT_MESSAGE_MAX_LENGTH} characters',
+            })
+            return
+        
+        if not self.message_bucket.allow():
+            metrics.increment('chat.ws.message_rate_limited')
+            await self.send_event({
+                'type': 'error',
+                'conversation_id': conversation_id,
+                'message': 'Sending messages too fast',
+            })
+            return
+        
+        try:
+            if settings.CHAT_WRITE_BEHIND:
+                # Broadcast now, write in the next batch
+                message = await self.buffer_message(conversation_id, message_type, content)
+            else:
+                # Save message to database
+                message = await self.save_message(conversation_id, message_type, content)
+        except Conversation.DoesNotExist:
+            await self.send_event({
+                'type': 'error',
+                'conversation_id': conversation_id,
+                'message': 'Conversation not found',
+            })
+            return
+        except WorkerIdUnavailable:
+            logger.exception("Could not assign a message id")
+            await self.send_event({
+                'type': 'error',
+                'conversation_id': conversation_id,
+                'message': 'Could not send the message, try again',
+            })
+            return
+        
+        # Send message to room group, serialized once for every recipient
+        await self.channel_layer.group_send(
+            f'chat_{conversation_id}',
+            {
+                'type': 'chat_message',
+                'message_id': message.id,
+                'frames': encode_frames({
+                    'type': 'message',
+                    'message': message_payload(message),
+                }),
+            }
+        )
+    
+    async def send_frame(self, frames, key=None):
+        """Queue a pre-encoded event; ``key`` lets a newer frame replace it"""
+        if not self.outbound.put(frames[self.protocol], key):
+            # Too slow to keep up; it can reconnect and resume
+            await self.close(code=1013)
+    
+    async def send_event(self, data):
+        await self.send_frame({self.protocol: encode_frame(self.protocol, data)})
+    
+    async def write_event(self, data):
+        """Write an event to the socket right away, bypassing the outbound queue"""
+        await self.send(**send_kwargs(self.protocol, encode_frame(self.protocol, data)))
+    
+    async def drain_outbound(self):
+        while True:
+            frame = await self.outbound.get()
+            await self.send(**send_kwargs(self.protocol, frame))
+            if self.outbound.lost_messages and not len(self.outbound):
+                self.outbound.lost_messages = False
+                await self.write_event({'type': 'resync_required'})
+    
+    async def chat_message(self, event):
+        # Already sent while replaying on connect
+        if event['message_id'] in self.replayed_ids:
+            self.replayed_ids.discard(event['message_id'])
+            return
+        
+        # Send message to WebSocket
+        await self.send_frame(event['frames'])
+    
+    async def chat_typing(self, event):
+        # Don't echo typing indicators back to the typist
+        if event['user_id'] == self.user.id:
+            return
+        
+        await self.send_frame(event['frames'], ('typing', event['conversation_id'], event['user_id']))
+    
+    async def chat_read(self, event):
+        await self.send_frame(event['frames'], ('read', event['conversation_id'], event['user_id']))
+    
+    async def chat_presence(self, event):
+        await self.send_frame(event['frames'], ('presence', event['conversation_id'], event['user_id']))
+    
+    async def broadcast_presence(self, conversation_ids, is_online):
+        for conversation_id in conversation_ids:
+            await self.channel_layer.group_send(
+                f'chat_{conversation_id}',
+                {
+                    'type': 'chat_presence',
+                    'conversation_id': conversation_id,
+                    'user_id': self.user.id,
+                    'frames': encode_frames({
+                        'type': 'presence',
+                        'conversation_id': conversation_id,
+                        'user_id': self.user.id,
+                        'is_online': is_online,
+                    }),
+                }
+            )
+    
+    def build_message(self, conversation_id, message_type, content):
+        return Message(
+            conversation_id=conversation_id,
+            sender=self.user,
+            message_type=message_type,
+            content=content
+        )
+    
+    @database_sync_to_async
+    def save_message(self, conversation_id, message_type, content):
+        with transaction.atomic():
+            message = self.build_message(conversation_id, message_type, content)
+            message.save()
+            record_message(message)
+        return message
+    
+    async def buffer_message(self, conversation_id, message_type, content):
+        message = self.build_message(conversation_id, message_type, content)
+        try:
+            message.id = next_message_id(wait=False)
+        except WorkerIdUnavailable:
+            # The lease is still being claimed or renewed; wait for it off the event loop
+            message.id = await sync_to_async(next_message_id, thread_sensitive=False)()
+        get_writer().submit(message)
+        return message
+
+
+class ChatConsumer(BaseChatConsumer):
+    """One conversation per socket: ws/chat/<conversation_id>/"""
+    
     async def connect(self):
-        self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
+        self.room_group_name = None
+        self.user = self.scope.get('user')
+        self.replayed_ids = set()
+        self.setup_connection()
+        
+        try:
+            self.conversation_id = int(self.scope['url_route']['kwargs']['conversation_id'])
+        except ValueError:
+            await self.close()
+            return
+        
+        # Authenticate and check membership once, at handshake time
+        if self.user is None or not self.user.is_authenticated:
+            await self.close()
+            return
+        
+        self.conversation = await self.get_conversation()
+        if self.conversation is None:
+            await self.close()
+            return
+        
         self.room_group_name = f'chat_{self.conversation_id}'
         
         # Join room group
@@ -16,66 +285,185 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-        await self.accept()
+        await get_buffers().subscribe(self.channel_layer, self.conversation_id)
+        
+        await self.accept_with_protocol()
+        
+        resume_from = self.get_resume_from()
+        if resume_from is not None:
+            await self.replay(resume_from)
+        
+        if presence.connect(self.user.id):
+            await self.broadcast_presence([self.conversation_id], True)
+        await database_sync_to_async(presence.maybe_flush_last_seen)()
     
     async def disconnect(self, close_code):
+        if self.room_group_name is None:
+            return
+        
+        if presence.disconnect(self.user.id):
+            await self.broadcast_presence([self.conversation_id], False)
+        await database_sync_to_async(presence.maybe_flush_last_seen)()
+        
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        get_buffers().unsubscribe(self.conversation_id)
     
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message_type = data.get('type', 'text')
-        content = data.get('content', '')
-        sender_id = data.get('sender_id')
+    async def receive(self, text_data=None, bytes_data=None):
+        data = await self.decode_client_frame(text_data, bytes_data)
+        if data is not None:
+            await self.handle_frame(self.conversation_id, data)
+    
+    def get_resume_from(self):
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            return int(query['resume_from'][0])
+        except (KeyError, ValueError):
+            return None
+    
+    async def replay(self, resume_from):
+        """
+        Send the messages broadcast after ``resume_from`` while the client was
+        away. Runs before any live event is queued, so it writes directly.
+        """
+        missed = get_buffers().since(self.conversation_id, resume_from)
+        if missed is None:
+            missed = await self.load_missed(resume_from)
+        if missed is None:
+            # Too far behind; the client should catch up through the sync endpoint
+            await self.write_event({'type': 'resync_required'})
+            return
         
-        # Save message to database
-        message = await self.save_message(sender_id, message_type, content)
+        for message in missed:
+            self.replayed_ids.add(message['id'])
+            await self.write_event({
+                'type': 'message',
+                'message': message
+            })
+        await self.write_event({
+            'type': 'resumed',
+            'replayed': len(missed),
+        })
+    
+    @database_sync_to_async
+    def load_missed(self, resume_from):
+        """Messages after ``resume_from`` from the database, or None if there are too many"""
+        limit = settings.CHAT_REPLAY_MAX_MESSAGES
+        unwritten = get_writer().pending_for(self.conversation_id) if settings.CHAT_WRITE_BEHIND else []
+        pending = [message for message in unwritten if message.id > resume_from]
         
-        if message:
-            # Send message to room group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'message': {
-                        'id': message.id,
-                        'sender_id': sender_id,
-                        'sender_username': message.sender.username,
-                        'message_type': message_type,
-                        'content': content,
-                        'created_at': message.created_at.isoformat(),
-                    }
-                }
+        seq = Message.objects.filter(
+            conversation_id=self.conversation_id, id=resume_from
+        ).values_list('seq', flat=True).first()
+        if seq is None:
+            # Unknown id, unless it is still waiting to be written
+            if not any(message.id == resume_from for message in unwritten):
+                return None
+            written = []
+        else:
+            # Range scan on the (conversation, seq) index
+            written = list(
+                Message.objects.filter(conversation_id=self.conversation_id, seq__gt=seq)
+                .select_related('sender')
+                .order_by('seq')[:limit + 1]
             )
+        
+        written_ids = {message.id for message in written}
+        missed = written + [message for message in pending if message.id not in written_ids]
+        if len(missed) > limit:
+            return None
+        return [message_payload(message) for message in missed]
     
-    async def chat_message(self, event):
-        message = event['message']
+    @database_sync_to_async
+    def get_conversation(self):
+        return Conversation.objects.filter(
+            id=self.conversation_id,
+            memberships__user=self.user
+        ).first()
+
+
+class UserChatConsumer(BaseChatConsumer):
+    """
+    All of a user's conversations over one socket: ws/chat/
+    
+    The connection joins every conversation group plus the personal group
+    ``user_<id>``, through which it learns about conversations started after
+    it connected. Client frames name their target with ``conversation_id``.
+    """
+    
+    async def connect(self):
+        self.personal_group_name = None
+        self.user = self.scope.get('user')
+        self.setup_connection()
         
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'message',
-            'message': message
-        }))
+        if self.user is None or not self.user.is_authenticated:
+            await self.close()
+            return
+        
+        self.conversation_ids = await self.get_conversation_ids()
+        self.personal_group_name = f'user_{self.user.id}'
+        
+        await self.channel_layer.group_add(self.personal_group_name, self.channel_name)
+        for conversation_id in self.conversation_ids:
+            await self.channel_layer.group_add(f'chat_{conversation_id}', self.channel_name)
+        
+        await self.accept_with_protocol()
+        
+        if presence.connect(self.user.id):
+            await self.broadcast_presence(self.conversation_ids, True)
+        await database_sync_to_async(presence.maybe_flush_last_seen)()
+    
+    async def disconnect(self, close_code):
+        if self.personal_group_name is None:
+            return
+        
+        if presence.disconnect(self.user.id):
+            await self.broadcast_presence(self.conversation_ids, False)
+        await database_sync_to_async(presence.maybe_flush_last_seen)()
+        
+        for conversation_id in self.conversation_ids:
+            await self.channel_layer.group_discard(f'chat_{conversation_id}', self.channel_name)
+        await self.channel_layer.group_discard(self.personal_group_name, self.channel_name)
+    
+    async def receive(self, text_data=None, bytes_data=None):
+        data = await self.decode_client_frame(text_data, bytes_data)
+        if data is None:
+            return
+        
+        if data.get('type') == 'heartbeat':
+            await self.handle_frame(None, data)
+            return
+        
+        conversation_id = data.get('conversation_id')
+        # Anything else could be unhashable; True would pass for conversation 1
+        if not isinstance(conversation_id, int) or isinstance(conversation_id, bool):
+            await self.send_event({
+                'type': 'error',
+                'message': 'Invalid conversation_id',
+            })
+            return
+        if conversation_id not in self.conversation_ids:
+            await self.send_event({
+                'type': 'error',
+                'conversation_id': conversation_id,
+                'message': 'Unknown conversation',
+            })
+            return
+        
+        await self.handle_frame(conversation_id, data)
+    
+    async def conversation_started(self, event):
+        conversation_id = event['conversation_id']
+        if conversation_id not in self.conversation_ids:
+            self.conversation_ids.add(conversation_id)
+            await self.channel_layer.group_add(f'chat_{conversation_id}', self.channel_name)
+        await self.send_frame(event['frames'])
     
     @database_sync_to_async
-    def save_message(self, sender_id, message_type, content):
-        try:
-            conversation = Conversation.objects.get(id=self.conversation_id)
-            sender = User.objects.get(id=sender_id)
-            
-            message = Message.objects.create(
-                conversation=conversation,
-                sender=sender,
-                message_type=message_type,
-                content=content
-            )
-            
-            # Update conversation timestamp
-            conversation.save()
-            
-            return message
-        except (Conversation.DoesNotExist, User.DoesNotExist):
-            return None
+    def get_conversation_ids(self):
+        return set(
+            ConversationMember.objects.filter(user=self.user).values_list('conversation_id', flat=True)
+        )
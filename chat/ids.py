@@ -0,0 +1,197 @@
+"""
+Message id generator.
+
+Message ids are assigned by the application rather than by the database so a
+message can be broadcast before it is written (see chat.writebehind).
+
+Layout, most significant bit first: 41 bits of milliseconds since ID_EPOCH_MS,
+5 bits of worker id and 7 bits of per-millisecond sequence. Ids stay below
+2**53, so JavaScript clients can keep treating them as plain numbers, and they
+keep increasing over time, so they still work as read pointers and cursors.
+
+Two processes with the same worker id could issue the same id in the same
+millisecond, so each process leases its worker id through a WorkerIdLease
+row. A background thread claims a free or expired id and renews the lease
+every third of CHAT_WORKER_LEASE_SECONDS. Ids are only issued while the last
+renewal is less than half a lease old, so a process that cannot reach the
+database stops issuing ids well before another one may take its worker id
+over, with room to spare for clock differences between hosts. With all 32
+worker ids leased, sending a message fails with WorkerIdUnavailable.
+"""
+
+import atexit
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+ID_EPOCH_MS = 1735689600000  # 2025-01-01T00:00:00Z
+WORKER_BITS = 5
+SEQUENCE_BITS = 7
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+# How long the first message of a process may wait for its worker id
+LEASE_WAIT_SECONDS = 10
+
+
+class WorkerIdUnavailable(RuntimeError):
+    """This process holds no worker id, so it must not issue message ids"""
+
+
+class IdGenerator:
+    """Thread-safe generator of time-ordered 53-bit ids"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._sequence = 0
+
+    def next_id(self, worker_id):
+        with self._lock:
+            # Never go backwards, even if the wall clock does
+            now = max(int(time.time() * 1000), self._last_ms)
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & SEQUENCE_MASK
+                if self._sequence == 0:
+                    # Sequence exhausted for this millisecond, borrow the next one
+                    now += 1
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return (
+                ((now - ID_EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS))
+                | (worker_id << SEQUENCE_BITS)
+                | self._sequence
+            )
+
+
+class WorkerLease:
+    """This process's worker id, kept leased by a daemon thread"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.token = uuid.uuid4().hex
+        self.worker_id = None
+        self._valid_until = 0.0
+        self._error = None
+        self._ready = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='chat-worker-lease', daemon=True)
+        self._thread.start()
+
+    def current(self, timeout=LEASE_WAIT_SECONDS):
+        """The leased worker id, waiting up to ``timeout`` seconds for the lease to be claimed or renewed"""
+        with self._ready:
+            if not self._ready.wait_for(lambda: time.monotonic() < self._valid_until, timeout):
+                raise WorkerIdUnavailable(
+                    f'No message worker id is leased by this process: {self._error or "lease not renewed"}'
+                )
+            return self.worker_id
+
+    def _claim(self, now):
+        from .models import WorkerIdLease
+
+        expires_at = now + timedelta(seconds=self.seconds)
+        worker_ids = list(range(1 << WORKER_BITS))
+        random.shuffle(worker_ids)
+        for worker_id in worker_ids:
+            if WorkerIdLease.objects.filter(worker_id=worker_id, expires_at__lt=now).update(
+                owner=self.token, expires_at=expires_at
+            ):
+                return worker_id
+            try:
+                with transaction.atomic():
+                    WorkerIdLease.objects.create(worker_id=worker_id, owner=self.token, expires_at=expires_at)
+                return worker_id
+            except IntegrityError:
+                # Leased by a live process
+                continue
+        raise WorkerIdUnavailable(f'All {1 << WORKER_BITS} message worker ids are leased')
+
+    def _renew(self, now):
+        from .models import WorkerIdLease
+
+        renewed = WorkerIdLease.objects.filter(worker_id=self.worker_id, owner=self.token).update(
+            expires_at=now + timedelta(seconds=self.seconds)
+        )
+        return self.worker_id if renewed else None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            started = time.monotonic()
+            delay = self.seconds / 3
+            try:
+                now = timezone.now()
+                worker_id = self._renew(now) if self.worker_id is not None else None
+                if worker_id is None:
+                    worker_id = self._claim(now)
+                with self._ready:
+                    self.worker_id = worker_id
+                    self._valid_until = started + self.seconds / 2
+                    self._error = None
+                    self._ready.notify_all()
+            except Exception as exc:
+                logger.exception("Could not lease a message worker id")
+                self._error = exc
+                delay = 1
+            finally:
+                close_old_connections()
+            self._stopped.wait(delay)
+
+    def release(self):
+        from .models import WorkerIdLease
+
+        self._stopped.set()
+        with self._ready:
+            self._valid_until = 0.0
+        try:
+            WorkerIdLease.objects.filter(owner=self.token).delete()
+        except Exception:
+            logger.warning("Could not release message worker id %s", self.worker_id, exc_info=True)
+
+
+_generator = None
+_lease = None
+_generator_pid = None
+_generator_lock = threading.Lock()
+
+
+def _release_lease():
+    if _lease is not None and _generator_pid == os.getpid():
+        _lease.release()
+
+
+atexit.register(_release_lease)
+
+
+def next_message_id(wait=True):
+    """
+    Return a new message id for this process. Without ``wait`` it raises
+    WorkerIdUnavailable at once instead of waiting for the lease thread, for
+    callers on an event loop.
+    """
+    global _generator, _lease, _generator_pid
+
+    # A forked child shares its parent's lease token but not its lease
+    # thread, so it leases a worker id of its own
+    with _generator_lock:
+        if _generator is None or _generator_pid != os.getpid():
+            _generator = IdGenerator()
+            _lease = WorkerLease(settings.CHAT_WORKER_LEASE_SECONDS)
+            _generator_pid = os.getpid()
+        generator, lease = _generator, _lease
+    return generator.next_id(lease.current(LEASE_WAIT_SECONDS if wait else 0))
+
+
+def first_id_at(timestamp):
+    """Smallest id any worker can issue at ``timestamp`` (seconds since the Unix epoch)"""
+    return max(int(timestamp * 1000) - ID_EPOCH_MS, 0) << (WORKER_BITS + SEQUENCE_BITS)
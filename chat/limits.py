@@ -0,0 +1,107 @@
+"""
+Flow control for chat WebSockets.
+
+TokenBucket caps how fast one connection may send frames and messages.
+
+OutboundQueue sits between the channel layer and the socket. The consumer
+keeps draining its channel, so the room's other members are never held up.
+When a client reads too slowly the queue fills up, and CHAT_WS_SLOW_CONSUMER_POLICY
+decides what happens next:
+
+* ``drop_oldest`` drops the oldest queued frame.
+* ``coalesce`` replaces a queued typing, presence or read frame with a newer
+  one for the same user and conversation. When the queue is full it drops
+  the oldest of those frames, and only drops chat messages if nothing else
+  is left.
+* ``disconnect`` closes the connection, and the client reconnects and resumes.
+
+A client that lost chat messages this way gets ``resync_required`` once the
+queue has drained.
+"""
+
+import asyncio
+import time
+from collections import deque
+
+from chatapp import metrics
+
+
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+
+class TokenBucket:
+    """Allows ``rate`` events per second on average and bursts of up to ``burst``"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def allow(self, cost=1):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class OutboundQueue:
+    """Bounded queue of frames waiting to be written to one socket"""
+
+    def __init__(self, maxsize, policy):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow consumer policy {policy!r}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.lost_messages = False
+        self._frames = deque()
+        self._ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, frame, key=None):
+        """
+        Queue a frame. ``key`` identifies frames a newer one may replace
+        (None for chat messages). Returns False if the policy says to drop
+        the connection instead.
+        """
+        if self.policy == COALESCE and key is not None:
+            for index, (queued_key, _) in enumerate(self._frames):
+                if queued_key == key:
+                    self._frames[index] = (key, frame)
+                    metrics.increment('chat.ws.outbound_coalesced')
+                    return True
+
+        if len(self._frames) >= self.maxsize:
+            if self.policy == DISCONNECT:
+                metrics.increment('chat.ws.slow_consumer_disconnects')
+                return False
+            self._evict()
+
+        self._frames.append((key, frame))
+        self._ready.set()
+        return True
+
+    def _evict(self):
+        index = 0
+        if self.policy == COALESCE:
+            # Prefer losing a transient frame over a chat message
+            index = next((i for i, (key, _) in enumerate(self._frames) if key is not None), 0)
+        key, _ = self._frames[index]
+        del self._frames[index]
+        if key is None:
+            self.lost_messages = True
+        metrics.increment('chat.ws.outbound_dropped')
+
+    async def get(self):
+        while not self._frames:
+            self._ready.clear()
+            await self._ready.wait()
+        return self._frames.popleft()[1]
@@ -0,0 +1,295 @@
+"""
+WebSocket fan-out load generator, used by the loadtest management command.
+
+It creates ``rooms`` conversations of ``clients`` throwaway users each,
+connects every user to its room's socket (ws/chat/<id>/) and has each client
+send text messages at ``rate`` per second for ``duration`` seconds. Every
+message carries the time it was sent, so each receiving client can measure
+the delay from send to fan-out delivery.
+
+Clients talk to chatapp.asgi.application inside this process by default,
+which needs no server and makes settings easy to compare between runs. With
+``url`` they connect to a running server over the network instead; that needs
+the optional ``websockets`` package and a server that uses the same database.
+
+The report covers connection setup, fan-out latency percentiles, send and
+delivery throughput, deliveries that had not arrived by the end of the drain
+period (lost, or stuck behind a backlog), error frames (mostly the
+per-connection rate limits) and how fast messages reached the database.
+
+In-process runs share one event loop between the clients and the server, so
+the generator's own work counts against the numbers; use ``url`` with a
+separate server process when that matters.
+"""
+
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+from urllib.parse import urlencode
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from rest_framework.authtoken.models import Token
+
+from users.models import User
+from .models import Conversation, ConversationMember, Message
+from .protocol import JSON
+
+
+MARKER = 'loadtest'
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list, rounded to microseconds"""
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))
+    return round(values[index], 3)
+
+
+class InProcessClient:
+    """A WebSocket connection straight into an ASGI application"""
+
+    def __init__(self, application, path, query):
+        self.application = application
+        self.scope = {
+            'type': 'websocket',
+            'path': path,
+            'raw_path': path.encode(),
+            'query_string': query.encode(),
+            'headers': [],
+            'subprotocols': [JSON],
+            'client': ('127.0.0.1', 0),
+            'server': ('127.0.0.1', 80),
+        }
+        self.inbound = asyncio.Queue()
+        self.outbound = asyncio.Queue()
+        self.task = None
+
+    async def connect(self):
+        self.task = asyncio.ensure_future(
+            self.application(self.scope, self.inbound.get, self.outbound.put)
+        )
+        await self.inbound.put({'type': 'websocket.connect'})
+        reply = await self.outbound.get()
+        return reply['type'] == 'websocket.accept'
+
+    async def send(self, text):
+        await self.inbound.put({'type': 'websocket.receive', 'text': text})
+
+    async def recv(self):
+        """The next text frame, or None once the server closes the socket"""
+        while True:
+            event = await self.outbound.get()
+            if event['type'] == 'websocket.close':
+                return None
+            if event.get('text') is not None:
+                return event['text']
+
+    async def close(self):
+        if self.task is None:
+            return
+        await self.inbound.put({'type': 'websocket.disconnect', 'code': 1000})
+        try:
+            await asyncio.wait_for(self.task, 5)
+        except Exception:
+            self.task.cancel()
+
+
+class NetworkClient:
+    """A WebSocket connection to a running server"""
+
+    def __init__(self, base_url, path, query):
+        self.url = f"{base_url.rstrip('/')}{path}?{query}"
+        self.socket = None
+
+    async def connect(self):
+        import websockets
+
+        try:
+            self.socket = await websockets.connect(self.url, subprotocols=[JSON], max_queue=None)
+        except (OSError, websockets.InvalidHandshake):
+            return False
+        return True
+
+    async def send(self, text):
+        await self.socket.send(text)
+
+    async def recv(self):
+        import websockets
+
+        try:
+            frame = await self.socket.recv()
+        except websockets.ConnectionClosed:
+            return None
+        return frame if isinstance(frame, str) else frame.decode()
+
+    async def close(self):
+        if self.socket is not None:
+            await self.socket.close()
+
+
+def create_fixtures(rooms, clients):
+    """Create the users, tokens and conversations; returns (run id, [(conversation id, [token keys])])"""
+    run = uuid.uuid4().hex[:8]
+    with transaction.atomic():
+        users = User.objects.bulk_create([
+            User(username=f'{MARKER}-{run}-{index}', display_name=f'{MARKER} {index}', password='!')
+            for index in range(rooms * clients)
+        ])
+        if users[0].pk is None:
+            users = list(User.objects.filter(username__startswith=f'{MARKER}-{run}-').order_by('pk'))
+        tokens = Token.objects.bulk_create([Token(user=user, key=Token.generate_key()) for user in users])
+        conversations = []
+        for room in range(rooms):
+            conversation = Conversation.objects.create()
+            members = users[room * clients:(room + 1) * clients]
+            ConversationMember.objects.bulk_create([
+                ConversationMember(conversation=conversation, user=user) for user in members
+            ])
+            conversations.append((
+                conversation.pk,
+                [token.key for token in tokens[room * clients:(room + 1) * clients]],
+            ))
+    return run, conversations
+
+
+def delete_fixtures(run, conversation_ids):
+    with transaction.atomic():
+        Conversation.objects.filter(pk__in=conversation_ids).delete()
+        User.objects.filter(username__startswith=f'{MARKER}-{run}-').delete()
+
+
+def count_messages(conversation_ids):
+    return Message.objects.filter(conversation_id__in=conversation_ids).count()
+
+
+class LoadTest:
+
+    def __init__(self, rooms, clients, rate, duration, drain=3.0, url=None, application=None):
+        self.rooms = rooms
+        self.clients = clients
+        self.rate = rate
+        self.duration = duration
+        self.drain = drain
+        self.url = url
+        self.application = application
+        self.latencies = []
+        self.received = 0
+        self.errors = {}
+        self.sent = 0
+        self.closed_early = 0
+
+    def make_client(self, conversation_id, token):
+        path = f'/ws/chat/{conversation_id}/'
+        query = urlencode({'token': token})
+        if self.url:
+            return NetworkClient(self.url, path, query)
+        return InProcessClient(self.application, path, query)
+
+    async def receive_loop(self, client, run):
+        prefix = f'{MARKER} {run} '
+        while True:
+            text = await client.recv()
+            if text is None:
+                self.closed_early += 1
+                return
+            now = time.perf_counter_ns()
+            data = json.loads(text)
+            if data.get('type') == 'message':
+                content = data['message'].get('content', '')
+                if content.startswith(prefix):
+                    sent_at = int(content.rsplit(' ', 1)[1])
+                    self.latencies.append((now - sent_at) / 1e6)
+                    self.received += 1
+            elif data.get('type') == 'error':
+                reason = data.get('message', 'error')
+                self.errors[reason] = self.errors.get(reason, 0) + 1
+
+    async def send_loop(self, client, run, index, deadline):
+        interval = 1 / self.rate
+        # Spread the clients over the first interval instead of sending in lockstep
+        await asyncio.sleep(random.uniform(0, interval))
+        next_at = time.perf_counter()
+        sequence = 0
+        while next_at < deadline:
+            content = f'{MARKER} {run} {index} {sequence} {time.perf_counter_ns()}'
+            await client.send(json.dumps({'type': 'text', 'content': content}))
+            self.sent += 1
+            sequence += 1
+            next_at += interval
+            await asyncio.sleep(max(0, next_at - time.perf_counter()))
+
+    async def run(self):
+        run, conversations = await sync_to_async(create_fixtures)(self.rooms, self.clients)
+        conversation_ids = [conversation_id for conversation_id, _ in conversations]
+        try:
+            return await self._run(run, conversations, conversation_ids)
+        finally:
+            await sync_to_async(delete_fixtures)(run, conversation_ids)
+
+    async def _run(self, run, conversations, conversation_ids):
+        clients = [
+            self.make_client(conversation_id, token)
+            for conversation_id, tokens in conversations
+            for token in tokens
+        ]
+
+        connect_times = []
+
+        async def connect(client):
+            started = time.perf_counter()
+            accepted = await client.connect()
+            connect_times.append((time.perf_counter() - started) * 1000)
+            return accepted
+
+        results = await asyncio.gather(*(connect(client) for client in clients))
+        connected = [client for client, accepted in zip(clients, results) if accepted]
+        receivers = [asyncio.ensure_future(self.receive_loop(client, run)) for client in connected]
+
+        messages_before = await sync_to_async(count_messages)(conversation_ids)
+        started = time.perf_counter()
+        deadline = started + self.duration
+        await asyncio.gather(*(
+            self.send_loop(client, run, index, deadline) for index, client in enumerate(connected)
+        ))
+        send_seconds = time.perf_counter() - started
+        messages_after_send = await sync_to_async(count_messages)(conversation_ids)
+
+        await asyncio.sleep(self.drain)
+        for receiver in receivers:
+            receiver.cancel()
+        await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+        messages_after = await sync_to_async(count_messages)(conversation_ids)
+
+        # Everyone in the room, the sender included, gets each message
+        expected = self.sent * self.clients
+        latencies = sorted(self.latencies)
+        connect_times.sort()
+        return {
+            'rooms': self.rooms,
+            'clients_per_room': self.clients,
+            'connections': len(clients),
+            'connected': len(connected),
+            'connect_ms_p50': percentile(connect_times, 0.50),
+            'connect_ms_p99': percentile(connect_times, 0.99),
+            'duration_s': round(send_seconds, 3),
+            'sent': self.sent,
+            'sent_per_s': round(self.sent / send_seconds, 1),
+            'deliveries_expected': expected,
+            'deliveries_received': self.received,
+            'deliveries_per_s': round(self.received / send_seconds, 1),
+            'dropped': expected - self.received,
+            'dropped_pct': round(100 * (expected - self.received) / expected, 2) if expected else 0.0,
+            'latency_ms_p50': percentile(latencies, 0.50),
+            'latency_ms_p95': percentile(latencies, 0.95),
+            'latency_ms_p99': percentile(latencies, 0.99),
+            'latency_ms_max': percentile(latencies, 1.0),
+            'db_writes': messages_after - messages_before,
+            'db_writes_per_s': round((messages_after_send - messages_before) / send_seconds, 1),
+            'errors': dict(self.errors),
+            'closed_by_server': self.closed_early,
+        }
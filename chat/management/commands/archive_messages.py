@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.archive import archive_messages
+
+
+class Command(BaseCommand):
+    help = 'Move old messages out of the database into compressed archive segments'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-days', type=int, default=settings.CHAT_ARCHIVE_AFTER_DAYS,
+            help='Archive messages older than this many days (default: CHAT_ARCHIVE_AFTER_DAYS)',
+        )
+        parser.add_argument(
+            '--conversation', type=int, action='append', dest='conversations',
+            help='Only archive this conversation (can be repeated)',
+        )
+
+    def handle(self, *args, **options):
+        results = archive_messages(options['older_than_days'], options['conversations'])
+        for conversation_id, count in results.items():
+            self.stdout.write(f"Conversation {conversation_id}: archived {count} messages")
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {sum(results.values())} messages from {len(results)} conversations"
+        ))
@@ -0,0 +1,96 @@
+import asyncio
+import json
+
+from channels.layers import channel_layers
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.loadtest import LoadTest
+
+
+class Command(BaseCommand):
+    help = 'Measure WebSocket fan-out latency and throughput with simulated chat rooms'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=10, help='Number of conversations (default: 10)')
+        parser.add_argument('--clients', type=int, default=5, help='Connected users per conversation (default: 5)')
+        parser.add_argument(
+            '--rate', type=float, default=1.0,
+            help='Messages per second sent by each client (default: 1). '
+                 'Above CHAT_WS_MESSAGE_RATE the server rejects some of them.',
+        )
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds of sending (default: 10)')
+        parser.add_argument(
+            '--drain', type=float, default=3.0,
+            help='Seconds to keep receiving after the last send (default: 3)',
+        )
+        parser.add_argument(
+            '--url',
+            help='Connect to a running server, e.g. ws://localhost:8000, instead of '
+                 'running the ASGI application in this process (needs the websockets package)',
+        )
+        parser.add_argument(
+            '--channel-layer', choices=['configured', 'memory'], default='configured',
+            help='In-process only: use CHANNEL_LAYERS as configured or an in-memory layer',
+        )
+        parser.add_argument(
+            '--write-behind', choices=['configured', 'on', 'off'], default='configured',
+            help='In-process only: override CHAT_WRITE_BEHIND',
+        )
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        if min(options['rooms'], options['clients']) < 1 or options['rate'] <= 0 or options['duration'] <= 0:
+            raise CommandError('--rooms, --clients, --rate and --duration must be positive')
+
+        application = None
+        if options['url']:
+            try:
+                import websockets  # noqa: F401
+            except ImportError:
+                raise CommandError('--url needs the websockets package (pip install websockets)')
+        else:
+            if options['channel_layer'] == 'memory':
+                settings.CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+                channel_layers.backends = {}
+            if options['write_behind'] != 'configured':
+                settings.CHAT_WRITE_BEHIND = options['write_behind'] == 'on'
+            from chatapp.asgi import application
+
+        test = LoadTest(
+            options['rooms'], options['clients'], options['rate'], options['duration'],
+            drain=options['drain'], url=options['url'], application=application,
+        )
+        report = asyncio.run(test.run())
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        def ms(value):
+            return '-' if value is None else f'{value:.1f} ms'
+
+        self.stdout.write(
+            f"Connections:  {report['connected']}/{report['connections']} "
+            f"({report['rooms']} rooms x {report['clients_per_room']} clients), "
+            f"connect p50 {ms(report['connect_ms_p50'])}, p99 {ms(report['connect_ms_p99'])}"
+        )
+        self.stdout.write(
+            f"Sent:         {report['sent']} messages in {report['duration_s']} s "
+            f"({report['sent_per_s']}/s)"
+        )
+        self.stdout.write(
+            f"Delivered:    {report['deliveries_received']}/{report['deliveries_expected']} "
+            f"({report['deliveries_per_s']}/s), dropped {report['dropped']} ({report['dropped_pct']}%)"
+        )
+        self.stdout.write(
+            f"Latency:      p50 {ms(report['latency_ms_p50'])}, p95 {ms(report['latency_ms_p95'])}, "
+            f"p99 {ms(report['latency_ms_p99'])}, max {ms(report['latency_ms_max'])}"
+        )
+        self.stdout.write(
+            f"DB writes:    {report['db_writes']} messages, {report['db_writes_per_s']}/s while sending"
+        )
+        for reason, count in sorted(report['errors'].items()):
+            self.stdout.write(self.style.WARNING(f"Errors:       {count} x {reason}"))
+        if report['closed_by_server']:
+            self.stdout.write(self.style.WARNING(f"Closed:       {report['closed_by_server']} sockets closed by the server"))
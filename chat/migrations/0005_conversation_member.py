@@ -0,0 +1,79 @@
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max, Q
+import django.db.models.deletion
+
+
+def backfill_read_pointers(apps, schema_editor):
+    ConversationMember = apps.get_model('chat', 'ConversationMember')
+    Message = apps.get_model('chat', 'Message')
+    
+    for member in ConversationMember.objects.all().iterator():
+        incoming = Message.objects.filter(conversation_id=member.conversation_id).exclude(sender_id=member.user_id)
+        unread = incoming.filter(is_read=False)
+        
+        # Everything up to the oldest unread message counts as read
+        first_unread = unread.order_by('id').values_list('id', flat=True).first()
+        if first_unread is None:
+            last_read = Message.objects.filter(conversation_id=member.conversation_id).aggregate(m=Max('id'))['m']
+        else:
+            last_read = Message.objects.filter(
+                Q(conversation_id=member.conversation_id) & Q(id__lt=first_unread)
+            ).aggregate(m=Max('id'))['m']
+        
+        member.last_read_message_id = last_read or 0
+        member.unread_count = unread.count()
+        member.save(update_fields=['last_read_message_id', 'unread_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0004_conversation_summary'),
+    ]
+
+    operations = [
+        # Promote the auto-created participants table to an explicit through model
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='ConversationMember',
+                    fields=[
+                        ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='chat.conversation')),
+                        ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_memberships', to=settings.AUTH_USER_MODEL)),
+                    ],
+                    options={
+                        'db_table': 'chat_conversation_participants',
+                        'unique_together': {('conversation', 'user')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='conversation',
+                    name='participants',
+                    field=models.ManyToManyField(related_name='conversations', through='chat.ConversationMember', to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='conversationmember',
+            name='id',
+            field=models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID'),
+        ),
+        migrations.AddField(
+            model_name='conversationmember',
+            name='last_read_message_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversationmember',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_read_pointers, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
@@ -0,0 +1,83 @@
+from collections import defaultdict
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def assign_dm_keys(apps, schema_editor):
+    """Key every two-person conversation and merge pairs that have several"""
+    Conversation = apps.get_model('chat', 'Conversation')
+    ConversationMember = apps.get_model('chat', 'ConversationMember')
+    Message = apps.get_model('chat', 'Message')
+    
+    pairs = defaultdict(list)
+    two_person = Conversation.objects.annotate(members=Count('memberships')).filter(members=2)
+    for conversation_id in two_person.order_by('id').values_list('id', flat=True):
+        user_ids = sorted(
+            ConversationMember.objects.filter(conversation_id=conversation_id).values_list('user_id', flat=True)
+        )
+        pairs[f"{user_ids[0]}:{user_ids[1]}"].append(conversation_id)
+    
+    for dm_key, conversation_ids in pairs.items():
+        keep, duplicates = conversation_ids[0], conversation_ids[1:]
+        if duplicates:
+            merge_conversations(Conversation, ConversationMember, Message, keep, duplicates)
+        Conversation.objects.filter(pk=keep).update(dm_key=dm_key)
+
+
+def merge_conversations(Conversation, ConversationMember, Message, keep, duplicates):
+    group = [keep] + duplicates
+    messages = list(Message.objects.filter(conversation_id__in=group).order_by('created_at', 'id'))
+    
+    # Renumber in two passes through a range no existing seq uses, so the
+    # unique (conversation, seq) constraint holds after every row update
+    offset = max(
+        Conversation.objects.filter(pk__in=group).aggregate(top=Max('last_seq'))['top'] or 0,
+        len(messages),
+    ) + 1
+    for index, message in enumerate(messages):
+        message.conversation_id = keep
+        message.seq = offset + index
+    Message.objects.bulk_update(messages, ['conversation', 'seq'], batch_size=500)
+    for index, message in enumerate(messages):
+        message.seq = index + 1
+    Message.objects.bulk_update(messages, ['seq'], batch_size=500)
+    
+    # Each user keeps the furthest read pointer of their memberships
+    for member in ConversationMember.objects.filter(conversation_id=keep):
+        pointer = ConversationMember.objects.filter(
+            conversation_id__in=group, user_id=member.user_id
+        ).aggregate(pointer=Max('last_read_message_id'))['pointer'] or 0
+        member.last_read_message_id = pointer
+        member.unread_count = Message.objects.filter(
+            conversation_id=keep, id__gt=pointer
+        ).exclude(sender_id=member.user_id).count()
+        member.save(update_fields=['last_read_message_id', 'unread_count'])
+    
+    last = messages[-1] if messages else None
+    updated_at = Conversation.objects.filter(pk__in=group).aggregate(latest=Max('updated_at'))['latest']
+    Conversation.objects.filter(pk=keep).update(
+        last_message=last,
+        last_message_preview=(last.content[:255] or f"[{last.message_type.title()}]") if last else '',
+        last_message_at=last.created_at if last else None,
+        message_count=len(messages),
+        last_seq=len(messages),
+        updated_at=updated_at,
+    )
+    Conversation.objects.filter(pk__in=duplicates).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_message_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='dm_key',
+            field=models.CharField(blank=True, editable=False, max_length=41, null=True, unique=True),
+        ),
+        migrations.RunPython(assign_dm_keys, migrations.RunPython.noop),
+    ]
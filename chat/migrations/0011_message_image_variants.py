@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-18 05:02
+
+from importlib import import_module
+
+from django.db import migrations, models
+
+
+search = import_module('chat.migrations.0009_message_search')
+
+
+def restore_search_triggers(apps, schema_editor):
+    # SQLite adds this column by rebuilding chat_message, which drops the
+    # full-text triggers from 0009; put them back and reindex
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in search.SQLITE_REVERSE + search.SQLITE_FORWARD:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_conversation_archived_seq'),
+    ]
+
+    operations = [
+        # Listed on both sides so unapplying (which rebuilds again) restores them too
+        migrations.RunPython(migrations.RunPython.noop, restore_search_triggers),
+        migrations.AddField(
+            model_name='message',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.RunPython(restore_search_triggers, migrations.RunPython.noop),
+    ]
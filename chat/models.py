@@ -1,23 +1,57 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.conf import settings
+from django.utils import timezone
+from .ids import next_message_id
 
 
 class Conversation(models.Model):
     """Conversation between two or more users"""
     
-    participants = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name='conversations')
+    participants = models.ManyToManyField(
+        settings.AUTH_USER_MODEL, through='ConversationMember', related_name='conversations'
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    # Denormalized summary, maintained by chat.services.record_message
+    last_message = models.ForeignKey(
+        'Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    last_message_preview = models.CharField(max_length=255, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    message_count = models.PositiveIntegerField(default=0)
+    # Highest Message.seq handed out in this conversation
+    last_seq = models.PositiveBigIntegerField(default=0)
+    # Messages up to this seq have been moved to cold storage (chat.archive)
+    archived_seq = models.PositiveBigIntegerField(default=0)
+    # "<lower user id>:<higher user id>" for two-person conversations, so each
+    # pair of users has at most one and it can be found with one index probe
+    dm_key = models.CharField(max_length=41, unique=True, null=True, blank=True, editable=False)
+    
     class Meta:
         ordering = ['-updated_at']
     
     def __str__(self):
         return f"Conversation {self.id}"
     
-    @property
-    def last_message(self):
-        return self.messages.first()
+    @staticmethod
+    def dm_key_for(user_id, other_user_id):
+        low, high = sorted((user_id, other_user_id))
+        return f"{low}:{high}"
+    
+    @staticmethod
+    def allocate_seq(conversation_id, count=1):
+        """
+        Reserve ``count`` consecutive sequence numbers and return the first,
+        or None if the conversation no longer exists.
+        Must run inside a transaction: the UPDATE holds the row lock until
+        commit, so concurrent writers get disjoint ranges.
+        """
+        conversations = Conversation.objects.filter(pk=conversation_id)
+        if not conversations.update(last_seq=F('last_seq') + count):
+            return None
+        return conversations.values_list('last_seq', flat=True).get() - count + 1
 
 
 class Message(models.Model):
@@ -33,15 +67,77 @@ class Message(models.Model):
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='sent_messages')
     message_type = models.CharField(max_length=10, choices=MESSAGE_TYPE_CHOICES, default='text')
+    # Monotonic position within the conversation, used for delta sync
+    seq = models.PositiveBigIntegerField(editable=False)
     content = models.TextField(blank=True)
     image = models.ImageField(upload_to='chat/images/', blank=True, null=True)
+    # Resized copies of image (see chatapp.imaging)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     video = models.FileField(upload_to='chat/videos/', blank=True, null=True)
     file = models.FileField(upload_to='chat/files/', blank=True, null=True)
-    is_read = models.BooleanField(default=False)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Set when the message is built rather than when it is written, so a
+    # write-behind message keeps the timestamp it was broadcast with
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     
     class Meta:
+        # On SQLite most schema changes to this table rebuild it, dropping the
+        # full-text search triggers; such migrations must restore them (see 0011)
         ordering = ['-created_at']
+        indexes = [
+            # Serves keyset pagination of a conversation's history
+            models.Index(fields=['conversation', 'created_at', 'id'], name='chat_msg_conv_created_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'seq'], name='chat_msg_conv_seq_uniq'),
+        ]
     
     def __str__(self):
         return f"{self.sender.username}: {self.content[:50]}"
+    
+    def save(self, *args, **kwargs):
+        # Ids come from chat.ids so they can be handed out before the INSERT
+        if self._state.adding and self.id is None:
+            self.id = next_message_id()
+            kwargs.setdefault('force_insert', True)
+        
+        if self._state.adding and self.seq is None:
+            with transaction.atomic():
+                self.seq = Conversation.allocate_seq(self.conversation_id)
+                if self.seq is None:
+                    raise Conversation.DoesNotExist(f'Conversation {self.conversation_id} no longer exists')
+                super().save(*args, **kwargs)
+            return
+        
+        super().save(*args, **kwargs)
+
+
+class ConversationMember(models.Model):
+    """A user's membership in a conversation, along with their read position"""
+    
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='memberships')
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='conversation_memberships'
+    )
+    # Id of the newest message this user has read (0 = nothing read yet)
+    last_read_message_id = models.BigIntegerField(default=0)
+    unread_count = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        # Reuses the table Django created for the original participants M2M
+        db_table = 'chat_conversation_participants'
+        unique_together = ['conversation', 'user']
+    
+    def __str__(self):
+        return f"{self.user.username} in conversation {self.conversation_id}"
+
+
+class WorkerIdLease(models.Model):
+    """A message id worker id held by one running process (see chat/ids.py)"""
+    
+    worker_id = models.PositiveSmallIntegerField(primary_key=True)
+    # Random token of the holding process
+    owner = models.CharField(max_length=32)
+    expires_at = models.DateTimeField()
+    
+    def __str__(self):
+        return f"worker {self.worker_id} until {self.expires_at}"
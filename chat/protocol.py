@@ -0,0 +1,128 @@
+"""
+Wire formats for the chat WebSocket.
+
+Clients pick a format with the WebSocket subprotocol:
+
+* ``chat.json`` (also used when no subprotocol is requested): JSON text frames
+  with the long field names the API has always used.
+* ``chat.msgpack``: MessagePack binary frames with the single-letter keys in
+  SHORT_KEYS and timestamps as epoch milliseconds. Offered only when the
+  ``msgpack`` package (in requirements.txt) is installed.
+
+Outgoing events are encoded once per broadcast with encode_frames() and every
+recipient just picks the frame for its own format.
+"""
+
+import json
+from datetime import datetime
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# What decode_frame() raises for a frame that is not a valid object
+DECODE_ERRORS = (ValueError, TypeError)
+if msgpack is not None:
+    DECODE_ERRORS += (msgpack.UnpackException,)
+
+
+JSON = 'chat.json'
+MSGPACK = 'chat.msgpack'
+
+SHORT_KEYS = {
+    'type': 't',
+    'message': 'm',
+    'id': 'i',
+    'conversation_id': 'c',
+    'seq': 'q',
+    'sender_id': 's',
+    'sender_username': 'u',
+    'message_type': 'k',
+    'content': 'b',
+    'created_at': 'a',
+    'user_id': 'w',
+    'username': 'n',
+    'is_typing': 'y',
+    'is_online': 'o',
+    'replayed': 'r',
+    'message_id': 'x',
+}
+LONG_KEYS = {short: long for long, short in SHORT_KEYS.items()}
+
+
+def supported_protocols():
+    if msgpack is None:
+        return (JSON,)
+    return (JSON, MSGPACK)
+
+
+def choose_protocol(requested):
+    """Pick the first subprotocol we support from the client's list, or None for plain JSON"""
+    supported = supported_protocols()
+    for protocol in requested:
+        if protocol in supported:
+            return protocol
+    return None
+
+
+def _shorten(value):
+    if isinstance(value, dict):
+        return {SHORT_KEYS.get(key, key): _shorten(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_shorten(item) for item in value]
+    return value
+
+
+def _lengthen(value):
+    if isinstance(value, dict):
+        return {LONG_KEYS.get(key, key): _lengthen(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_lengthen(item) for item in value]
+    return value
+
+
+def _compact(data):
+    data = _shorten(data)
+    # ``message`` is the chat message for message events, but text for errors
+    message = data.get('m')
+    if isinstance(message, dict) and isinstance(message.get('a'), str):
+        message['a'] = int(datetime.fromisoformat(message['a']).timestamp() * 1000)
+    return data
+
+
+def encode_frame(protocol, data):
+    """Encode an outgoing event for one format"""
+    if protocol == MSGPACK:
+        return msgpack.packb(_compact(data))
+    return json.dumps(data)
+
+
+def encode_frames(data):
+    """Encode an outgoing event for every supported format: {protocol: frame}"""
+    return {protocol: encode_frame(protocol, data) for protocol in supported_protocols()}
+
+
+def decode_event(frames):
+    """Recover the event dict from frames built by encode_frames()"""
+    return json.loads(frames[JSON])
+
+
+def send_kwargs(protocol, frame):
+    """Keyword arguments for WebsocketConsumer.send() carrying ``frame``"""
+    if protocol == MSGPACK:
+        return {'bytes_data': frame}
+    return {'text_data': frame}
+
+
+def decode_frame(protocol, text_data=None, bytes_data=None):
+    """Decode an incoming frame into a dict with the long field names"""
+    if protocol == MSGPACK and bytes_data is not None:
+        data = msgpack.unpackb(bytes_data)
+        if not isinstance(data, dict):
+            raise ValueError('Expected a map')
+        return _lengthen(data)
+    data = json.loads(text_data if text_data is not None else bytes_data)
+    if not isinstance(data, dict):
+        raise ValueError('Expected an object')
+    return data
@@ -0,0 +1,117 @@
+"""
+Coalesced read receipts from WebSocket clients.
+
+Clients ack what they have read with ``{"type": "read", "message_id": N}``.
+ChatConsumer hands each ack to the process-wide ReadReceiptBuffer, which
+keeps only the highest id per (conversation, user). Every
+CHAT_READ_FLUSH_INTERVAL seconds the buffer writes everything it holds in
+one UPDATE (chat.services.apply_read_pointers). It then broadcasts one
+chat_read event per pointer to the conversation's group, so a client that
+acks every message as it scrolls costs at most one write per interval.
+
+Pointers still buffered at interpreter exit are flushed synchronously. A
+hard kill loses at most one interval of acks, which the next ack or REST
+read repairs.
+"""
+
+import asyncio
+import atexit
+import logging
+import threading
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import DatabaseError
+
+from .protocol import encode_frames
+from .services import apply_read_pointers
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReadReceiptBuffer:
+    """Keeps the newest read ack per (conversation, user) until the next flush"""
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._task = None
+        self._has_pending = None
+
+    def submit(self, conversation_id, user_id, message_id):
+        """Record an ack; call from the event loop"""
+        self._ensure_flusher()
+        self._merge({(conversation_id, user_id): message_id})
+        self._has_pending.set()
+
+    def _merge(self, pointers):
+        with self._lock:
+            for key, message_id in pointers.items():
+                if message_id > self._pending.get(key, 0):
+                    self._pending[key] = message_id
+
+    def flush(self):
+        """Persist buffered pointers; returns the pointers as applied"""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return {}
+        try:
+            return apply_read_pointers(batch)
+        except DatabaseError:
+            logger.exception("Could not write %d read pointers, will retry", len(batch))
+            self._merge(batch)
+            return {}
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._task is not None and not self._task.done():
+            return
+        self._loop = loop
+        self._has_pending = asyncio.Event()
+        self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        channel_layer = get_channel_layer()
+        while True:
+            await self._has_pending.wait()
+            # Let acks for the same conversation pile up before writing
+            await asyncio.sleep(self.flush_interval)
+            self._has_pending.clear()
+
+            applied = await database_sync_to_async(self.flush)()
+            for (conversation_id, user_id), message_id in applied.items():
+                await channel_layer.group_send(
+                    f'chat_{conversation_id}',
+                    {
+                        'type': 'chat_read',
+                        'conversation_id': conversation_id,
+                        'user_id': user_id,
+                        'frames': encode_frames({
+                            'type': 'read',
+                            'conversation_id': conversation_id,
+                            'user_id': user_id,
+                            'message_id': message_id,
+                        }),
+                    }
+                )
+
+            with self._lock:
+                if self._pending:
+                    self._has_pending.set()
+
+
+_receipts = None
+
+
+def get_receipts():
+    """Return the process-wide read receipt buffer"""
+    global _receipts
+    if _receipts is None:
+        _receipts = ReadReceiptBuffer(settings.CHAT_READ_FLUSH_INTERVAL)
+        atexit.register(_receipts.flush)
+    return _receipts
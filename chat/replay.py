@@ -0,0 +1,140 @@
+"""
+Per-room replay buffers for WebSocket session resume.
+
+Each process keeps the most recent chat_message events of the rooms its
+clients are in, so a client that reconnects after a short drop can be sent
+what it missed without a database query. The buffers are filled by one
+listener channel per process that joins a room's group when the first local
+client does, and stays in it for CHAT_REPLAY_LINGER seconds after the last
+one leaves. A client that reconnects within that window still finds a
+complete buffer, even if it was the room's only local client. Messages sent
+through the REST API or finished uploads reach the room group too (see
+chat.services.broadcast_message), so the buffer holds every message.
+
+A buffer only answers for the span it saw in full. Older gaps (or rooms this
+process was not listening to) fall back to the database; see ChatConsumer.
+The listener channel gets a large capacity (CHAT_REPLAY_CHANNEL_CAPACITY),
+and if the channel layer still drops events for it, every buffer's floor is
+raised to the present, so earlier gaps are answered from the database.
+"""
+
+import asyncio
+import time
+from collections import deque
+
+from django.conf import settings
+
+from .ids import first_id_at
+from .protocol import decode_event
+
+
+class RoomBuffer:
+    """Bounded, id-ordered window of a room's recent messages"""
+
+    def __init__(self, size, floor):
+        self.messages = deque(maxlen=size)
+        # Every message with a larger id than this has been seen
+        self.floor = floor
+
+    def append(self, message):
+        if len(self.messages) == self.messages.maxlen:
+            self.floor = max(self.floor, self.messages[0]['id'])
+        self.messages.append(message)
+
+    def since(self, message_id):
+        """Messages after ``message_id``, or None if some may be missing"""
+        if message_id < self.floor:
+            return None
+        return sorted(
+            (message for message in self.messages if message['id'] > message_id),
+            key=lambda message: message['id']
+        )
+
+
+class ReplayBuffers:
+    def __init__(self, size, linger):
+        self.size = size
+        self.linger = linger
+        self._loop = None
+
+    def _bind(self, channel_layer):
+        # The listener channel and its task belong to one event loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._layer = channel_layer
+            self._channel = None
+            self._listener = None
+            self._rooms = {}
+            self._subscribers = {}
+            self._expiry = {}
+
+    async def subscribe(self, channel_layer, conversation_id):
+        """Register a local client of a room and start buffering it"""
+        self._bind(channel_layer)
+        if self._channel is None:
+            self._channel = await self._layer.new_channel('replay')
+        if self._listener is None or self._listener.done():
+            self._listener = self._loop.create_task(self._listen())
+
+        expiry = self._expiry.pop(conversation_id, None)
+        if expiry is not None:
+            expiry.cancel()
+        self._subscribers[conversation_id] = self._subscribers.get(conversation_id, 0) + 1
+
+        if conversation_id not in self._rooms:
+            await self._layer.group_add(f'chat_{conversation_id}', self._channel)
+            # Anything issued from now on reaches the listener
+            self._rooms[conversation_id] = RoomBuffer(self.size, first_id_at(time.time()))
+
+    def unsubscribe(self, conversation_id):
+        count = self._subscribers.get(conversation_id, 0) - 1
+        self._subscribers[conversation_id] = max(count, 0)
+        if count <= 0 and conversation_id not in self._expiry:
+            self._expiry[conversation_id] = self._loop.create_task(self._expire(conversation_id))
+
+    def since(self, conversation_id, message_id):
+        room = self._rooms.get(conversation_id) if self._loop is asyncio.get_running_loop() else None
+        return room.since(message_id) if room is not None else None
+
+    async def _expire(self, conversation_id):
+        await asyncio.sleep(self.linger)
+        if self._subscribers.get(conversation_id):
+            return
+        self._expiry.pop(conversation_id, None)
+        self._subscribers.pop(conversation_id, None)
+        self._rooms.pop(conversation_id, None)
+        await self._layer.group_discard(f'chat_{conversation_id}', self._channel)
+
+    def _mark_lost(self):
+        """Some events never reached the listener; stop vouching for anything before now"""
+        floor = first_id_at(time.time())
+        for room in self._rooms.values():
+            room.floor = max(room.floor, floor)
+
+    async def _listen(self):
+        pop_overflow = getattr(self._layer, 'pop_overflow', None)
+        while True:
+            event = await self._layer.receive(self._channel)
+            if pop_overflow is not None and pop_overflow(self._channel):
+                self._mark_lost()
+            if event.get('type') != 'chat_message':
+                continue
+            message = decode_event(event['frames'])['message']
+            room = self._rooms.get(message.get('conversation_id'))
+            if room is not None:
+                room.append(message)
+
+
+_buffers = None
+
+
+def get_buffers():
+    """The process-wide replay buffers"""
+    global _buffers
+    if _buffers is None:
+        _buffers = ReplayBuffers(
+            size=settings.CHAT_REPLAY_BUFFER_SIZE,
+            linger=settings.CHAT_REPLAY_LINGER,
+        )
+    return _buffers
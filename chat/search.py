@@ -0,0 +1,124 @@
+"""
+Full-text search over message content.
+
+On SQLite the index is an FTS5 table, chat_message_fts, with chat_message as
+its external content. On PostgreSQL it is a generated tsvector column,
+chat_message.search_vector, with a GIN index. Migration 0009 creates
+whichever one fits the database, and triggers (SQLite) or the generated
+column (PostgreSQL) keep it in step with every insert, update and delete.
+Other databases fall back to a LIKE scan.
+
+The user's query is reduced to plain word tokens, so it can never be
+misread as FTS syntax. Tokens are ANDed together and the last one matches
+as a prefix, so results show up while the user is still typing.
+"""
+
+import html
+import re
+
+from django.db import connection
+
+from .models import Message
+
+
+# Snippet markers from the database; swapped for <mark> after escaping
+MARK_START = '\ue000'
+MARK_END = '\ue001'
+SNIPPET_WORDS = 16
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(query):
+    return TOKEN_RE.findall(query.lower())
+
+
+def _sqlite_match(tokens):
+    return ' '.join(f'"{token}"' for token in tokens[:-1]) + f' "{tokens[-1]}"*'
+
+
+def _postgres_tsquery(tokens):
+    return ' & '.join(tokens[:-1] + [f'{tokens[-1]}:*'])
+
+
+SQLITE_SEARCH = f"""
+    SELECT m.id, snippet(chat_message_fts, 0, '{MARK_START}', '{MARK_END}', '…', {SNIPPET_WORDS})
+    FROM chat_message_fts
+    JOIN chat_message m ON m.id = chat_message_fts.rowid
+    JOIN chat_conversation_participants p ON p.conversation_id = m.conversation_id AND p.user_id = %s
+    WHERE chat_message_fts MATCH %s {{conversation_filter}}
+    ORDER BY bm25(chat_message_fts), m.id DESC
+    LIMIT %s OFFSET %s
+"""
+
+POSTGRES_SEARCH = f"""
+    SELECT m.id, ts_headline(
+        'simple', m.content, query,
+        'StartSel={MARK_START}, StopSel={MARK_END}, MaxWords={SNIPPET_WORDS}, MinWords=5'
+    )
+    FROM chat_message m
+    JOIN chat_conversation_participants p ON p.conversation_id = m.conversation_id AND p.user_id = %s,
+    to_tsquery('simple', %s) query
+    WHERE m.search_vector @@ query {{conversation_filter}}
+    ORDER BY ts_rank(m.search_vector, query) DESC, m.id DESC
+    LIMIT %s OFFSET %s
+"""
+
+
+def _search_index(sql, match, user, conversation_id, limit, offset):
+    conversation_filter = ''
+    params = [user.id, match]
+    if conversation_id is not None:
+        conversation_filter = 'AND m.conversation_id = %s'
+        params.append(conversation_id)
+    params += [limit, offset]
+    with connection.cursor() as cursor:
+        cursor.execute(sql.format(conversation_filter=conversation_filter), params)
+        return cursor.fetchall()
+
+
+def _search_like(tokens, user, conversation_id, limit, offset):
+    messages = Message.objects.filter(conversation__memberships__user=user)
+    if conversation_id is not None:
+        messages = messages.filter(conversation_id=conversation_id)
+    for token in tokens:
+        messages = messages.filter(content__icontains=token)
+    return [
+        (pk, content[:200])
+        for pk, content in messages.order_by('-created_at', '-id').values_list('id', 'content')[offset:offset + limit]
+    ]
+
+
+def highlight(snippet):
+    """HTML-escape a snippet and turn the match markers into <mark> tags"""
+    return html.escape(snippet).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+def search_messages(user, query, conversation_id=None, limit=20, offset=0):
+    """
+    Search messages in the user's conversations, best matches first.
+
+    Returns ``(messages, has_more)``. Each message has a ``snippet`` attribute
+    holding escaped HTML with the matched words wrapped in <mark>.
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        return [], False
+
+    if connection.vendor == 'sqlite':
+        rows = _search_index(SQLITE_SEARCH, _sqlite_match(tokens), user, conversation_id, limit + 1, offset)
+    elif connection.vendor == 'postgresql':
+        rows = _search_index(POSTGRES_SEARCH, _postgres_tsquery(tokens), user, conversation_id, limit + 1, offset)
+    else:
+        rows = _search_like(tokens, user, conversation_id, limit + 1, offset)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    messages = Message.objects.select_related('sender').in_bulk([pk for pk, _ in rows])
+    results = []
+    for pk, snippet in rows:
+        message = messages.get(pk)
+        if message is not None:
+            message.snippet = highlight(snippet)
+            results.append(message)
+    return results, has_more
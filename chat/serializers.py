@@ -1,31 +1,77 @@
 from rest_framework import serializers
-from .models import Conversation, Message
+from chatapp.imaging import ImageVariantsField
+from .models import Conversation, ConversationMember, Message
+from .services import read_state
 from users.serializers import UserSerializer
 
 
 class MessageSerializer(serializers.ModelSerializer):
     sender = UserSerializer(read_only=True)
+    is_read = serializers.SerializerMethodField()
+    image_variants = ImageVariantsField('image')
     
     class Meta:
         model = Message
-        fields = ['id', 'sender', 'message_type', 'content', 'image', 'video', 'file', 'is_read', 'created_at']
-        read_only_fields = ['id', 'sender', 'created_at']
+        fields = [
+            'id', 'seq', 'sender', 'message_type', 'content', 'image', 'image_variants',
+            'video', 'file', 'is_read', 'created_at'
+        ]
+        read_only_fields = ['id', 'seq', 'sender', 'created_at']
+    
+    def get_is_read(self, obj):
+        # (viewer_id, own_pointer, others_pointer) from chat.services.read_state
+        state = self.context.get('read_state')
+        if state is None:
+            return False
+        viewer_id, own_pointer, others_pointer = state
+        if obj.sender_id == viewer_id:
+            return obj.id <= others_pointer
+        return obj.id <= own_pointer
+
+
+class MessageSearchResultSerializer(MessageSerializer):
+    conversation_id = serializers.IntegerField(read_only=True)
+    # Escaped HTML with the matched words wrapped in <mark>
+    snippet = serializers.CharField(read_only=True)
+    
+    class Meta(MessageSerializer.Meta):
+        fields = ['conversation_id'] + MessageSerializer.Meta.fields + ['snippet']
 
 
 class ConversationSerializer(serializers.ModelSerializer):
     participants = UserSerializer(many=True, read_only=True)
-    last_message = MessageSerializer(read_only=True)
+    last_message = serializers.SerializerMethodField()
     unread_count = serializers.SerializerMethodField()
     
     class Meta:
         model = Conversation
-        fields = ['id', 'participants', 'last_message', 'unread_count', 'created_at', 'updated_at']
-        read_only_fields = ['id', 'created_at', 'updated_at']
+        fields = [
+            'id', 'participants', 'last_message', 'last_message_preview', 'last_message_at',
+            'message_count', 'last_seq', 'unread_count', 'created_at', 'updated_at'
+        ]
+        read_only_fields = fields
+    
+    def get_last_message(self, obj):
+        if obj.last_message is None:
+            return None
+        context = dict(self.context)
+        request = self.context.get('request')
+        if request and request.user.is_authenticated:
+            # list_conversations annotates the read pointers to avoid a query per row
+            if hasattr(obj, 'own_read_pointer'):
+                context['read_state'] = (request.user.id, obj.own_read_pointer, obj.others_read_pointer or 0)
+            else:
+                context['read_state'] = read_state(obj.id, request.user.id)
+        return MessageSerializer(obj.last_message, context=context).data
     
     def get_unread_count(self, obj):
+        if hasattr(obj, 'unread_messages'):
+            return obj.unread_messages
         request = self.context.get('request')
         if request and request.user.is_authenticated:
-            return obj.messages.filter(is_read=False).exclude(sender=request.user).count()
+            return ConversationMember.objects.filter(
+                conversation=obj, user=request.user
+            ).values_list('unread_count', flat=True).first() or 0
         return 0
 
 
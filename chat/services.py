@@ -0,0 +1,288 @@
+from collections import defaultdict
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import IntegrityError, transaction
+from django.db.models import (
+    BigIntegerField, Case, Count, F, Min, OuterRef, PositiveIntegerField, Q, Subquery, Value, When
+)
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+from .ids import next_message_id
+from .models import Conversation, ConversationMember, Message
+from .protocol import encode_frames
+
+
+PREVIEW_LENGTH = 255
+
+
+def message_preview(message):
+    """Short text shown for a message in the conversation list"""
+    if message.content:
+        return message.content[:PREVIEW_LENGTH]
+    return f"[{message.get_message_type_display()}]"
+
+
+def message_payload(message):
+    """The chat_message event body for a message"""
+    return {
+        'id': message.id,
+        'conversation_id': message.conversation_id,
+        # None in write-behind mode until the message is written
+        'seq': message.seq,
+        'sender_id': message.sender_id,
+        'sender_username': message.sender.username,
+        'message_type': message.message_type,
+        'content': message.content,
+        'created_at': message.created_at.isoformat(),
+    }
+
+
+def broadcast_message(message):
+    """
+    Send a message created outside the WebSocket consumers (REST, uploads)
+    to its room once the transaction commits, so connected clients and the
+    replay buffers (chat/replay.py) receive it like any other.
+    """
+    event = {
+        'type': 'chat_message',
+        'message_id': message.id,
+        'frames': encode_frames({
+            'type': 'message',
+            'message': message_payload(message),
+        }),
+    }
+    channel_layer = get_channel_layer()
+    transaction.on_commit(
+        lambda: async_to_sync(channel_layer.group_send)(f'chat_{message.conversation_id}', event)
+    )
+
+
+def record_message(message):
+    """Fold a newly created message into its conversation's summary"""
+    record_messages([message])
+
+
+def record_messages(messages):
+    """
+    Fold newly created messages into their conversations' summaries and
+    their members' read state.
+    
+    Each conversation is updated with a single UPDATE so concurrent senders
+    never lose a count, and the last-message pointer only moves forward, so
+    a slow writer cannot overwrite a newer message with an older one.
+    """
+    by_conversation = defaultdict(list)
+    for message in messages:
+        by_conversation[message.conversation_id].append(message)
+    
+    for conversation_id, batch in by_conversation.items():
+        batch.sort(key=lambda m: m.id)
+        _record_batch(conversation_id, batch)
+
+
+def _record_batch(conversation_id, batch):
+    newest = batch[-1]
+    is_newer = Q(last_message__isnull=True) | Q(last_message_id__lt=newest.id)
+    
+    def if_newer(field_name, value):
+        field = Conversation._meta.get_field(field_name)
+        return Case(
+            When(is_newer, then=Value(value)),
+            default=F(field.attname),
+            output_field=field.target_field if field.is_relation else field,
+        )
+    
+    Conversation.objects.filter(pk=conversation_id).update(
+        last_message=if_newer('last_message', newest.id),
+        last_message_preview=if_newer('last_message_preview', message_preview(newest)),
+        last_message_at=if_newer('last_message_at', newest.created_at),
+        message_count=F('message_count') + len(batch),
+        updated_at=timezone.now(),
+    )
+    
+    members = ConversationMember.objects.filter(conversation_id=conversation_id)
+    last_sent = {message.sender_id: index for index, message in enumerate(batch)}
+    members.exclude(user_id__in=last_sent).update(unread_count=F('unread_count') + len(batch))
+    # Sending a message implies having read everything before it
+    for sender_id, index in last_sent.items():
+        members.filter(user_id=sender_id).update(
+            last_read_message_id=batch[index].id,
+            unread_count=len(batch) - index - 1,
+        )
+
+
+def assign_seqs(messages):
+    """
+    Give unsaved messages consecutive sequence numbers, in id order. Returns
+    the messages that got one; those of deleted conversations are left out.
+    """
+    by_conversation = defaultdict(list)
+    for message in messages:
+        by_conversation[message.conversation_id].append(message)
+    
+    assigned = []
+    for conversation_id, batch in by_conversation.items():
+        batch.sort(key=lambda m: m.id)
+        first = Conversation.allocate_seq(conversation_id, len(batch))
+        if first is None:
+            continue
+        for offset, message in enumerate(batch):
+            message.seq = first + offset
+        assigned.extend(batch)
+    return assigned
+
+
+def persist_messages(messages):
+    """
+    Insert pre-built messages in one statement and record them. Messages for
+    conversations deleted since they were built are dropped; returns the
+    messages written.
+    """
+    for message in messages:
+        if message.id is None:
+            message.id = next_message_id()
+    with transaction.atomic():
+        messages = assign_seqs(messages)
+        if messages:
+            Message.objects.bulk_create(messages)
+            record_messages(messages)
+    return messages
+
+
+def mark_read(conversation_id, user_id):
+    """Move a user's read pointer to the conversation's latest message"""
+    latest = Conversation.objects.filter(pk=conversation_id).values('last_message_id')
+    ConversationMember.objects.filter(conversation_id=conversation_id, user_id=user_id).update(
+        last_read_message_id=Coalesce(Subquery(latest), Value(0)),
+        unread_count=0,
+    )
+
+
+def apply_read_pointers(pointers):
+    """
+    Move several read pointers forward in one UPDATE.
+    
+    ``pointers`` maps ``(conversation_id, user_id)`` to the id of the newest
+    message the user has read. Ids are clamped to the conversation's latest
+    message and pointers never move backwards; unread counts are recounted
+    from the new position. Returns the pointers as applied.
+    """
+    latest = dict(
+        Conversation.objects.filter(pk__in={conversation_id for conversation_id, _ in pointers})
+        .values_list('pk', 'last_message_id')
+    )
+    applied = {}
+    for (conversation_id, user_id), message_id in pointers.items():
+        message_id = min(message_id, latest.get(conversation_id) or 0)
+        if message_id > 0:
+            applied[(conversation_id, user_id)] = message_id
+    if not applied:
+        return {}
+    
+    conditions = Q()
+    pointer_cases = []
+    unread_cases = []
+    for (conversation_id, user_id), message_id in applied.items():
+        match = Q(conversation_id=conversation_id, user_id=user_id)
+        conditions |= match
+        pointer_cases.append(When(match, then=Greatest(
+            F('last_read_message_id'), Value(message_id), output_field=BigIntegerField()
+        )))
+        unread = (
+            Message.objects.filter(
+                conversation_id=conversation_id,
+                id__gt=Greatest(OuterRef('last_read_message_id'), Value(message_id), output_field=BigIntegerField()),
+            )
+            .exclude(sender_id=user_id)
+            .order_by()
+            .values('conversation_id')
+            .annotate(count=Count('pk'))
+            .values('count')
+        )
+        unread_cases.append(When(match, then=Coalesce(Subquery(unread), Value(0))))
+    
+    ConversationMember.objects.filter(conditions).update(
+        last_read_message_id=Case(*pointer_cases, default=F('last_read_message_id'), output_field=BigIntegerField()),
+        unread_count=Case(*unread_cases, default=F('unread_count'), output_field=PositiveIntegerField()),
+    )
+    return applied
+
+
+def read_state(conversation_id, user_id):
+    """
+    Return ``(user_id, own_pointer, others_pointer)`` for MessageSerializer.
+    
+    ``others_pointer`` is the lowest pointer among the other members, so a
+    message is reported as read only once everyone has read it.
+    """
+    pointers = ConversationMember.objects.filter(conversation_id=conversation_id).aggregate(
+        own=Min('last_read_message_id', filter=Q(user_id=user_id)),
+        others=Min('last_read_message_id', filter=~Q(user_id=user_id)),
+    )
+    return user_id, pointers['own'] or 0, pointers['others'] or 0
+
+
+def conversations_for(user):
+    """
+    The user's conversations, annotated with everything ConversationSerializer
+    needs so that serializing any number of them costs a fixed number of queries.
+    """
+    others_pointer = (
+        ConversationMember.objects.filter(conversation=OuterRef('pk'))
+        .exclude(user=user)
+        .values('conversation')
+        .annotate(pointer=Min('last_read_message_id'))
+        .values('pointer')
+    )
+    return (
+        Conversation.objects.filter(memberships__user=user)
+        .select_related('last_message__sender')
+        .prefetch_related('participants')
+        .annotate(
+            unread_messages=F('memberships__unread_count'),
+            own_read_pointer=F('memberships__last_read_message_id'),
+            others_read_pointer=Subquery(others_pointer),
+        )
+    )
+
+
+def get_or_create_direct_conversation(user, other_user):
+    """
+    Return ``(conversation, created)`` for the two-person conversation
+    between the users, looked up by its unique dm_key.
+    """
+    dm_key = Conversation.dm_key_for(user.id, other_user.id)
+    conversation = Conversation.objects.filter(dm_key=dm_key).first()
+    if conversation is not None:
+        return conversation, False
+    
+    try:
+        with transaction.atomic():
+            conversation = Conversation.objects.create(dm_key=dm_key)
+            ConversationMember.objects.bulk_create([
+                ConversationMember(conversation=conversation, user=user),
+                ConversationMember(conversation=conversation, user=other_user),
+            ])
+    except IntegrityError:
+        # A concurrent request created it first
+        return Conversation.objects.get(dm_key=dm_key), False
+    return conversation, True
+
+
+def announce_conversation(conversation_id, user_ids, conversation_data):
+    """
+    Tell the users' ws/chat/ sockets about a new conversation so they join
+    its group and start receiving its messages.
+    """
+    channel_layer = get_channel_layer()
+    frames = encode_frames({
+        'type': 'conversation',
+        'conversation_id': conversation_id,
+        'conversation': conversation_data,
+    })
+    for user_id in user_ids:
+        async_to_sync(channel_layer.group_send)(f'user_{user_id}', {
+            'type': 'conversation_started',
+            'conversation_id': conversation_id,
+            'frames': frames,
+        })
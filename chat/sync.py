@@ -0,0 +1,109 @@
+"""
+Delta sync for reconnecting clients.
+
+A client sends the last sequence number it has seen in each conversation (or
+the opaque cursor returned by its previous sync) and gets back, in a single
+bounded response, the summaries of the conversations that moved past that
+point and the new messages in each of them, oldest first. When ``has_more``
+is set the client repeats the call with the returned cursor.
+
+The changed conversations are picked in SQL by comparing last_seq with the
+client's positions, so the cost follows what changed, not how many
+conversations the user has. Messages that were archived (chat.archive) since
+the client's position are not sent; ``archived`` maps those conversations to
+their archived_seq, and the client pages back through the messages endpoint,
+which reads the archive, to fill the gap.
+"""
+
+import base64
+import binascii
+import json
+
+from django.conf import settings
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
+
+from .models import Message
+from .serializers import ConversationSerializer, MessageSerializer
+from .services import conversations_for
+
+
+class InvalidSyncCursor(ValueError):
+    """Raised for a sync cursor that we did not issue"""
+
+
+def encode_sync_cursor(positions):
+    raw = json.dumps(positions, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_sync_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        positions = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return {int(key): int(value) for key, value in positions.items()}
+    except (ValueError, TypeError, AttributeError, binascii.Error):
+        raise InvalidSyncCursor(cursor)
+
+
+def build_sync(request, positions):
+    """Build the sync payload for ``positions`` ({conversation id: seq})"""
+    max_conversations = settings.CHAT_SYNC_MAX_CONVERSATIONS
+    per_conversation = settings.CHAT_SYNC_MESSAGES_PER_CONVERSATION
+
+    seen = {conversation_id: seq for conversation_id, seq in positions.items() if seq > 0}
+    # Conversations the client has never seen, plus those that moved past its position
+    moved = Q(last_seq__gt=0) & ~Q(pk__in=seen)
+    for conversation_id, seq in seen.items():
+        moved |= Q(pk=conversation_id, last_seq__gt=seq)
+    changed = list(conversations_for(request.user).filter(moved)[:max_conversations + 1])
+    has_more = len(changed) > max_conversations
+    changed = changed[:max_conversations]
+
+    # Where each conversation's remaining messages start in the table
+    starts = {
+        conversation.id: max(positions.get(conversation.id, 0), conversation.archived_seq)
+        for conversation in changed
+    }
+    messages_by_conversation = {conversation.id: [] for conversation in changed}
+    if changed:
+        # One query: each conversation's next messages via its (conversation, seq) index
+        conditions = Q()
+        for conversation in changed:
+            conditions |= Q(conversation_id=conversation.id, seq__gt=starts[conversation.id])
+        rows = (
+            Message.objects.filter(conditions)
+            .annotate(position=Window(
+                RowNumber(), partition_by=F('conversation_id'), order_by=F('seq').asc()
+            ))
+            .filter(position__lte=per_conversation + 1)
+            .select_related('sender')
+            .order_by('conversation_id', 'seq')
+        )
+        for message in rows:
+            messages_by_conversation[message.conversation_id].append(message)
+
+    new_positions = dict(positions)
+    messages = {}
+    archived = {}
+    for conversation in changed:
+        if positions.get(conversation.id, 0) < conversation.archived_seq:
+            archived[str(conversation.id)] = conversation.archived_seq
+        batch = messages_by_conversation[conversation.id]
+        if len(batch) > per_conversation:
+            has_more = True
+            batch = batch[:per_conversation]
+        new_positions[conversation.id] = batch[-1].seq if batch else starts[conversation.id]
+
+        read_state = (request.user.id, conversation.own_read_pointer, conversation.others_read_pointer or 0)
+        messages[str(conversation.id)] = MessageSerializer(
+            batch, many=True, context={'read_state': read_state}
+        ).data
+
+    return {
+        'conversations': ConversationSerializer(changed, many=True, context={'request': request}).data,
+        'messages': messages,
+        'archived': archived,
+        'has_more': has_more,
+        'cursor': encode_sync_cursor(new_positions),
+    }
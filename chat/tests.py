@@ -0,0 +1,69 @@
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase
+
+from .consumers import ChatConsumer
+from .limits import TokenBucket
+from .protocol import JSON, MSGPACK, encode_frame, send_kwargs
+
+
+class FrameRoundTripTests(SimpleTestCase):
+    """Events encoded for each wire format decode back to the same fields"""
+
+    MESSAGE_EVENT = {
+        'type': 'message',
+        'message': {
+            'id': 7,
+            'conversation_id': 3,
+            'seq': 1,
+            'sender_id': 2,
+            'sender_username': 'alice',
+            'message_type': 'text',
+            'content': 'Hello!',
+            'created_at': '2024-01-01T12:00:00+00:00',
+        },
+    }
+
+    def decode(self, protocol, frame):
+        """What decode_client_frame() makes of ``frame``, plus anything it sent back"""
+        consumer = ChatConsumer()
+        consumer.protocol = protocol
+        consumer.frame_bucket = TokenBucket(rate=100, burst=100)
+        sent = []
+
+        async def send_event(data):
+            sent.append(data)
+
+        consumer.send_event = send_event
+        kwargs = send_kwargs(protocol, frame)
+        data = async_to_sync(consumer.decode_client_frame)(kwargs.get('text_data'), kwargs.get('bytes_data'))
+        return data, sent
+
+    def test_error_event(self):
+        event = {'type': 'error', 'message': 'Invalid frame'}
+        for protocol in (JSON, MSGPACK):
+            with self.subTest(protocol=protocol):
+                data, sent = self.decode(protocol, encode_frame(protocol, event))
+                self.assertEqual(data, event)
+                self.assertEqual(sent, [])
+
+    def test_message_event(self):
+        data, _ = self.decode(JSON, encode_frame(JSON, self.MESSAGE_EVENT))
+        self.assertEqual(data, self.MESSAGE_EVENT)
+
+        data, sent = self.decode(MSGPACK, encode_frame(MSGPACK, self.MESSAGE_EVENT))
+        self.assertEqual(sent, [])
+        # MessagePack carries the timestamp as epoch milliseconds
+        expected = dict(self.MESSAGE_EVENT['message'], created_at=1704110400000)
+        self.assertEqual(data, dict(self.MESSAGE_EVENT, message=expected))
+
+    def test_list_values(self):
+        event = {'type': 'messages', 'messages': [{'id': 1, 'content': 'a'}, {'id': 2, 'content': 'b'}]}
+        data, _ = self.decode(MSGPACK, encode_frame(MSGPACK, event))
+        self.assertEqual(data, event)
+
+    def test_invalid_frame(self):
+        for protocol, frame in ((JSON, '{"type":'), (MSGPACK, b'\xc1')):
+            with self.subTest(protocol=protocol):
+                data, sent = self.decode(protocol, frame)
+                self.assertIsNone(data)
+                self.assertEqual(sent, [{'type': 'error', 'message': 'Invalid frame'}])
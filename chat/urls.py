@@ -7,4 +7,7 @@ urlpatterns = [
     path('conversations/<int:conversation_id>/', views.get_conversation, name='get_conversation'),
     path('conversations/<int:conversation_id>/messages/', views.get_messages, name='get_messages'),
     path('conversations/<int:conversation_id>/send/', views.send_message, name='send_message'),
+    path('sync/', views.sync, name='sync'),
+    path('search/', views.search, name='search'),
+    path('metrics/', views.metrics, name='metrics'),
 ]
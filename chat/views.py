@@ -1,13 +1,27 @@
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes, authentication_classes
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.authentication import TokenAuthentication
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
+from django.db import transaction
 from django.db.models import Q
+from django.conf import settings
+from chatapp import metrics as chat_metrics
+from chatapp.imaging import schedule_variants
+from chatapp.pagination import InvalidCursor, decode_cursor, encode_cursor, get_page_size
 from users.authentication import CsrfExemptSessionAuthentication
-from .models import Conversation, Message
-from .serializers import ConversationSerializer, MessageSerializer, MessageCreateSerializer
+from .archive import paginate_history
+from .models import Conversation, ConversationMember, Message
+from .search import search_messages
+from .serializers import (
+    ConversationSerializer, MessageSerializer, MessageCreateSerializer, MessageSearchResultSerializer
+)
+from .services import (
+    announce_conversation, broadcast_message, conversations_for,
+    get_or_create_direct_conversation, mark_read, read_state, record_message
+)
+from .sync import InvalidSyncCursor, build_sync, decode_sync_cursor
 from users.models import User
 
 
@@ -16,7 +30,7 @@ from users.models import User
 @permission_classes([IsAuthenticated])
 def list_conversations(request):
     """Get all conversations for current user"""
-    conversations = Conversation.objects.filter(participants=request.user)
+    conversations = conversations_for(request.user)
     serializer = ConversationSerializer(conversations, many=True, context={'request': request})
     return Response({
         'success': True,
@@ -45,53 +59,78 @@ def start_conversation(request):
             'message': 'Cannot start conversation with yourself'
         }, status=status.HTTP_400_BAD_REQUEST)
     
-    # Check if conversation already exists
-    existing = Conversation.objects.filter(
-        participants=request.user
-    ).filter(
-        participants=other_user
-    ).first()
+    conversation, created = get_or_create_direct_conversation(request.user, other_user)
+    data = ConversationSerializer(conversation, context={'request': request}).data
     
-    if existing:
-        return Response({
-            'success': True,
-            'conversation': ConversationSerializer(existing, context={'request': request}).data,
-            'existing': True
-        })
-    
-    # Create new conversation
-    conversation = Conversation.objects.create()
-    conversation.participants.add(request.user, other_user)
+    if created:
+        announce_conversation(conversation.id, [request.user.id, other_user.id], data)
     
     return Response({
         'success': True,
-        'conversation': ConversationSerializer(conversation, context={'request': request}).data,
-        'existing': False
-    }, status=status.HTTP_201_CREATED)
+        'conversation': data,
+        'existing': not created
+    }, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
 
 
 @api_view(['GET'])
 @authentication_classes([TokenAuthentication, CsrfExemptSessionAuthentication])
 @permission_classes([IsAuthenticated])
 def get_messages(request, conversation_id):
-    """Get messages for a conversation"""
+    """
+    Get a page of messages for a conversation, newest first.
+    
+    Query params: ``before``/``after`` cursors from a previous page and
+    ``limit`` (capped by CHAT_MESSAGES_MAX_PAGE_SIZE).
+    """
     conversation = get_object_or_404(Conversation, id=conversation_id)
     
-    if request.user not in conversation.participants.all():
+    if not ConversationMember.objects.filter(conversation=conversation, user=request.user).exists():
         return Response({
             'success': False,
             'message': 'You are not a participant in this conversation'
         }, status=status.HTTP_403_FORBIDDEN)
     
-    # Mark messages as read
-    conversation.messages.exclude(sender=request.user).update(is_read=True)
+    before = request.GET.get('before')
+    after = request.GET.get('after')
+    
+    if before and after:
+        return Response({
+            'success': False,
+            'message': 'Use either before or after, not both'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
+        before_key = decode_cursor(before) if before else None
+        after_key = decode_cursor(after) if after else None
+    except InvalidCursor:
+        return Response({
+            'success': False,
+            'message': 'Invalid cursor'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    page_size = get_page_size(request, settings.CHAT_MESSAGES_PAGE_SIZE, settings.CHAT_MESSAGES_MAX_PAGE_SIZE)
     
-    messages = conversation.messages.all().order_by('created_at')
-    serializer = MessageSerializer(messages, many=True)
+    # Opening the latest page marks the conversation as read
+    if before_key is None:
+        mark_read(conversation.id, request.user.id)
+    
+    messages, has_more = paginate_history(conversation, page_size, before=before_key, after=after_key)
+    serializer = MessageSerializer(
+        messages, many=True, context={'read_state': read_state(conversation.id, request.user.id)}
+    )
+    
+    # next_cursor pages towards older messages, prev_cursor towards newer ones
+    next_cursor = None
+    if messages and (has_more or after_key):
+        next_cursor = encode_cursor(messages[-1].created_at, messages[-1].id)
+    prev_cursor = encode_cursor(messages[0].created_at, messages[0].id) if messages else after
     
     return Response({
         'success': True,
-        'messages': serializer.data
+        'messages': serializer.data,
+        'has_more': has_more,
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor,
     })
 
 
@@ -111,10 +150,11 @@ def send_message(request, conversation_id):
     serializer = MessageCreateSerializer(data=request.data)
     
     if serializer.is_valid():
-        message = serializer.save(conversation=conversation, sender=request.user)
-        
-        # Update conversation timestamp
-        conversation.save()
+        with transaction.atomic():
+            message = serializer.save(conversation=conversation, sender=request.user)
+            record_message(message)
+            broadcast_message(message)
+            schedule_variants(message, 'image')
         
         return Response({
             'success': True,
@@ -144,3 +184,84 @@ def get_conversation(request, conversation_id):
         'success': True,
         'conversation': ConversationSerializer(conversation, context={'request': request}).data
     })
+
+
+@api_view(['POST'])
+@authentication_classes([TokenAuthentication, CsrfExemptSessionAuthentication])
+@permission_classes([IsAuthenticated])
+def sync(request):
+    """
+    Return what changed across all of the user's conversations.
+    
+    Body: ``{"conversations": {"<id>": <last seen seq>, ...}}`` or
+    ``{"cursor": "<cursor from the previous sync>"}``. Conversations left out
+    of the map are treated as never seen.
+    """
+    positions = request.data.get('conversations')
+    cursor = request.data.get('cursor')
+    
+    try:
+        if cursor:
+            positions = decode_sync_cursor(cursor)
+        else:
+            positions = {int(key): int(value) for key, value in (positions or {}).items()}
+    except (InvalidSyncCursor, AttributeError, TypeError, ValueError):
+        return Response({
+            'success': False,
+            'message': 'Invalid sync position'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    return Response({
+        'success': True,
+        **build_sync(request, positions)
+    })
+
+
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication, CsrfExemptSessionAuthentication])
+@permission_classes([IsAuthenticated])
+def search(request):
+    """
+    Search messages in the user's conversations, best matches first.
+    
+    Query params: ``q``, optional ``conversation`` id, ``limit`` and ``offset``.
+    """
+    query = request.GET.get('q', '')
+    
+    if len(query) < 2:
+        return Response({
+            'success': True,
+            'results': [],
+            'has_more': False
+        })
+    
+    try:
+        conversation_id = request.GET.get('conversation')
+        conversation_id = int(conversation_id) if conversation_id else None
+        offset = max(int(request.GET.get('offset', 0)), 0)
+    except ValueError:
+        return Response({
+            'success': False,
+            'message': 'Invalid conversation or offset'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    limit = get_page_size(request, settings.CHAT_SEARCH_PAGE_SIZE, settings.CHAT_SEARCH_MAX_PAGE_SIZE)
+    messages, has_more = search_messages(request.user, query, conversation_id, limit, offset)
+    
+    return Response({
+        'success': True,
+        'results': MessageSearchResultSerializer(messages, many=True).data,
+        'has_more': has_more,
+        'next_offset': offset + len(messages) if has_more else None
+    })
+
+
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication, CsrfExemptSessionAuthentication])
+@permission_classes([IsAdminUser])
+def metrics(request):
+    """Counters for rate limits, dropped frames and other load shedding in this process"""
+    return Response({
+        'success': True,
+        'counters': chat_metrics.snapshot()
+    })
@@ -0,0 +1,159 @@
+"""
+Write-behind persistence for WebSocket messages.
+
+With CHAT_WRITE_BEHIND enabled, ChatConsumer gives each incoming message its
+id up front (chat.ids), broadcasts it straight away and hands it to the
+process-wide MessageWriteBehind, which inserts messages with bulk_create once
+CHAT_WRITE_BEHIND_BATCH_SIZE of them are waiting or
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL seconds have passed, whichever comes first.
+
+Anything still buffered is flushed synchronously at interpreter exit, so a
+graceful shutdown loses nothing. A hard kill can lose up to one flush interval
+of messages; keep the setting off where that is not acceptable.
+
+When a batch fails its messages are written one by one. A message the
+database rejects outright is dropped; one that hits a transient error goes
+back to the front of the queue, at most MAX_ATTEMPTS times. Dropped messages
+are counted as ``chat.writebehind.dropped`` (see chatapp/metrics.py).
+"""
+
+import asyncio
+import atexit
+import logging
+import threading
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DataError, DatabaseError, IntegrityError
+
+from chatapp import metrics
+from .services import persist_messages
+
+
+logger = logging.getLogger(__name__)
+
+# Writes of one message before it is given up on
+MAX_ATTEMPTS = 5
+
+
+class MessageWriteBehind:
+    """Buffers unsaved messages and persists them in micro-batches"""
+
+    def __init__(self, batch_size, flush_interval):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._attempts = {}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._task = None
+        self._has_pending = None
+        self._batch_full = None
+
+    def submit(self, message):
+        """Queue a message with its id already assigned; call from the event loop"""
+        self._ensure_flusher()
+        with self._lock:
+            self._pending.append(message)
+            size = len(self._pending)
+        self._has_pending.set()
+        if size >= self.batch_size:
+            self._batch_full.set()
+
+    def pending_for(self, conversation_id):
+        """Messages of a conversation that are accepted but not yet written"""
+        with self._lock:
+            return [m for m in self._pending if m.conversation_id == conversation_id]
+
+    def flush(self, limit=None):
+        """Write up to ``limit`` buffered messages (all of them by default)"""
+        with self._lock:
+            if limit is None:
+                limit = len(self._pending)
+            batch = self._pending[:limit]
+            del self._pending[:limit]
+        if not batch:
+            return
+
+        try:
+            persist_messages(batch)
+            return
+        except Exception:
+            logger.exception("Batch insert of %d messages failed, retrying one by one", len(batch))
+
+        retry = []
+        for message in batch:
+            try:
+                persist_messages([message])
+            except (IntegrityError, DataError):
+                # Rejected by the database; writing it again cannot help
+                self._drop(message)
+            except DatabaseError:
+                attempts = self._attempts.get(message.id, 0) + 1
+                if attempts >= MAX_ATTEMPTS:
+                    self._drop(message)
+                    continue
+                logger.exception("Could not write message %s, will retry", message.id)
+                self._attempts[message.id] = attempts
+                retry.append(message)
+            except Exception:
+                self._drop(message)
+            else:
+                self._attempts.pop(message.id, None)
+        if retry:
+            with self._lock:
+                self._pending[:0] = retry
+
+    def _drop(self, message):
+        logger.exception("Dropping message %s", message.id)
+        metrics.increment('chat.writebehind.dropped')
+        self._attempts.pop(message.id, None)
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._task is not None and not self._task.done():
+            return
+        self._loop = loop
+        self._has_pending = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await self._has_pending.wait()
+            # Give the batch a moment to fill up unless it is already full
+            if not self._batch_full.is_set():
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._has_pending.clear()
+            self._batch_full.clear()
+
+            try:
+                await database_sync_to_async(self.flush)(self.batch_size)
+            except Exception:
+                # Keep the flusher alive whatever happens to one batch
+                logger.exception("Write-behind flush failed")
+
+            with self._lock:
+                remaining = len(self._pending)
+            if remaining:
+                self._has_pending.set()
+                if remaining >= self.batch_size:
+                    self._batch_full.set()
+
+
+_writer = None
+
+
+def get_writer():
+    """Return the process-wide write-behind buffer"""
+    global _writer
+    if _writer is None:
+        _writer = MessageWriteBehind(
+            settings.CHAT_WRITE_BEHIND_BATCH_SIZE,
+            settings.CHAT_WRITE_BEHIND_FLUSH_INTERVAL,
+        )
+        atexit.register(_writer.flush)
+    return _writer
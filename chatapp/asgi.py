@@ -12,10 +12,11 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatapp.settings')
 django_asgi_app = get_asgi_application()
 
 from chat.routing import websocket_urlpatterns
+from users.authentication import TokenAuthMiddleware
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
     "websocket": AuthMiddlewareStack(
-        URLRouter(websocket_urlpatterns)
+        TokenAuthMiddleware(URLRouter(websocket_urlpatterns))
     ),
 })
@@ -0,0 +1,264 @@
+"""
+Resized variants of uploaded images.
+
+After a post, message or avatar image is saved, schedule_variants() queues it
+for a small thread pool once the transaction commits. The pool decodes the
+original once and writes every size in IMAGE_VARIANT_SIZES, bounded by the
+longest edge, in the original's format family (JPEG, or PNG when the image
+has transparency) and as WebP. The results are recorded in the model's
+``<field>_variants`` JSON column:
+
+    {"source": "posts/images/cat_x7Yz1Qa.jpg", "stripped": true,
+     "sizes": {"thumb": {"width": 160, "height": 120,
+                         "url": "posts/images/variants/cat_x7Yz1Qa_thumb_Rk2mP0c.jpg",
+                         "webp": "posts/images/variants/cat_x7Yz1Qa_thumb_T8vLs4d.webp"}, ...}}
+
+Everything is re-encoded from pixels only, so EXIF (camera, GPS), XMP and
+comments never reach the stored files; the orientation tag is applied first.
+That includes the original: the pool saves a stripped copy (at
+IMAGE_ORIGINAL_QUALITY for lossy formats, in the same format where Pillow can
+write it, JPEG or PNG otherwise), points the field at it and deletes the
+uploaded file. Until then the original URL serves the upload as sent, and
+afterwards it changes, so clients should take ``image`` and the variants from
+the same response. ``stripped`` marks originals that were already cleaned so
+rebuilding the variants does not re-encode them again. Images whose header
+claims more than IMAGE_MAX_PIXELS are skipped before they are decoded.
+
+``source`` ties the variants to one version of the image. If the field has
+moved on to a newer file, ImageVariantsField reports no variants until the
+newer ones are built, and the stale files are deleted. The ``variants_built``
+signal is sent (sender=model, pk=pk) once new variants are recorded.
+"""
+
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from django.dispatch import Signal
+from PIL import Image, ImageOps, UnidentifiedImageError
+from rest_framework import serializers
+
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+variants_built = Signal()
+
+
+def variant_sizes():
+    """IMAGE_VARIANT_SIZES as [(name, longest edge)], smallest first"""
+    sizes = []
+    for item in settings.IMAGE_VARIANT_SIZES.split(','):
+        name, _, edge = item.strip().partition(':')
+        sizes.append((name, int(edge)))
+    return sorted(sizes, key=lambda size: size[1])
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    # A pool inherited through fork has no threads, so start a new one
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.IMAGE_VARIANT_WORKERS, thread_name_prefix='image-variants'
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def schedule_variants(instance, field_name):
+    """Build variants of ``instance.<field_name>`` in the background after commit"""
+    name = getattr(instance, field_name).name
+    if not name:
+        return
+    model, pk = type(instance), instance.pk
+    transaction.on_commit(
+        lambda: _get_executor().submit(build_variants, model, pk, field_name, name)
+    )
+
+
+def _encode(image, format, **options):
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **options)
+    return buffer.getvalue()
+
+
+def _render(original, name, edge, stem, directory, storage):
+    image = original.copy()
+    image.thumbnail((edge, edge), Image.LANCZOS)
+    quality = settings.IMAGE_VARIANT_QUALITY
+    if image.mode in ('RGBA', 'LA'):
+        fallback, extension = _encode(image, 'PNG', optimize=True), 'png'
+    else:
+        image = image.convert('RGB')
+        fallback, extension = _encode(image, 'JPEG', quality=quality, optimize=True, progressive=True), 'jpg'
+    webp = _encode(image, 'WEBP', quality=quality, method=4)
+    base = f'{directory}/variants/{stem}_{name}'
+    return {
+        'width': image.width,
+        'height': image.height,
+        'url': storage.save(f'{base}.{extension}', ContentFile(fallback)),
+        'webp': storage.save(f'{base}.webp', ContentFile(webp)),
+    }
+
+
+def _strip(source, image, name, storage):
+    """
+    Save ``image``, the decoded ``source``, again without its metadata next
+    to ``name``; returns the new name.
+    """
+    stem, extension = os.path.splitext(name)
+    icc_profile = source.info.get('icc_profile')
+    quality = settings.IMAGE_ORIGINAL_QUALITY
+    if source.format == 'GIF' or (getattr(source, 'n_frames', 1) > 1 and source.format in ('PNG', 'WEBP')):
+        # Keep every frame; these carry no orientation to apply
+        options = {'comment': b''} if source.format == 'GIF' else {'quality': quality}
+        data = _encode(source, source.format, save_all=True, icc_profile=icc_profile, **options)
+    elif source.format == 'JPEG' and image.mode in ('RGB', 'L'):
+        data = _encode(image, 'JPEG', quality=quality, optimize=True, icc_profile=icc_profile, comment=b'')
+    elif source.format == 'WEBP':
+        data = _encode(image, 'WEBP', quality=quality, method=4, icc_profile=icc_profile)
+    elif source.format == 'PNG' or image.mode in ('RGBA', 'LA'):
+        data, extension = _encode(image, 'PNG', icc_profile=icc_profile), '.png'
+    else:
+        data, extension = _encode(image.convert('RGB'), 'JPEG', quality=quality, optimize=True), '.jpg'
+    # The name is taken, so storage picks a fresh one
+    return storage.save(f'{stem}{extension}', ContentFile(data))
+
+
+def render_variants(storage, name, strip=True):
+    """
+    Write the variants of the stored image ``name`` and, if ``strip``, a copy
+    of it without metadata. Returns ``(sizes, stripped name or None)``.
+    """
+    stripped = None
+    with storage.open(name, 'rb') as f:
+        source = Image.open(f)
+        # Only the header has been read so far
+        width, height = source.size
+        if width * height > settings.IMAGE_MAX_PIXELS:
+            raise ValueError(f'{name} is {width}x{height}, over IMAGE_MAX_PIXELS')
+        if not strip:
+            # Let JPEG decode at a reduced scale that still covers the largest size
+            largest = variant_sizes()[-1][1]
+            source.draft('RGB', (largest, largest))
+        original = ImageOps.exif_transpose(source)
+        if original.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            original = original.convert('RGBA' if 'transparency' in original.info else 'RGB')
+        if strip:
+            stripped = _strip(source, original, name, storage)
+
+    try:
+        sizes = _render_sizes(original, name, storage)
+    except BaseException:
+        if stripped:
+            storage.delete(stripped)
+        raise
+    return sizes, stripped
+
+
+def _render_sizes(original, name, storage):
+    directory, filename = os.path.split(name)
+    stem = os.path.splitext(filename)[0]
+    sizes = {}
+    previous = None
+    for size_name, edge in variant_sizes():
+        if previous and max(previous['width'], previous['height']) >= max(original.size):
+            # The original is smaller than this size; a bigger copy would be the same image
+            sizes[size_name] = previous
+            continue
+        previous = sizes[size_name] = _render(original, size_name, edge, stem, directory, storage)
+    return sizes
+
+
+def _variant_files(variants):
+    for size in variants.get('sizes', {}).values():
+        yield size['url']
+        yield size['webp']
+
+
+def build_variants(model, pk, field_name, name):
+    """Build and record the variants of one image; runs on the worker pool"""
+    close_old_connections()
+    try:
+        storage = model._meta.get_field(field_name).storage
+        variants_field = f'{field_name}_variants'
+        previous = model.objects.filter(pk=pk).values_list(variants_field, flat=True).first() or {}
+        strip = not (previous.get('source') == name and previous.get('stripped'))
+        try:
+            sizes, stripped = render_variants(storage, name, strip=strip)
+        except (OSError, ValueError, UnidentifiedImageError, Image.DecompressionBombError):
+            logger.warning("Could not build variants of %s", name, exc_info=True)
+            return
+
+        current = set(_variant_files({'sizes': sizes}))
+        if stripped:
+            current.add(stripped)
+        values = {variants_field: {'source': stripped or name, 'stripped': True, 'sizes': sizes}}
+        if stripped:
+            values[field_name] = stripped
+        try:
+            updated = model.objects.filter(pk=pk, **{field_name: name}).update(**values)
+        except Exception:
+            for path in current:
+                storage.delete(path)
+            raise
+        # Names can come round again once the old files are deleted
+        stale = set(_variant_files(previous)) - current
+        if stripped:
+            stale.add(name)
+        if not updated:
+            # The row is gone or has a newer image; these files are unused
+            stale = current
+        for path in stale:
+            storage.delete(path)
+        if updated:
+            variants_built.send(sender=model, pk=pk)
+    except Exception:
+        logger.exception("Building variants of %s failed", name)
+    finally:
+        close_old_connections()
+
+
+class ImageVariantsField(serializers.Field):
+    """
+    Read-only ``{size: {width, height, url, webp}}`` for an image field, with
+    absolute URLs when the serializer has a request. Empty until the
+    variants of the current image have been built.
+    """
+
+    def __init__(self, image_field, **kwargs):
+        self.image_field = image_field
+        kwargs['source'] = '*'
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, instance):
+        image = getattr(instance, self.image_field)
+        variants = getattr(instance, f'{self.image_field}_variants') or {}
+        if not image or variants.get('source') != image.name:
+            return {}
+        storage = image.storage
+        request = self.context.get('request')
+
+        def url(path):
+            url = storage.url(path)
+            return request.build_absolute_uri(url) if request is not None else url
+
+        return {
+            size_name: {
+                'width': size['width'],
+                'height': size['height'],
+                'url': url(size['url']),
+                'webp': url(size['webp']),
+            }
+            for size_name, size in variants.get('sizes', {}).items()
+        }
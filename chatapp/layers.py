@@ -0,0 +1,436 @@
+"""
+Channel layer shared by every worker process on one host.
+
+InMemoryChannelLayer only delivers within a single process, so consumers
+connected to different ASGI workers never hear each other. SharedChannelLayer
+keeps group membership and cross-process messages in a transport that all
+workers share (by default a small SQLite file, so no extra service is needed),
+while messages between consumers of the same process go straight through
+in-memory queues.
+
+Specific channels handed out by new_channel() carry a per-process token
+(``specific.<token>!<random>``). One poller task per process collects that
+process's messages from the transport and routes them to local queues, so the
+amount of polling does not grow with the number of connections.
+
+To move to a networked broker later, implement BaseTransport against it and
+point CONFIG['transport'] at the class.
+"""
+
+import asyncio
+import base64
+import json
+import random
+import sqlite3
+import string
+import time
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.utils.module_loading import import_string
+
+from . import metrics
+
+
+def encode_message(message):
+    """Serialize a channel message; bytes values survive the round trip"""
+    return json.dumps(message, default=_encode_bytes, separators=(',', ':'))
+
+
+def decode_message(data):
+    return json.loads(data, object_hook=_decode_bytes)
+
+
+def _encode_bytes(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    raise TypeError(f"{type(value).__name__} is not serializable in a channel message")
+
+
+def _decode_bytes(obj):
+    if len(obj) == 1 and '__bytes__' in obj:
+        return base64.b64decode(obj['__bytes__'])
+    return obj
+
+
+class BaseTransport:
+    """
+    Storage shared by all processes using the layer.
+
+    Methods are blocking; the layer calls them from one dedicated thread.
+    ``process`` is the owning process token for specific channels and None
+    for general channels.
+    """
+
+    def send(self, channel, process, data, expires, capacity):
+        """Store one message, returning False if the channel is at capacity"""
+        raise NotImplementedError
+
+    def send_many(self, rows):
+        """Store (channel, process, data, expires, capacity) rows, skipping full channels"""
+        raise NotImplementedError
+
+    def receive_process(self, process, limit):
+        """Remove and return up to ``limit`` (channel, data, expires) rows for a process"""
+        raise NotImplementedError
+
+    def receive_channel(self, channel):
+        """Remove and return the oldest (data, expires) row of a general channel, or None"""
+        raise NotImplementedError
+
+    def group_add(self, group, channel, expires):
+        raise NotImplementedError
+
+    def group_discard(self, group, channel):
+        raise NotImplementedError
+
+    def discard_channel(self, channel):
+        """Remove a channel from every group"""
+        raise NotImplementedError
+
+    def group_channels(self, group, now):
+        raise NotImplementedError
+
+    def cleanup(self, now):
+        """Drop expired messages and group memberships"""
+        raise NotImplementedError
+
+    def flush(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteTransport(BaseTransport):
+    """Transport over a SQLite file in WAL mode, shared by processes on one host"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS channel_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,
+            process TEXT,
+            data TEXT NOT NULL,
+            expires REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS channel_messages_process ON channel_messages (process, id);
+        CREATE INDEX IF NOT EXISTS channel_messages_channel ON channel_messages (channel, id);
+        CREATE TABLE IF NOT EXISTS channel_groups (
+            name TEXT NOT NULL,
+            channel TEXT NOT NULL,
+            expires REAL NOT NULL,
+            PRIMARY KEY (name, channel)
+        );
+    """
+
+    INSERT = """
+        INSERT INTO channel_messages (channel, process, data, expires)
+        SELECT ?, ?, ?, ?
+        WHERE (SELECT COUNT(*) FROM channel_messages WHERE channel = ?) < ?
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._connection = None
+
+    @property
+    def db(self):
+        # Opened lazily so the connection belongs to the layer's thread
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # Messages are ephemeral; there is nothing worth an fsync
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.executescript(self.SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    def send(self, channel, process, data, expires, capacity):
+        cursor = self.db.execute(self.INSERT, (channel, process, data, expires, channel, capacity))
+        return cursor.rowcount == 1
+
+    def send_many(self, rows):
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for channel, process, data, expires, capacity in rows:
+                db.execute(self.INSERT, (channel, process, data, expires, channel, capacity))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def receive_process(self, process, limit):
+        db = self.db
+        rows = db.execute(
+            'SELECT id, channel, data, expires FROM channel_messages WHERE process = ? ORDER BY id LIMIT ?',
+            (process, limit)
+        ).fetchall()
+        if rows:
+            # Only this process reads its own rows, so no transaction is needed
+            db.execute('DELETE FROM channel_messages WHERE process = ? AND id <= ?', (process, rows[-1][0]))
+        return [row[1:] for row in rows]
+
+    def receive_channel(self, channel):
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(
+                'SELECT id, data, expires FROM channel_messages '
+                'WHERE channel = ? AND process IS NULL ORDER BY id LIMIT 1',
+                (channel,)
+            ).fetchone()
+            if row is not None:
+                db.execute('DELETE FROM channel_messages WHERE id = ?', (row[0],))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return row[1:] if row is not None else None
+
+    def group_add(self, group, channel, expires):
+        self.db.execute(
+            'INSERT OR REPLACE INTO channel_groups (name, channel, expires) VALUES (?, ?, ?)',
+            (group, channel, expires)
+        )
+
+    def group_discard(self, group, channel):
+        self.db.execute('DELETE FROM channel_groups WHERE name = ? AND channel = ?', (group, channel))
+
+    def discard_channel(self, channel):
+        self.db.execute('DELETE FROM channel_groups WHERE channel = ?', (channel,))
+
+    def group_channels(self, group, now):
+        rows = self.db.execute(
+            'SELECT channel FROM channel_groups WHERE name = ? AND expires > ?', (group, now)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def cleanup(self, now):
+        self.db.execute('DELETE FROM channel_messages WHERE expires < ?', (now,))
+        self.db.execute('DELETE FROM channel_groups WHERE expires < ?', (now,))
+
+    def flush(self):
+        self.db.execute('DELETE FROM channel_messages')
+        self.db.execute('DELETE FROM channel_groups')
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class SharedChannelLayer(BaseChannelLayer):
+    """Multi-process channel layer backed by a pluggable transport"""
+
+    extensions = ['groups', 'flush']
+
+    # Cross-process delivery latency is between these two values
+    MIN_POLL_INTERVAL = 0.005
+    CLEANUP_INTERVAL = 10
+    RECEIVE_BATCH = 500
+
+    def __init__(
+        self,
+        transport='chatapp.layers.SQLiteTransport',
+        transport_options=None,
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        poll_interval=0.05,
+        **kwargs,
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.group_expiry = group_expiry
+        self.poll_interval = poll_interval
+
+        if isinstance(transport, str):
+            transport = import_string(transport)(**(transport_options or {}))
+        self.transport = transport
+
+        self.process_token = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='channel-layer')
+        self._loop = None
+        self._queues = {}
+        self._poller = None
+        self._last_cleanup = 0
+        # Local channels that had messages dropped because their queue was full
+        self._overflowed = set()
+
+    # Helpers
+
+    async def _call(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, method, *args)
+
+    def _process_of(self, channel):
+        """Process token of a specific channel, or None for a general channel"""
+        if '!' not in channel:
+            return None
+        return channel.split('!', 1)[0].rsplit('.', 1)[-1]
+
+    def _is_local(self, channel):
+        return self._process_of(channel) == self.process_token
+
+    def _bind_loop(self):
+        # Queues and the poller belong to one event loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queues = {}
+            self._poller = None
+
+    def _queue(self, channel):
+        queue = self._queues.get(channel)
+        if queue is None:
+            queue = self._queues[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return queue
+
+    def _put_local(self, channel, message, expires):
+        try:
+            self._queue(channel).put_nowait((expires, message))
+        except asyncio.QueueFull:
+            self._overflowed.add(channel)
+            raise ChannelFull(channel)
+
+    def _ensure_poller(self):
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.get_running_loop().create_task(self._poll())
+
+    async def _poll(self):
+        interval = self.MIN_POLL_INTERVAL
+        while True:
+            rows = await self._call(self.transport.receive_process, self.process_token, self.RECEIVE_BATCH)
+            now = time.time()
+            for channel, data, expires in rows:
+                if expires < now:
+                    continue
+                try:
+                    self._queue(channel).put_nowait((expires, decode_message(data)))
+                except asyncio.QueueFull:
+                    self._overflowed.add(channel)
+
+            if now - self._last_cleanup > self.CLEANUP_INTERVAL:
+                self._last_cleanup = now
+                await self._cleanup(now)
+
+            # Poll quickly while busy, back off towards poll_interval when idle
+            interval = self.MIN_POLL_INTERVAL if rows else min(interval * 2, self.poll_interval)
+            await asyncio.sleep(interval)
+
+    async def _cleanup(self, now):
+        await self._call(self.transport.cleanup, now)
+        # A channel whose oldest message expired unread has no consumer left
+        for channel, queue in list(self._queues.items()):
+            if not queue.empty() and queue._queue[0][0] < now:
+                del self._queues[channel]
+                await self._call(self.transport.discard_channel, channel)
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        assert '__asgi_channel__' not in message
+        self._bind_loop()
+
+        expires = time.time() + self.expiry
+        if self._is_local(channel):
+            self._put_local(channel, deepcopy(message), expires)
+            return
+
+        delivered = await self._call(
+            self.transport.send, channel, self._process_of(channel),
+            encode_message(message), expires, self.get_capacity(channel)
+        )
+        if not delivered:
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        self._bind_loop()
+
+        if '!' not in channel:
+            # General channels are rare here; poll the transport directly
+            while True:
+                row = await self._call(self.transport.receive_channel, channel)
+                if row is not None and row[1] >= time.time():
+                    return decode_message(row[0])
+                if row is None:
+                    await asyncio.sleep(self.poll_interval)
+
+        self._ensure_poller()
+        queue = self._queue(channel)
+        try:
+            while True:
+                expires, message = await queue.get()
+                if expires >= time.time():
+                    return message
+        finally:
+            if queue.empty() and self._queues.get(channel) is queue:
+                del self._queues[channel]
+
+    def pop_overflow(self, channel):
+        """Whether messages for a local ``channel`` were dropped since the last call"""
+        if channel in self._overflowed:
+            self._overflowed.discard(channel)
+            return True
+        return False
+
+    async def new_channel(self, prefix='specific'):
+        suffix = ''.join(random.choices(string.ascii_letters, k=12))
+        return f"{prefix}.{self.process_token}!{suffix}"
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._call(self.transport.group_add, group, channel, time.time() + self.group_expiry)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        await self._call(self.transport.group_discard, group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        self._bind_loop()
+
+        now = time.time()
+        expires = now + self.expiry
+        channels = await self._call(self.transport.group_channels, group, now)
+
+        remote = []
+        data = None
+        for channel in channels:
+            if self._is_local(channel):
+                try:
+                    self._put_local(channel, deepcopy(message), expires)
+                except ChannelFull:
+                    metrics.increment('channel_layer.group_send_dropped')
+            else:
+                # Serialize once for every remote member
+                if data is None:
+                    data = encode_message(message)
+                remote.append((channel, self._process_of(channel), data, expires, self.get_capacity(channel)))
+
+        if remote:
+            await self._call(self.transport.send_many, remote)
+
+    # Flush extension
+
+    async def flush(self):
+        self._queues = {}
+        await self._call(self.transport.flush)
+
+    async def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+            self._poller = None
+        await self._call(self.transport.close)
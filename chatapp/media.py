@@ -0,0 +1,195 @@
+"""
+Serving of uploaded media.
+
+serve_media() answers GET and HEAD for files under MEDIA_ROOT in every
+environment, not only with DEBUG on:
+
+- Single byte ranges (``Range: bytes=...``) get 206 Partial Content, so
+  video players can seek without downloading the whole file. ``If-Range`` is
+  honoured. Requests for several ranges get the whole file, which HTTP allows.
+- ETag and Last-Modified come from the file's size and mtime, and
+  If-None-Match / If-Modified-Since are answered with 304.
+- Uploaded names are never reused: ContentAddressedStorage gives every file
+  a random suffix, also when the plain name is free again after a delete.
+  So responses are cacheable for MEDIA_CACHE_MAX_AGE seconds and marked
+  immutable, and the mtime-based ETag is only ever compared against the
+  same content.
+
+With MEDIA_SENDFILE set to ``x-accel-redirect`` (nginx) or ``x-sendfile``
+(Apache, lighttpd) the view only checks the request and hands the file to the
+front server. Otherwise the body is a FileResponse; under a WSGI server with
+``wsgi.file_wrapper`` (gunicorn) that is sent with sendfile() straight from
+the page cache, ranges included, since the file is positioned at the start of
+the range and Content-Length bounds it.
+
+Files that can render as a page (HTML, SVG, ...) are sent as attachments.
+Partial uploads and the content-addressed blobs (uploads/storage.py) are not
+served; blobs are only reachable through the file names that link to them.
+"""
+
+import io
+import mimetypes
+import os
+import re
+from pathlib import Path
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotAllowed
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe, quote_etag
+
+from uploads.storage import BLOB_DIR
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+# Served inline; anything else is downloaded rather than rendered by the browser
+INLINE_TYPES = re.compile(r'^(image/(?!svg)|video/|audio/)|^application/pdf$')
+
+
+class RangeFile:
+    """``length`` bytes of ``file`` from ``start``, as a seekable file of its own"""
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.name = file.name
+        self.start = start
+        self.length = length
+        self.position = 0
+        file.seek(start)
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.length}[whence]
+        self.position = max(0, min(base + offset, self.length))
+        # Keep the descriptor in step: sendfile() starts from its offset
+        self.file.seek(self.start + self.position)
+        return self.position
+
+    def read(self, size=-1):
+        remaining = self.length - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = self.file.read(size)
+        self.position += len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    """
+    The (start, length) of a single ``bytes=`` range, None to send the whole
+    file, or ValueError when the range cannot be satisfied.
+    """
+    match = RANGE_RE.match(header.replace(' ', ''))
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        # Suffix range: the last N bytes
+        length = min(int(last), size)
+        if length == 0:
+            raise ValueError(header)
+        return size - length, length
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, end - start + 1
+
+
+def _resolve(path):
+    try:
+        full_path = Path(safe_join(settings.MEDIA_ROOT, path))
+    except SuspiciousFileOperation:
+        raise Http404
+    resolved = full_path.resolve()
+    # Partial files of resumable uploads are not media yet, and blobs are
+    # only reachable through the names that link to them: knowing a hash
+    # must not be enough to download the content
+    hidden = (Path(settings.UPLOAD_TEMP_DIR).resolve(), (Path(settings.MEDIA_ROOT) / BLOB_DIR).resolve())
+    if any(resolved.is_relative_to(directory) for directory in hidden) or not full_path.is_file():
+        raise Http404
+    return full_path
+
+
+def _if_range_matches(request, etag, last_modified):
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def _base_headers(response, full_path, content_type, etag, last_modified):
+    response['Content-Type'] = content_type
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Accept-Ranges'] = 'bytes'
+    response['Cache-Control'] = f'public, max-age={settings.MEDIA_CACHE_MAX_AGE}, immutable'
+    if not INLINE_TYPES.match(content_type):
+        response['Content-Disposition'] = content_disposition_header(True, full_path.name)
+    return response
+
+
+def serve_media(request, path):
+    """Serve one file from MEDIA_ROOT"""
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+
+    full_path = _resolve(path)
+    stat = full_path.stat()
+    size = stat.st_size
+    last_modified = int(stat.st_mtime)
+    etag = quote_etag(f'{stat.st_mtime_ns:x}-{size:x}')
+    content_type = mimetypes.guess_type(full_path.name)[0] or 'application/octet-stream'
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        return _base_headers(not_modified, full_path, content_type, etag, last_modified)
+
+    if settings.MEDIA_SENDFILE == 'x-accel-redirect':
+        # nginx handles Range itself for redirected responses
+        response = HttpResponse()
+        relative = full_path.relative_to(os.path.abspath(settings.MEDIA_ROOT)).as_posix()
+        response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_PREFIX + quote(relative)
+        return _base_headers(response, full_path, content_type, etag, last_modified)
+    if settings.MEDIA_SENDFILE == 'x-sendfile':
+        response = HttpResponse()
+        response['X-Sendfile'] = str(full_path)
+        return _base_headers(response, full_path, content_type, etag, last_modified)
+
+    byte_range = None
+    range_header = request.headers.get('Range')
+    if range_header and _if_range_matches(request, etag, last_modified):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return _base_headers(response, full_path, content_type, etag, last_modified)
+
+    start, length = byte_range or (0, size)
+    if request.method == 'HEAD':
+        response = HttpResponse(status=206 if byte_range else 200)
+        response['Content-Length'] = length
+    else:
+        file = open(full_path, 'rb')
+        body = RangeFile(file, start, length) if byte_range else file
+        response = FileResponse(body, status=206 if byte_range else 200)
+    if byte_range:
+        response['Content-Range'] = f'bytes {start}-{start + length - 1}/{size}'
+    return _base_headers(response, full_path, content_type, etag, last_modified)
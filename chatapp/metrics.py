@@ -0,0 +1,30 @@
+"""
+Process-wide event counters.
+
+Code that enforces a limit or drops work calls increment() so operators can
+see how often it happens. Counters live in memory and are per process; they
+reset on restart. Staff can read them at /api/chat/metrics/.
+"""
+
+import threading
+from collections import Counter
+
+
+_lock = threading.Lock()
+_counters = Counter()
+
+
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+def snapshot():
+    """Current value of every counter"""
+    with _lock:
+        return dict(_counters)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
@@ -0,0 +1,71 @@
+"""
+Keyset (cursor) pagination helpers shared by the API views.
+
+Cursors are opaque, URL-safe tokens wrapping a ``(created_at, id)`` position,
+so every page is a bounded range scan over a ``(..., created_at, id)`` index
+instead of an OFFSET that gets slower the deeper a client scrolls.
+"""
+
+import base64
+import binascii
+from datetime import datetime
+
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    """Raised when a client sends a cursor that we did not issue"""
+
+
+def encode_cursor(created_at, pk):
+    """Build an opaque cursor for the row at (created_at, pk)"""
+    raw = f"{created_at.isoformat()}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into a (created_at, pk) tuple"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        created_at, pk = raw.split('|')
+        return datetime.fromisoformat(created_at), int(pk)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        raise InvalidCursor(cursor)
+
+
+def get_page_size(request, default, maximum):
+    """Read the ``limit`` query parameter, clamped to [1, maximum]"""
+    try:
+        size = int(request.GET.get('limit', default))
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, maximum))
+
+
+def paginate_keyset(queryset, page_size, before=None, after=None):
+    """
+    Fetch one page of ``queryset`` newest-first.
+
+    ``before``/``after`` are decoded cursors. Without a cursor the newest
+    page is returned. Returns ``(rows, has_more)`` where ``has_more`` tells
+    whether more rows exist in the direction of travel.
+    """
+    if after is not None:
+        created_at, pk = after
+        rows = list(
+            queryset.filter(
+                Q(created_at__gt=created_at) | Q(created_at=created_at, pk__gt=pk)
+            ).order_by('created_at', 'pk')[:page_size + 1]
+        )
+        has_more = len(rows) > page_size
+        return rows[:page_size][::-1], has_more
+
+    if before is not None:
+        created_at, pk = before
+        queryset = queryset.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk)
+        )
+    rows = list(queryset.order_by('-created_at', '-pk')[:page_size + 1])
+    has_more = len(rows) > page_size
+    return rows[:page_size], has_more
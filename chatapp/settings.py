@@ -30,6 +30,7 @@ INSTALLED_APPS = [
     'users',
     'posts',
     'chat',
+    'uploads',
 ]
 
 MIDDLEWARE = [
@@ -66,13 +67,128 @@ TEMPLATES = [
 WSGI_APPLICATION = 'chatapp.wsgi.application'
 ASGI_APPLICATION = 'chatapp.asgi.application'
 
-# Channel layers for WebSocket
+# Channel layers for WebSocket.
+# SharedChannelLayer lets every worker process on this host exchange messages
+# through a local SQLite file (see chatapp/layers.py), so running several ASGI
+# workers needs no external service.
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer'
+        'BACKEND': 'chatapp.layers.SharedChannelLayer',
+        'CONFIG': {
+            'transport': 'chatapp.layers.SQLiteTransport',
+            'transport_options': {
+                'path': os.getenv('CHANNEL_LAYER_PATH', str(BASE_DIR / 'channels.sqlite3')),
+            },
+            'capacity': 100,
+            # The replay listener (chat/replay.py) receives every message of
+            # every room its process serves
+            'channel_capacity': {
+                'replay.*': int(os.getenv('CHAT_REPLAY_CHANNEL_CAPACITY', '5000')),
+            },
+            'expiry': 60,
+            'group_expiry': 86400,
+        },
     }
 }
 
+# Post feed pagination
+POSTS_PAGE_SIZE = int(os.getenv('POSTS_PAGE_SIZE', '20'))
+POSTS_MAX_PAGE_SIZE = int(os.getenv('POSTS_MAX_PAGE_SIZE', '100'))
+
+# Chat message history pagination
+CHAT_MESSAGES_PAGE_SIZE = int(os.getenv('CHAT_MESSAGES_PAGE_SIZE', '50'))
+CHAT_MESSAGES_MAX_PAGE_SIZE = int(os.getenv('CHAT_MESSAGES_MAX_PAGE_SIZE', '200'))
+
+# Message search page size
+CHAT_SEARCH_PAGE_SIZE = int(os.getenv('CHAT_SEARCH_PAGE_SIZE', '20'))
+CHAT_SEARCH_MAX_PAGE_SIZE = int(os.getenv('CHAT_SEARCH_MAX_PAGE_SIZE', '50'))
+
+# Delta sync limits: conversations per response and messages per conversation
+CHAT_SYNC_MAX_CONVERSATIONS = int(os.getenv('CHAT_SYNC_MAX_CONVERSATIONS', '50'))
+CHAT_SYNC_MESSAGES_PER_CONVERSATION = int(os.getenv('CHAT_SYNC_MESSAGES_PER_CONVERSATION', '100'))
+
+# Session resume: messages kept per room in memory, how long a process keeps
+# buffering a room after its last local client leaves, and the largest gap
+# replayed from the database before asking the client to resync
+CHAT_REPLAY_BUFFER_SIZE = int(os.getenv('CHAT_REPLAY_BUFFER_SIZE', '200'))
+CHAT_REPLAY_LINGER = float(os.getenv('CHAT_REPLAY_LINGER', '30'))
+CHAT_REPLAY_MAX_MESSAGES = int(os.getenv('CHAT_REPLAY_MAX_MESSAGES', '500'))
+
+# How long read acks from WebSocket clients are coalesced before one batched write
+CHAT_READ_FLUSH_INTERVAL = float(os.getenv('CHAT_READ_FLUSH_INTERVAL', '1.0'))
+
+# Cold message archive (see chat/archive.py and the archive_messages command)
+CHAT_ARCHIVE_ROOT = os.getenv('CHAT_ARCHIVE_ROOT', str(BASE_DIR / 'archive'))
+CHAT_ARCHIVE_AFTER_DAYS = int(os.getenv('CHAT_ARCHIVE_AFTER_DAYS', '180'))
+CHAT_ARCHIVE_SEGMENT_MESSAGES = int(os.getenv('CHAT_ARCHIVE_SEGMENT_MESSAGES', '1000'))
+
+# WebSocket limits (see chat/limits.py): largest accepted frame, longest
+# message, per-connection rates (per second) with their burst allowance, and
+# how many outbound frames may wait for a slow client before
+# CHAT_WS_SLOW_CONSUMER_POLICY (drop_oldest, coalesce or disconnect) applies
+CHAT_WS_MAX_FRAME_BYTES = int(os.getenv('CHAT_WS_MAX_FRAME_BYTES', '65536'))
+CHAT_MESSAGE_MAX_LENGTH = int(os.getenv('CHAT_MESSAGE_MAX_LENGTH', '4000'))
+CHAT_WS_FRAME_RATE = float(os.getenv('CHAT_WS_FRAME_RATE', '20'))
+CHAT_WS_FRAME_BURST = int(os.getenv('CHAT_WS_FRAME_BURST', '40'))
+CHAT_WS_MESSAGE_RATE = float(os.getenv('CHAT_WS_MESSAGE_RATE', '5'))
+CHAT_WS_MESSAGE_BURST = int(os.getenv('CHAT_WS_MESSAGE_BURST', '10'))
+CHAT_WS_OUTBOUND_QUEUE = int(os.getenv('CHAT_WS_OUTBOUND_QUEUE', '256'))
+CHAT_WS_SLOW_CONSUMER_POLICY = os.getenv('CHAT_WS_SLOW_CONSUMER_POLICY', 'coalesce')
+
+# Write-behind persistence for WebSocket messages (see chat/writebehind.py).
+# When disabled, ChatConsumer writes each message before broadcasting it.
+CHAT_WRITE_BEHIND = os.getenv('CHAT_WRITE_BEHIND', 'False').lower() in ('true', '1', 'yes')
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.getenv('CHAT_WRITE_BEHIND_BATCH_SIZE', '100'))
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv('CHAT_WRITE_BEHIND_FLUSH_INTERVAL', '0.05'))
+
+# Each process leases one of the 32 worker ids embedded in message ids
+# (see chat/ids.py); a lease not renewed for this many seconds can be taken over
+CHAT_WORKER_LEASE_SECONDS = int(os.getenv('CHAT_WORKER_LEASE_SECONDS', '60'))
+
+# Resumable uploads (see uploads/chunks.py): where partial files are kept,
+# the largest file and chunk accepted, and how long an idle upload survives
+# the purge_uploads command
+UPLOAD_TEMP_DIR = os.getenv('UPLOAD_TEMP_DIR', str(BASE_DIR / 'media' / 'uploads'))
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', str(1024 * 1024 * 1024)))
+UPLOAD_CHUNK_MAX_BYTES = int(os.getenv('UPLOAD_CHUNK_MAX_BYTES', str(8 * 1024 * 1024)))
+UPLOAD_SESSION_TTL_HOURS = float(os.getenv('UPLOAD_SESSION_TTL_HOURS', '24'))
+
+# Media serving (see chatapp/media.py): browser cache lifetime for uploads,
+# and optional offload to the front server with MEDIA_SENDFILE set to
+# x-accel-redirect (nginx, internal location at MEDIA_ACCEL_PREFIX) or x-sendfile
+MEDIA_CACHE_MAX_AGE = int(os.getenv('MEDIA_CACHE_MAX_AGE', str(365 * 24 * 3600)))
+MEDIA_SENDFILE = os.getenv('MEDIA_SENDFILE', '')
+MEDIA_ACCEL_PREFIX = os.getenv('MEDIA_ACCEL_PREFIX', '/protected-media/')
+
+# Image variants (see chatapp/imaging.py): name:longest edge pairs, encoder
+# quality, quality of the metadata-free copy that replaces the uploaded
+# original, worker threads per process and the largest image decoded
+IMAGE_VARIANT_SIZES = os.getenv('IMAGE_VARIANT_SIZES', 'thumb:160,small:480,medium:1080')
+IMAGE_VARIANT_QUALITY = int(os.getenv('IMAGE_VARIANT_QUALITY', '82'))
+IMAGE_ORIGINAL_QUALITY = int(os.getenv('IMAGE_ORIGINAL_QUALITY', '92'))
+IMAGE_VARIANT_WORKERS = int(os.getenv('IMAGE_VARIANT_WORKERS', '2'))
+IMAGE_MAX_PIXELS = int(os.getenv('IMAGE_MAX_PIXELS', str(50 * 1000 * 1000)))
+
+# Presence (see users/presence.py) and serialized posts (see posts/cache.py).
+# Use a shared cache backend for PRESENCE_CACHE and POSTS_CACHE when running
+# several worker processes.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'posts': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'posts',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+PRESENCE_CACHE = 'default'
+PRESENCE_TTL = int(os.getenv('PRESENCE_TTL', '60'))
+PRESENCE_FLUSH_INTERVAL = int(os.getenv('PRESENCE_FLUSH_INTERVAL', '30'))
+# Cache alias for post payloads, and seconds an entry is kept
+POSTS_CACHE = os.getenv('POSTS_CACHE', 'posts')
+POSTS_CACHE_TIMEOUT = int(os.getenv('POSTS_CACHE_TIMEOUT', '300'))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
@@ -108,6 +224,21 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Uploads are stored once per distinct content (see uploads/storage.py) and
+# hashed while they are received
+STORAGES = {
+    'default': {
+        'BACKEND': 'uploads.storage.ContentAddressedStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+FILE_UPLOAD_HANDLERS = [
+    'uploads.handlers.HashingMemoryFileUploadHandler',
+    'uploads.handlers.HashingTemporaryFileUploadHandler',
+]
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # CORS settings
@@ -124,7 +255,10 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
+    'upload-offset',
+    'upload-checksum',
 ]
+CORS_EXPOSE_HEADERS = ['upload-offset']
 
 # CSRF settings
 CSRF_TRUSTED_ORIGINS = os.getenv('CORS_ALLOWED_ORIGINS', 'http://localhost:3000,http://127.0.0.1:3000').split(',')
@@ -5,6 +5,7 @@ from .models import Post, PollOption, PollVote, Like, Comment
 class PollOptionInline(admin.TabularInline):
     model = PollOption
     extra = 0
+    readonly_fields = ['votes_count']
 
 
 @admin.register(Post)
@@ -22,7 +23,7 @@ class PollOptionAdmin(admin.ModelAdmin):
 
 @admin.register(PollVote)
 class PollVoteAdmin(admin.ModelAdmin):
-    list_display = ['user', 'option', 'created_at']
+    list_display = ['user', 'post', 'option', 'created_at']
 
 
 @admin.register(Like)
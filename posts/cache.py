@@ -0,0 +1,128 @@
+"""
+Shared cache of serialized posts.
+
+Most of a post's payload (author card, content, media URLs, counts, poll
+options) is the same for every viewer and is read far more often than it
+changes. render_posts() keeps that payload per post in the POSTS_CACHE cache,
+serializes only the posts it does not find there, and then fills in what
+depends on the viewer: ``is_liked`` and ``user_vote`` from the viewer_state()
+annotations, and the author's presence, which changes too often to cache.
+
+Entries are invalidated by version. Every post and every author has a random
+version token, and a payload is stored under the tokens it was built with.
+invalidate_post() and invalidate_author() replace the token once the
+transaction commits, so later reads miss; a request that read the old token
+while the change was in flight can only write to a key nobody reads any
+more. posts/signals.py calls them when posts, likes, comments, votes or
+authors change.
+
+Payloads contain absolute URLs, so the key includes the request's scheme and
+host. With the default local-memory cache every process has its own copy and
+other processes only see a change once POSTS_CACHE_TIMEOUT expires; point
+POSTS_CACHE at a shared cache when running several worker processes.
+
+Hits and misses are counted as ``posts.cache.hits`` and ``posts.cache.misses``
+(see chatapp/metrics.py).
+"""
+
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework import serializers
+
+from chatapp import metrics
+from users import presence
+from .models import Post
+from .serializers import PostSerializer
+from .services import posts_for
+
+
+def _cache():
+    return caches[settings.POSTS_CACHE]
+
+
+def _version_key(kind, pk):
+    return f'{kind}-version:{pk}'
+
+
+def _versions(kind, ids):
+    """Current version token of each id, creating the missing ones"""
+    cache = _cache()
+    keys = {pk: _version_key(kind, pk) for pk in ids}
+    found = cache.get_many(keys.values())
+    versions = {}
+    for pk, key in keys.items():
+        if key not in found:
+            token = uuid.uuid4().hex
+            # If an invalidation got there first, whatever is cached under
+            # our token is never read
+            cache.add(key, token, None)
+            found[key] = token
+        versions[pk] = found[key]
+    return versions
+
+
+def _bump(kind, pk):
+    transaction.on_commit(lambda: _cache().set(_version_key(kind, pk), uuid.uuid4().hex, None))
+
+
+def invalidate_post(post_id):
+    """Drop the cached payload of one post once the transaction commits"""
+    _bump('post', post_id)
+
+
+def invalidate_author(user_id):
+    """Drop the cached payloads of all of a user's posts once the transaction commits"""
+    _bump('author', user_id)
+
+
+def _for_viewer(payload, post):
+    data = dict(payload)
+    data['is_liked'] = post.viewer_liked
+    data['user_vote'] = post.viewer_vote if post.post_type == 'poll' else None
+    author = dict(data['author'])
+    author['is_online'] = presence.is_online(post.author_id)
+    last_seen = presence.last_seen(post.author_id)
+    if last_seen is not None:
+        author['last_seen'] = serializers.DateTimeField().to_representation(last_seen)
+    data['author'] = author
+    return data
+
+
+def render_posts(posts, request):
+    """
+    PostSerializer output for ``posts``, which must come from
+    posts.services.viewer_state(), using cached payloads where possible.
+    """
+    if not posts:
+        return []
+    cache = _cache()
+    origin = f'{request.scheme}://{request.get_host()}'
+    # Versions are read before the missing posts are loaded, so a change
+    # committed in between is never cached under the new version
+    post_versions = _versions('post', [post.id for post in posts])
+    author_versions = _versions('author', {post.author_id for post in posts})
+    keys = {
+        post.id: f'post:{post.id}:{post_versions[post.id]}:{author_versions[post.author_id]}:{origin}'
+        for post in posts
+    }
+
+    payloads = cache.get_many(keys.values())
+    missing = [post.id for post in posts if keys[post.id] not in payloads]
+    if len(missing) < len(posts):
+        metrics.increment('posts.cache.hits', len(posts) - len(missing))
+    if missing:
+        metrics.increment('posts.cache.misses', len(missing))
+        # Rendered as nobody in particular; the viewer's fields are replaced below
+        fresh = posts_for(None, Post.objects.filter(id__in=missing))
+        rendered = {
+            keys[item['id']]: item
+            for item in PostSerializer(fresh, many=True, context={'request': request}).data
+        }
+        cache.set_many(rendered, settings.POSTS_CACHE_TIMEOUT)
+        payloads.update(rendered)
+
+    # Posts deleted since the page was read are left out
+    return [_for_viewer(payloads[keys[post.id]], post) for post in posts if keys[post.id] in payloads]
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from posts.models import Post
+from posts.services import reconcile_poll_votes
+
+
+class Command(BaseCommand):
+    help = 'Recompute poll vote tallies from the recorded votes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--post', type=int, action='append', dest='posts',
+            help='Only this poll (can be repeated)',
+        )
+
+    def handle(self, *args, **options):
+        posts = Post.objects.filter(post_type='poll')
+        if options['posts']:
+            posts = posts.filter(pk__in=options['posts'])
+        fixed_options, fixed_posts = reconcile_poll_votes(posts)
+        self.stdout.write(self.style.SUCCESS(
+            f"Corrected {fixed_options} option tallies and {fixed_posts} poll totals"
+        ))
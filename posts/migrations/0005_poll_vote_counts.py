@@ -0,0 +1,63 @@
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def _count(PollVote, field):
+    return Coalesce(Subquery(
+        PollVote.objects.filter(**{field: OuterRef('pk')})
+        .order_by()
+        .values(field)
+        .annotate(count=Count('pk'))
+        .values('count')
+    ), 0)
+
+
+def backfill(apps, schema_editor):
+    Post = apps.get_model('posts', 'Post')
+    PollOption = apps.get_model('posts', 'PollOption')
+    PollVote = apps.get_model('posts', 'PollVote')
+
+    PollVote.objects.update(post_id=Subquery(
+        PollOption.objects.filter(pk=OuterRef('option_id')).values('post_id')[:1]
+    ))
+    # Concurrent requests could leave a user with several votes on one poll;
+    # keep the newest
+    duplicates = (
+        PollVote.objects.order_by()
+        .values('user_id', 'post_id')
+        .annotate(count=Count('pk'), newest=Max('pk'))
+        .filter(count__gt=1)
+    )
+    for row in duplicates:
+        PollVote.objects.filter(user_id=row['user_id'], post_id=row['post_id']).exclude(pk=row['newest']).delete()
+
+    PollOption.objects.update(votes_count=_count(PollVote, 'option'))
+    Post.objects.filter(post_type='poll').update(poll_votes_count=_count(PollVote, 'post'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0004_post_feed_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='poll_votes_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='polloption',
+            name='votes_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='pollvote',
+            name='post',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='poll_votes', to='posts.post'),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('posts', '0005_poll_vote_counts'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pollvote',
+            name='post',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='poll_votes', to='posts.post'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='pollvote',
+            unique_together=set(),
+        ),
+        migrations.AddConstraint(
+            model_name='pollvote',
+            constraint=models.UniqueConstraint(fields=('user', 'post'), name='posts_pollvote_user_post_uniq'),
+        ),
+    ]
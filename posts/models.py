@@ -17,11 +17,20 @@ class Post(models.Model):
     content = models.TextField(blank=True)  # Caption or text content
     image = models.ImageField(upload_to='posts/images/', blank=True, null=True)
     video = models.FileField(upload_to='posts/videos/', blank=True, null=True)
+    # Resized copies of image (see chatapp.imaging)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
+    # Total votes on a poll, kept up to date by vote_poll
+    poll_votes_count = models.PositiveIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Serve keyset pagination of the feed and of each author's posts
+            models.Index(fields=['created_at', 'id'], name='posts_created_idx'),
+            models.Index(fields=['author', 'created_at', 'id'], name='posts_author_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.author.username} - {self.post_type} - {self.created_at}"
@@ -40,24 +49,26 @@ class PollOption(models.Model):
     
     post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='poll_options')
     option_text = models.CharField(max_length=200)
+    # Kept up to date by vote_poll; reconcile_poll_votes recomputes it
+    votes_count = models.PositiveIntegerField(default=0, editable=False)
     
     def __str__(self):
         return self.option_text
-    
-    @property
-    def votes_count(self):
-        return self.votes.count()
 
 
 class PollVote(models.Model):
     """User votes on poll options"""
     
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    # The option's post, so the database can allow one vote per user per poll
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='poll_votes')
     option = models.ForeignKey(PollOption, on_delete=models.CASCADE, related_name='votes')
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
-        unique_together = ['user', 'option']
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'post'], name='posts_pollvote_user_post_uniq'),
+        ]
     
     def __str__(self):
         return f"{self.user.username} voted for {self.option.option_text}"
@@ -1,14 +1,14 @@
 from rest_framework import serializers
 from .models import Post, PollOption, PollVote, Like, Comment
 from users.serializers import UserSerializer
+from chatapp.imaging import ImageVariantsField
 
 
 class PollOptionSerializer(serializers.ModelSerializer):
-    votes_count = serializers.ReadOnlyField()
-    
     class Meta:
         model = PollOption
         fields = ['id', 'option_text', 'votes_count']
+        read_only_fields = ['votes_count']
 
 
 class CommentSerializer(serializers.ModelSerializer):
@@ -23,35 +23,53 @@ class CommentSerializer(serializers.ModelSerializer):
 class PostSerializer(serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
     poll_options = PollOptionSerializer(many=True, read_only=True)
-    likes_count = serializers.ReadOnlyField()
-    comments_count = serializers.ReadOnlyField()
+    likes_count = serializers.SerializerMethodField()
+    comments_count = serializers.SerializerMethodField()
     is_liked = serializers.SerializerMethodField()
     user_vote = serializers.SerializerMethodField()
+    image_variants = ImageVariantsField('image')
     
     class Meta:
         model = Post
         fields = [
-            'id', 'author', 'post_type', 'content', 'image', 'video',
-            'poll_options', 'likes_count', 'comments_count', 'is_liked',
+            'id', 'author', 'post_type', 'content', 'image', 'image_variants', 'video',
+            'poll_options', 'poll_votes_count', 'likes_count', 'comments_count', 'is_liked',
             'user_vote', 'created_at', 'updated_at'
         ]
-        read_only_fields = ['id', 'author', 'created_at', 'updated_at']
+        read_only_fields = ['id', 'author', 'poll_votes_count', 'created_at', 'updated_at']
+    
+    # posts.services.posts_for annotates the counts and the viewer's like and
+    # vote; the queries below only run for posts loaded without it
+    
+    def get_likes_count(self, obj):
+        if hasattr(obj, 'like_total'):
+            return obj.like_total
+        return obj.likes_count
+    
+    def get_comments_count(self, obj):
+        if hasattr(obj, 'comment_total'):
+            return obj.comment_total
+        return obj.comments_count
     
     def get_is_liked(self, obj):
+        if hasattr(obj, 'viewer_liked'):
+            return obj.viewer_liked
         request = self.context.get('request')
         if request and request.user.is_authenticated:
             return obj.likes.filter(user=request.user).exists()
         return False
     
     def get_user_vote(self, obj):
+        if obj.post_type != 'poll':
+            return None
+        if hasattr(obj, 'viewer_vote'):
+            return obj.viewer_vote
         request = self.context.get('request')
-        if request and request.user.is_authenticated and obj.post_type == 'poll':
-            vote = PollVote.objects.filter(
+        if request and request.user.is_authenticated:
+            return PollVote.objects.filter(
                 user=request.user,
                 option__post=obj
-            ).first()
-            if vote:
-                return vote.option.id
+            ).values_list('option_id', flat=True).first()
         return None
 
 
@@ -0,0 +1,98 @@
+from django.db import transaction
+from django.db.models import (
+    BooleanField, Count, Exists, F, IntegerField, OuterRef, Prefetch, Q, Subquery, Value
+)
+from django.db.models.functions import Coalesce
+from .models import Comment, Like, PollOption, PollVote, Post
+
+
+def _count(model, field='post'):
+    """Number of ``model`` rows pointing at the outer row through ``field``"""
+    return Coalesce(Subquery(
+        model.objects.filter(**{field: OuterRef('pk')})
+        .order_by()
+        .values(field)
+        .annotate(count=Count('pk'))
+        .values('count')
+    ), 0)
+
+
+def _with_viewer(queryset, user):
+    """Annotate whether ``user`` likes each post and the option they voted for"""
+    if user is not None and user.is_authenticated:
+        viewer_liked = Exists(Like.objects.filter(post=OuterRef('pk'), user=user))
+        viewer_vote = Subquery(
+            PollVote.objects.filter(post=OuterRef('pk'), user=user).values('option_id')[:1]
+        )
+    else:
+        viewer_liked = Value(False, output_field=BooleanField())
+        viewer_vote = Value(None, output_field=IntegerField())
+    return queryset.annotate(viewer_liked=viewer_liked, viewer_vote=viewer_vote)
+
+
+def posts_for(user, queryset=None):
+    """
+    Posts annotated with everything PostSerializer needs, so that serializing
+    any number of them costs a fixed number of queries: one for the posts
+    with their authors and counts, one for the poll options.
+
+    The counts are subqueries rather than joins, which would multiply every
+    like by every comment before counting.
+    """
+    if queryset is None:
+        queryset = Post.objects.all()
+    queryset = (
+        queryset
+        .select_related('author')
+        .prefetch_related(Prefetch('poll_options', queryset=PollOption.objects.order_by('id')))
+        .annotate(
+            like_total=_count(Like),
+            comment_total=_count(Comment),
+        )
+    )
+    return _with_viewer(queryset, user)
+
+
+def viewer_state(user, queryset=None):
+    """
+    Just the columns needed to page through posts, plus the viewer's like
+    and vote; posts.cache.render_posts() supplies the rest.
+    """
+    if queryset is None:
+        queryset = Post.objects.all()
+    return _with_viewer(queryset.only('id', 'author_id', 'post_type', 'created_at'), user)
+
+
+def _reconcile(model, field, counter, rows, post_field):
+    """Recount ``counter`` for ``rows`` that disagree with PollVote; returns how many were off"""
+    # Imported here because posts.cache builds on this module
+    from .cache import invalidate_post
+
+    drifted = list(
+        rows.annotate(actual=_count(PollVote, field))
+        .filter(~Q(**{counter: F('actual')}))
+        .values_list('pk', post_field)
+    )
+    for pk, post_id in drifted:
+        with transaction.atomic():
+            # vote_poll holds this row's lock from its counter update until
+            # its vote commits, so the recount sees every vote counted so far
+            model.objects.select_for_update().filter(pk=pk).first()
+            model.objects.filter(pk=pk).update(**{counter: _count(PollVote, field)})
+            # update() sends no signals, so drop the cached payload here
+            invalidate_post(post_id)
+    return len(drifted)
+
+
+def reconcile_poll_votes(posts=None):
+    """
+    Recompute the poll tallies that vote_poll keeps, from the PollVote rows.
+    Returns ``(options fixed, posts fixed)``.
+    """
+    if posts is None:
+        posts = Post.objects.filter(post_type='poll')
+    options = _reconcile(
+        PollOption, 'option', 'votes_count', PollOption.objects.filter(post__in=posts), 'post_id'
+    )
+    totals = _reconcile(Post, 'post', 'poll_votes_count', posts, 'pk')
+    return options, totals
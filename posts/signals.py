@@ -0,0 +1,53 @@
+"""
+Invalidate cached post payloads (see posts/cache.py) when what they show
+changes: the post itself, its poll options, likes, comments and votes, its
+image variants, or its author's profile.
+"""
+
+from django.db.models.signals import post_delete, post_save
+
+from chatapp.imaging import variants_built
+from users.models import User
+from .cache import invalidate_author, invalidate_post
+from .models import Comment, Like, PollOption, PollVote, Post
+
+
+POST_CHILDREN = (PollOption, PollVote, Like, Comment)
+
+# Saves that change nothing an author card shows
+IGNORED_USER_FIELDS = {'last_login', 'last_seen'}
+
+
+def post_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        invalidate_post(instance.pk)
+
+
+def child_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        invalidate_post(instance.post_id)
+
+
+def author_changed(sender, instance, created=False, raw=False, update_fields=None, **kwargs):
+    if raw or created:
+        return
+    if update_fields is not None and set(update_fields) <= IGNORED_USER_FIELDS:
+        return
+    invalidate_author(instance.pk)
+
+
+def variants_changed(sender, pk, **kwargs):
+    if sender is Post:
+        invalidate_post(pk)
+    elif sender is User:
+        invalidate_author(pk)
+
+
+def connect():
+    post_save.connect(post_changed, sender=Post, dispatch_uid='post_cache_save')
+    post_delete.connect(post_changed, sender=Post, dispatch_uid='post_cache_delete')
+    for model in POST_CHILDREN:
+        post_save.connect(child_changed, sender=model, dispatch_uid=f'post_cache_save_{model.__name__}')
+        post_delete.connect(child_changed, sender=model, dispatch_uid=f'post_cache_delete_{model.__name__}')
+    post_save.connect(author_changed, sender=User, dispatch_uid='post_cache_author')
+    variants_built.connect(variants_changed, dispatch_uid='post_cache_variants')
@@ -0,0 +1,95 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from users.models import User
+from .models import Comment, Like, PollOption, PollVote, Post
+
+
+class PostQueryCountTests(TestCase):
+    """
+    Reading posts must cost the same number of queries however many posts
+    are on the page. A per-post query (author, counts, poll options, the
+    viewer's like or vote) makes the N-post page cost more than the 1-post one.
+    """
+
+    # Token lookup, then the page of posts
+    PAGE_QUERIES = 2
+    # Posts missing from the cache: one query for the posts with their
+    # authors and counts, one for their poll options
+    RENDER_QUERIES = 2
+    N = 5
+
+    def setUp(self):
+        caches[settings.POSTS_CACHE].clear()
+        self.author = User.objects.create_user(username='author', password='pw123456')
+        self.viewer = User.objects.create_user(username='viewer', password='pw123456')
+        self.client = APIClient()
+        token = Token.objects.create(user=self.viewer)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+    def make_posts(self, author, count):
+        """``count`` posts by ``author``, alternating text and poll posts"""
+        posts = []
+        for i in range(count):
+            if i % 2:
+                post = Post.objects.create(author=author, post_type='poll', content=f'Poll {i}')
+                options = [
+                    PollOption.objects.create(post=post, option_text=text)
+                    for text in ('Yes', 'No')
+                ]
+                PollVote.objects.create(user=self.viewer, post=post, option=options[0])
+            else:
+                post = Post.objects.create(author=author, post_type='text', content=f'Post {i}')
+            Like.objects.create(user=self.viewer, post=post)
+            Comment.objects.create(user=self.viewer, post=post, content='Nice')
+            posts.append(post)
+        return posts
+
+    def assertPageQueries(self, url, expected):
+        # The first request renders every post, the second is served from the cache
+        with self.assertNumQueries(self.PAGE_QUERIES + self.RENDER_QUERIES):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['posts']), expected)
+        with self.assertNumQueries(self.PAGE_QUERIES):
+            response = self.client.get(url)
+        self.assertEqual(len(response.data['posts']), expected)
+        return response
+
+    def test_list_posts_single(self):
+        self.make_posts(self.author, 1)
+        self.assertPageQueries(reverse('list_posts'), 1)
+
+    def test_list_posts_many(self):
+        self.make_posts(self.author, self.N)
+        response = self.assertPageQueries(reverse('list_posts'), self.N)
+        for data in response.data['posts']:
+            self.assertTrue(data['is_liked'])
+            self.assertEqual(data['likes_count'], 1)
+            self.assertEqual(data['comments_count'], 1)
+            if data['post_type'] == 'poll':
+                self.assertEqual(len(data['poll_options']), 2)
+                self.assertEqual(data['user_vote'], data['poll_options'][0]['id'])
+
+    def test_my_posts_single(self):
+        self.make_posts(self.viewer, 1)
+        self.assertPageQueries(reverse('my_posts'), 1)
+
+    def test_my_posts_many(self):
+        self.make_posts(self.viewer, self.N)
+        self.make_posts(self.author, 2)
+        self.assertPageQueries(reverse('my_posts'), self.N)
+
+    def test_get_post(self):
+        for post in self.make_posts(self.author, 2):
+            url = reverse('get_post', args=[post.id])
+            with self.assertNumQueries(self.PAGE_QUERIES + self.RENDER_QUERIES):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['post']['id'], post.id)
+            with self.assertNumQueries(self.PAGE_QUERIES):
+                self.client.get(url)
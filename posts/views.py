@@ -3,26 +3,73 @@ from rest_framework.decorators import api_view, permission_classes, authenticati
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.authentication import TokenAuthentication
 from rest_framework.response import Response
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, When
+from django.db.models.functions import Greatest
+from django.http import Http404
 from django.shortcuts import get_object_or_404
+from chatapp.imaging import schedule_variants
+from chatapp.pagination import InvalidCursor, decode_cursor, encode_cursor, get_page_size, paginate_keyset
 from users.authentication import CsrfExemptSessionAuthentication
 from .models import Post, PollOption, PollVote, Like, Comment
+from .cache import render_posts
+from .services import viewer_state
 from .serializers import (
     PostSerializer, PostCreateSerializer, CommentSerializer, VoteSerializer
 )
 
 
-@api_view(['GET'])
-@permission_classes([AllowAny])
-def list_posts(request):
-    """Get all public posts"""
-    posts = Post.objects.all()
-    serializer = PostSerializer(posts, many=True, context={'request': request})
+def paginated_posts(request, queryset):
+    """
+    One page of ``queryset``, newest first, as a response.
+    
+    Query params: ``before``/``after`` cursors from a previous page and
+    ``limit`` (capped by POSTS_MAX_PAGE_SIZE).
+    """
+    before = request.GET.get('before')
+    after = request.GET.get('after')
+    
+    if before and after:
+        return Response({
+            'success': False,
+            'message': 'Use either before or after, not both'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
+        before_key = decode_cursor(before) if before else None
+        after_key = decode_cursor(after) if after else None
+    except InvalidCursor:
+        return Response({
+            'success': False,
+            'message': 'Invalid cursor'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    page_size = get_page_size(request, settings.POSTS_PAGE_SIZE, settings.POSTS_MAX_PAGE_SIZE)
+    posts, has_more = paginate_keyset(queryset, page_size, before=before_key, after=after_key)
+    
+    # next_cursor pages towards older posts, prev_cursor towards newer ones
+    next_cursor = None
+    if posts and (has_more or after_key):
+        next_cursor = encode_cursor(posts[-1].created_at, posts[-1].id)
+    prev_cursor = encode_cursor(posts[0].created_at, posts[0].id) if posts else after
+    
     return Response({
         'success': True,
-        'posts': serializer.data
+        'posts': render_posts(posts, request),
+        'has_more': has_more,
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor,
     })
 
 
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def list_posts(request):
+    """Get a page of public posts, newest first"""
+    return paginated_posts(request, viewer_state(request.user))
+
+
 @api_view(['POST'])
 @authentication_classes([TokenAuthentication, CsrfExemptSessionAuthentication])
 @permission_classes([IsAuthenticated])
@@ -32,6 +79,7 @@ def create_post(request):
     
     if serializer.is_valid():
         post = serializer.save(author=request.user)
+        schedule_variants(post, 'image')
         return Response({
             'success': True,
             'message': 'Post created successfully',
@@ -48,11 +96,13 @@ def create_post(request):
 @permission_classes([AllowAny])
 def get_post(request, post_id):
     """Get a single post"""
-    post = get_object_or_404(Post, id=post_id)
-    serializer = PostSerializer(post, context={'request': request})
+    post = get_object_or_404(viewer_state(request.user), id=post_id)
+    rendered = render_posts([post], request)
+    if not rendered:
+        raise Http404
     return Response({
         'success': True,
-        'post': serializer.data
+        'post': rendered[0]
     })
 
 
@@ -161,29 +211,46 @@ def vote_poll(request, post_id):
     option_id = serializer.validated_data['option_id']
     option = get_object_or_404(PollOption, id=option_id, post=post)
     
-    # Check if user already voted on this poll
-    existing_vote = PollVote.objects.filter(
-        user=request.user,
-        option__post=post
-    ).first()
-    
-    if existing_vote:
-        if existing_vote.option.id == option_id:
-            return Response({
-                'success': False,
-                'message': 'You already voted for this option'
-            }, status=status.HTTP_400_BAD_REQUEST)
-        # Change vote
-        existing_vote.option = option
-        existing_vote.save()
-    else:
-        PollVote.objects.create(user=request.user, option=option)
+    # The vote and the tallies change together; the (user, post) unique
+    # constraint stops two concurrent first votes from both counting
+    try:
+        with transaction.atomic():
+            existing_vote = PollVote.objects.select_for_update().filter(
+                user=request.user,
+                post=post
+            ).first()
+            
+            if existing_vote is None:
+                PollVote.objects.create(user=request.user, post=post, option=option)
+                PollOption.objects.filter(id=option.id).update(votes_count=F('votes_count') + 1)
+                Post.objects.filter(id=post.id).update(poll_votes_count=F('poll_votes_count') + 1)
+            elif existing_vote.option_id == option.id:
+                return Response({
+                    'success': False,
+                    'message': 'You already voted for this option'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            else:
+                # Change vote: move it from one tally to the other in one statement
+                PollOption.objects.filter(id__in=[existing_vote.option_id, option.id]).update(
+                    votes_count=Case(
+                        When(id=option.id, then=F('votes_count') + 1),
+                        default=Greatest(F('votes_count') - 1, 0),
+                    )
+                )
+                existing_vote.option = option
+                existing_vote.save(update_fields=['option'])
+    except IntegrityError:
+        return Response({
+            'success': False,
+            'message': 'Another vote on this poll is being recorded, try again'
+        }, status=status.HTTP_409_CONFLICT)
     
     # Return updated poll data
+    post = viewer_state(request.user).get(id=post.id)
     return Response({
         'success': True,
         'message': 'Vote recorded',
-        'post': PostSerializer(post, context={'request': request}).data
+        'post': render_posts([post], request)[0]
     })
 
 
@@ -191,10 +258,5 @@ def vote_poll(request, post_id):
 @authentication_classes([TokenAuthentication, CsrfExemptSessionAuthentication])
 @permission_classes([IsAuthenticated])
 def my_posts(request):
-    """Get current user's posts"""
-    posts = Post.objects.filter(author=request.user)
-    serializer = PostSerializer(posts, many=True, context={'request': request})
-    return Response({
-        'success': True,
-        'posts': serializer.data
-    })
+    """Get a page of the current user's posts, newest first"""
+    return paginated_posts(request, viewer_state(request.user, Post.objects.filter(author=request.user)))
@@ -0,0 +1,23 @@
+from django.contrib import admin
+from .models import Blob, StoredFile, UploadSession
+
+
+@admin.register(UploadSession)
+class UploadSessionAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'target', 'kind', 'filename', 'offset', 'size', 'status', 'updated_at']
+    list_filter = ['status', 'target', 'kind']
+    search_fields = ['user__username', 'filename']
+    raw_id_fields = ['user', 'message', 'post']
+
+
+@admin.register(Blob)
+class BlobAdmin(admin.ModelAdmin):
+    list_display = ['sha256', 'size', 'refcount', 'created_at']
+    readonly_fields = ['sha256', 'size', 'refcount', 'created_at']
+
+
+@admin.register(StoredFile)
+class StoredFileAdmin(admin.ModelAdmin):
+    list_display = ['name', 'blob', 'created_at']
+    search_fields = ['name', 'blob__sha256']
+    readonly_fields = ['name', 'blob', 'created_at']
@@ -0,0 +1,313 @@
+"""
+Resumable uploads.
+
+A client opens an UploadSession with the file's name and size, then sends the
+bytes in any number of PUT requests, each carrying the offset it starts at.
+Chunks are streamed straight into a partial file under UPLOAD_TEMP_DIR and
+never held in memory whole. UploadSession.offset only moves forward once a
+chunk is on disk, so after a dropped connection the client asks for the
+session, reads the offset and carries on from there. A chunk that is cut off
+keeps whatever arrived.
+
+The SHA-256 of the whole file is kept up to date as chunks arrive, so
+finishing an upload does not read the file again. The running hashes live in
+this process only; a chunk that lands on another worker, or after a restart,
+re-hashes the partial file once to catch up.
+
+When every byte is in, finalize() moves the partial file into the storage of
+the Message or Post field it belongs to and creates that row. A new upload
+whose ``sha256`` matches a file the uploader already has in
+ContentAddressedStorage (an attachment they sent, a post of theirs or their
+avatar) starts out complete and is finalized by linking the stored copy.
+Knowing a hash is not proof of having the bytes, so content stored only by
+other users is uploaded in full and deduplicated once it has been hashed here.
+"""
+
+import fcntl
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from chatapp.imaging import schedule_variants
+from chat.models import Conversation, Message
+from chat.services import broadcast_message, record_message
+from posts.models import Post
+from users.models import User
+from .models import StoredFile, UploadSession
+from .storage import BlobReference, ContentAddressedStorage
+
+
+READ_SIZE = 64 * 1024
+# Running hashes kept per process, least recently used dropped first
+MAX_HASHERS = 256
+
+
+class UploadError(Exception):
+    """A chunk or finalize request that cannot be applied"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class ChunkConflict(UploadError):
+    """The chunk does not start at the session's current offset"""
+
+    def __init__(self, message):
+        super().__init__(message, status=409)
+
+
+class PartialFile(File):
+    """
+    A finished upload on local disk. FileSystemStorage moves a file that has
+    a temporary_file_path() into place instead of copying it.
+    """
+
+    def temporary_file_path(self):
+        return self.name
+
+
+_hashers = OrderedDict()
+_hashers_lock = threading.Lock()
+
+
+def part_path(session):
+    return Path(settings.UPLOAD_TEMP_DIR) / f'{session.pk}.part'
+
+
+def _hash_file(path, length):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        remaining = length
+        while remaining:
+            block = f.read(min(READ_SIZE, remaining))
+            if not block:
+                break
+            hasher.update(block)
+            remaining -= len(block)
+    return hasher
+
+
+def _hasher_at(session, path):
+    """The running hash of the first ``session.offset`` bytes"""
+    with _hashers_lock:
+        entry = _hashers.get(session.pk)
+        if entry is not None:
+            _hashers.move_to_end(session.pk)
+    if entry is not None and entry[0] == session.offset:
+        return entry[1].copy()
+    return _hash_file(path, session.offset)
+
+
+def _remember_hasher(session_id, offset, hasher):
+    with _hashers_lock:
+        _hashers[session_id] = (offset, hasher)
+        _hashers.move_to_end(session_id)
+        while len(_hashers) > MAX_HASHERS:
+            _hashers.popitem(last=False)
+
+
+def _forget_hasher(session_id):
+    with _hashers_lock:
+        _hashers.pop(session_id, None)
+
+
+def parse_checksum(header):
+    """Parse an ``Upload-Checksum: sha256 <hex>`` header; None when absent"""
+    if not header:
+        return None
+    algorithm, _, value = header.partition(' ')
+    if algorithm.lower() != 'sha256' or len(value.strip()) != 64:
+        raise UploadError('Upload-Checksum must be "sha256 <hex digest>"')
+    return value.strip().lower()
+
+
+def write_chunk(session, start, stream, length, checksum=None):
+    """
+    Write ``length`` bytes read from ``stream`` at ``start``.
+
+    ``checksum`` is the hex SHA-256 of the chunk. A chunk that fails it is
+    thrown away. A chunk that ends early (the client went away) is kept up to
+    the last byte received and not checked. Returns the new offset.
+    """
+    if session.status != 'active':
+        raise UploadError('Upload is already complete')
+    if start != session.offset:
+        raise ChunkConflict(f'Expected offset {session.offset}')
+    if length > settings.UPLOAD_CHUNK_MAX_BYTES:
+        raise UploadError(f'Chunks are limited to {settings.UPLOAD_CHUNK_MAX_BYTES} bytes', status=413)
+    if start + length > session.size:
+        raise UploadError('Chunk runs past the end of the file')
+
+    path = part_path(session)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    with os.fdopen(fd, 'r+b') as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise ChunkConflict('Another chunk for this upload is still being written')
+
+        # Re-read under the lock: a chunk that just finished may have moved it
+        session.refresh_from_db(fields=['offset', 'status'])
+        if session.status != 'active':
+            raise UploadError('Upload is already complete')
+        if start != session.offset:
+            raise ChunkConflict(f'Expected offset {session.offset}')
+
+        hasher = _hasher_at(session, path)
+        chunk_hasher = hashlib.sha256()
+        f.seek(start)
+        received = 0
+        try:
+            while received < length:
+                block = stream.read(min(READ_SIZE, length - received))
+                if not block:
+                    break
+                f.write(block)
+                hasher.update(block)
+                chunk_hasher.update(block)
+                received += len(block)
+        except OSError:
+            # Client disconnected mid-chunk; keep what arrived
+            pass
+
+        if received == length and checksum is not None and chunk_hasher.hexdigest() != checksum:
+            f.truncate(start)
+            raise UploadError('Chunk checksum mismatch')
+        # Anything past the new offset is left over from an earlier attempt
+        f.truncate(start + received)
+        f.flush()
+        os.fsync(f.fileno())
+
+        session.offset = start + received
+        UploadSession.objects.filter(pk=session.pk).update(offset=session.offset, updated_at=timezone.now())
+        _remember_hasher(session.pk, session.offset, hasher)
+    return session.offset
+
+
+def _target_model(session):
+    return Message if session.target == 'message' else Post
+
+
+def _finish_message(session, file, data):
+    try:
+        conversation = Conversation.objects.get(pk=data.get('conversation_id'))
+    except (Conversation.DoesNotExist, ValueError, TypeError):
+        raise UploadError('Conversation not found', status=404)
+    if not conversation.participants.filter(pk=session.user_id).exists():
+        raise UploadError('You are not a participant in this conversation', status=403)
+
+    message = Message(
+        conversation=conversation,
+        sender_id=session.user_id,
+        message_type=session.kind,
+        content=data.get('content', ''),
+    )
+    getattr(message, session.kind).save(session.filename, file, save=False)
+    message.save()
+    record_message(message)
+    broadcast_message(message)
+    session.message = message
+    return message
+
+
+def _finish_post(session, file, data):
+    post = Post(author_id=session.user_id, post_type=session.kind, content=data.get('content', ''))
+    getattr(post, session.kind).save(session.filename, file, save=False)
+    post.save()
+    session.post = post
+    return post
+
+
+def finalize(session, data):
+    """
+    Attach a fully received upload to a new Message (``data`` needs
+    ``conversation_id``) or Post, and return that row. Calling it again for
+    a finished session returns the same row.
+    """
+    if session.status == 'complete':
+        return session.message if session.target == 'message' else session.post
+    if session.offset != session.size:
+        raise ChunkConflict(f'Upload is incomplete: {session.offset} of {session.size} bytes received')
+
+    path = part_path(session)
+    if path.exists():
+        hasher = _hasher_at(session, path)
+        if session.sha256 and hasher.hexdigest() != session.sha256:
+            raise UploadError('File checksum mismatch')
+        file = PartialFile(open(path, 'rb'), name=str(path))
+        # Saves ContentAddressedStorage from hashing the file again
+        file.sha256 = hasher.hexdigest()
+    elif session.sha256 and _user_has_blob(session.user, session.sha256, session.size):
+        # The uploader already had this content stored when the upload started
+        file = BlobReference(session.sha256, session.size)
+    else:
+        raise UploadError('Upload data is missing', status=410)
+
+    try:
+        with transaction.atomic():
+            session = UploadSession.objects.select_for_update().get(pk=session.pk)
+            if session.status == 'complete':
+                return session.message if session.target == 'message' else session.post
+            if session.target == 'message':
+                result = _finish_message(session, file, data)
+            else:
+                result = _finish_post(session, file, data)
+            session.status = 'complete'
+            session.save(update_fields=['status', 'message', 'post', 'updated_at'])
+            if session.kind == 'image':
+                schedule_variants(result, 'image')
+    except FileNotFoundError:
+        # The stored copy went away after the upload was skipped
+        UploadSession.objects.filter(pk=session.pk).update(offset=0)
+        raise ChunkConflict('Stored content is gone, upload the file again from offset 0')
+    finally:
+        file.close()
+
+    _forget_hasher(session.pk)
+    if path.exists():
+        # Storages that cannot move the file copy it instead
+        path.unlink()
+    return result
+
+
+def _user_has_blob(user, sha256, size):
+    """Whether one of ``user``'s own messages, posts or avatar is stored as this blob"""
+    names = StoredFile.objects.filter(blob__sha256=sha256, blob__size=size).values('name')
+    return (
+        Message.objects.filter(sender=user).filter(
+            Q(image__in=names) | Q(video__in=names) | Q(file__in=names)
+        ).exists()
+        or Post.objects.filter(author=user).filter(Q(image__in=names) | Q(video__in=names)).exists()
+        or User.objects.filter(pk=user.pk, avatar__in=names).exists()
+    )
+
+
+def skip_known_content(session):
+    """
+    Mark a new upload as fully received when its uploader already has content
+    with its ``sha256`` stored, so the client can complete it without sending
+    any bytes.
+    """
+    storage = _target_model(session)._meta.get_field(session.kind).storage
+    if not session.sha256 or not isinstance(storage, ContentAddressedStorage):
+        return
+    if _user_has_blob(session.user, session.sha256, session.size):
+        session.offset = session.size
+        session.save(update_fields=['offset', 'updated_at'])
+
+
+def discard(session):
+    """Delete a session and its partial file"""
+    _forget_hasher(session.pk)
+    part_path(session).unlink(missing_ok=True)
+    session.delete()
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import Message
+from chatapp.imaging import build_variants
+from posts.models import Post
+from users.models import User
+
+
+SOURCES = {
+    'posts': (Post, 'image'),
+    'messages': (Message, 'image'),
+    'avatars': (User, 'avatar'),
+}
+
+
+class Command(BaseCommand):
+    help = 'Build resized variants, and strip the metadata of originals, for images that do not have them yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--only', choices=sorted(SOURCES), action='append',
+            help='Only process these images (can be repeated)',
+        )
+        parser.add_argument(
+            '--rebuild', action='store_true',
+            help='Also rebuild images that already have variants, e.g. after changing IMAGE_VARIANT_SIZES',
+        )
+
+    def handle(self, *args, **options):
+        for label in options['only'] or sorted(SOURCES):
+            model, field_name = SOURCES[label]
+            rows = model.objects.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True})
+            count = 0
+            for pk, name, variants in rows.values_list('pk', field_name, f'{field_name}_variants').iterator():
+                variants = variants or {}
+                if not options['rebuild'] and variants.get('source') == name and variants.get('stripped'):
+                    continue
+                build_variants(model, pk, field_name, name)
+                count += 1
+            self.stdout.write(f"{label}: processed {count} images")
+        self.stdout.write(self.style.SUCCESS('Done'))
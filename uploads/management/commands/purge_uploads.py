@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from uploads.chunks import discard
+from uploads.models import UploadSession
+
+
+class Command(BaseCommand):
+    help = 'Delete abandoned resumable uploads and their partial files'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-hours', type=float, default=settings.UPLOAD_SESSION_TTL_HOURS,
+            help='Delete uploads idle for this many hours (default: UPLOAD_SESSION_TTL_HOURS)',
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timezone.timedelta(hours=options['older_than_hours'])
+        count = 0
+        for session in UploadSession.objects.filter(status='active', updated_at__lt=cutoff).iterator():
+            discard(session)
+            count += 1
+        # Finished sessions only serve retried finalize calls
+        finished, _ = UploadSession.objects.filter(status='complete', updated_at__lt=cutoff).delete()
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {count} abandoned and {finished} finished uploads"
+        ))
@@ -0,0 +1,74 @@
+import uuid
+
+from django.conf import settings
+from django.db import models
+
+
+class UploadSession(models.Model):
+    """A resumable upload in progress (see uploads/chunks.py)"""
+
+    TARGET_CHOICES = [
+        ('message', 'Message'),
+        ('post', 'Post'),
+    ]
+
+    KIND_CHOICES = [
+        ('image', 'Image'),
+        ('video', 'Video'),
+        ('file', 'File'),
+    ]
+
+    STATUS_CHOICES = [
+        ('active', 'Active'),
+        ('complete', 'Complete'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='upload_sessions')
+    target = models.CharField(max_length=10, choices=TARGET_CHOICES)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    # Bytes received and on disk so far; the next chunk must start here
+    offset = models.PositiveBigIntegerField(default=0)
+    # Optional hex SHA-256 of the whole file, checked when the upload completes
+    sha256 = models.CharField(max_length=64, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='active')
+    # What the finished upload was attached to, so a retried finalize is harmless
+    message = models.ForeignKey('chat.Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    post = models.ForeignKey('posts.Post', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'updated_at'], name='uploads_status_updated_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username}: {self.filename} ({self.offset}/{self.size})"
+
+
+class Blob(models.Model):
+    """One stored copy of some file content (see uploads/storage.py)"""
+
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    size = models.PositiveBigIntegerField()
+    # Number of StoredFile names that share this content
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256} ({self.refcount} refs)"
+
+
+class StoredFile(models.Model):
+    """A file name in storage and the blob holding its content"""
+
+    name = models.CharField(max_length=255, primary_key=True)
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, related_name='names')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,49 @@
+import os
+
+from django.conf import settings
+from rest_framework import serializers
+from .models import UploadSession
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    message_id = serializers.IntegerField(read_only=True)
+    post_id = serializers.IntegerField(read_only=True)
+    
+    class Meta:
+        model = UploadSession
+        fields = [
+            'id', 'target', 'kind', 'filename', 'size', 'offset', 'sha256', 'status',
+            'message_id', 'post_id', 'created_at', 'updated_at'
+        ]
+        read_only_fields = fields
+
+
+class UploadCreateSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UploadSession
+        fields = ['target', 'kind', 'filename', 'size', 'sha256']
+    
+    def validate_filename(self, value):
+        # Only the base name is kept; the target field decides the directory
+        value = os.path.basename(value.replace('\\', '/')).strip()
+        if value in ('', '.', '..'):
+            raise serializers.ValidationError('Invalid file name')
+        return value
+    
+    def validate_size(self, value):
+        if value < 1:
+            raise serializers.ValidationError('Size must be at least 1 byte')
+        if value > settings.UPLOAD_MAX_BYTES:
+            raise serializers.ValidationError(f'Uploads are limited to {settings.UPLOAD_MAX_BYTES} bytes')
+        return value
+    
+    def validate_sha256(self, value):
+        value = value.lower()
+        if value and (len(value) != 64 or any(c not in '0123456789abcdef' for c in value)):
+            raise serializers.ValidationError('Expected a hex SHA-256 digest')
+        return value
+    
+    def validate(self, data):
+        if data['target'] == 'post' and data['kind'] == 'file':
+            raise serializers.ValidationError({'kind': 'Posts take an image or a video'})
+        return data
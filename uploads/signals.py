@@ -0,0 +1,88 @@
+"""
+Release stored files when the rows that use them go away.
+
+Deleting a Message, Post or User, or replacing one of its files, deletes
+the old file and its image variants from storage once the transaction
+commits. With ContentAddressedStorage that drops one reference to the blob
+and frees the blob when nothing else uses it.
+
+Archiving messages deletes their rows but keeps the files, which the
+archive still points at; it runs inside retain_files().
+"""
+
+import contextlib
+import contextvars
+
+from django.db import models, transaction
+from django.db.models.signals import post_delete, pre_save
+
+from chat.models import Message
+from posts.models import Post
+from users.models import User
+
+
+TRACKED_MODELS = (Message, Post, User)
+
+_retaining = contextvars.ContextVar('retaining_files', default=False)
+
+
+@contextlib.contextmanager
+def retain_files():
+    """Delete rows inside this block without deleting their files"""
+    token = _retaining.set(True)
+    try:
+        yield
+    finally:
+        _retaining.reset(token)
+
+
+def _file_fields(model):
+    return [field for field in model._meta.concrete_fields if isinstance(field, models.FileField)]
+
+
+def _files_of(field, name, variants):
+    yield name
+    for size in (variants or {}).get('sizes', {}).values():
+        yield size['url']
+        yield size['webp']
+
+
+def _release_later(storage, names):
+    names = {name for name in names if name}
+    if names:
+        transaction.on_commit(lambda: [storage.delete(name) for name in names])
+
+
+def release_deleted(sender, instance, **kwargs):
+    if _retaining.get():
+        return
+    for field in _file_fields(sender):
+        name = getattr(instance, field.attname).name
+        variants = getattr(instance, f'{field.name}_variants', None)
+        _release_later(field.storage, _files_of(field, name, variants))
+
+
+def release_replaced(sender, instance, raw=False, **kwargs):
+    if raw or instance._state.adding or instance.pk is None:
+        return
+    fields = _file_fields(sender)
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None:
+        fields = [field for field in fields if field.name in update_fields]
+    if not fields:
+        return
+    columns = [field.attname for field in fields]
+    variant_columns = [f'{field.name}_variants' for field in fields if hasattr(instance, f'{field.name}_variants')]
+    old = sender._default_manager.filter(pk=instance.pk).values(*columns, *variant_columns).first()
+    if old is None:
+        return
+    for field in fields:
+        old_name = old[field.attname]
+        if old_name and old_name != getattr(instance, field.attname).name:
+            _release_later(field.storage, _files_of(field, old_name, old.get(f'{field.name}_variants')))
+
+
+def connect():
+    for model in TRACKED_MODELS:
+        post_delete.connect(release_deleted, sender=model, dispatch_uid=f'release_deleted_{model.__name__}')
+        pre_save.connect(release_replaced, sender=model, dispatch_uid=f'release_replaced_{model.__name__}')
@@ -0,0 +1,159 @@
+"""
+Content-addressed file storage.
+
+ContentAddressedStorage keeps each distinct file content once, as a blob
+named after its SHA-256 under ``blobs/``:
+
+    blobs/3f/3f9a...c1
+
+The names the models store (``chat/images/cat.jpg`` and so on) stay exactly
+as before, but each one is a hard link to its blob. URLs, media serving and
+downloads keep working unchanged while the bytes are on disk only once.
+Saving content that is already stored writes nothing; it only adds a link.
+
+StoredFile records which blob every name links to, and Blob.refcount counts
+those names. delete() removes the name, and the blob goes with its last
+name. uploads.signals calls delete() when a Message, Post or User row that
+referenced a file goes away.
+
+The SHA-256 is worked out while the content is copied to a temporary file
+next to the blobs, unless the file already carries a ``sha256`` attribute set
+by the upload handlers in uploads/handlers.py or by a resumable upload.
+
+Every saved name gets a random suffix (``cat_x7Yz1Qa.jpg``), even when the
+plain name is free, so a URL never points at different content over time.
+
+Hard links need MEDIA_ROOT to be a single filesystem. Files saved before this
+storage was enabled have no StoredFile and are deleted as plain files.
+"""
+
+import hashlib
+import os
+import tempfile
+
+from django.core.files import File
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.db.models import F
+
+from .models import Blob, StoredFile
+
+
+BLOB_DIR = 'blobs'
+
+
+class BlobReference(File):
+    """
+    Content known only by its hash. Saving one links the existing blob; it
+    fails with FileNotFoundError if that blob is gone.
+    """
+
+    def __init__(self, sha256, size):
+        super().__init__(None, name=sha256)
+        self.sha256 = sha256
+        self.size = size
+
+    def close(self):
+        pass
+
+
+class ContentAddressedStorage(FileSystemStorage):
+
+    def get_available_name(self, name, max_length=None):
+        # Always add a random suffix, so a name freed by delete() is not
+        # handed to different content that clients could confuse with the
+        # old file they cached (chatapp/media.py marks media immutable)
+        directory, filename = os.path.split(name)
+        root, extension = os.path.splitext(filename)
+        name = os.path.join(directory, self.get_alternative_name(root, extension))
+        return super().get_available_name(name, max_length)
+
+    def blob_name(self, sha256):
+        return f'{BLOB_DIR}/{sha256[:2]}/{sha256}'
+
+    def _spool(self, content):
+        """Copy ``content`` to a temporary file, hashing it on the way"""
+        directory = self.path(f'{BLOB_DIR}/tmp')
+        os.makedirs(directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=directory)
+        hasher = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    f.write(chunk)
+                    hasher.update(chunk)
+        except BaseException:
+            os.unlink(path)
+            raise
+        return hasher.hexdigest(), path
+
+    def _place_blob(self, blob_path, content, spooled):
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        if spooled is not None:
+            os.replace(spooled, blob_path)
+        elif isinstance(content, BlobReference):
+            raise FileNotFoundError(blob_path)
+        elif hasattr(content, 'temporary_file_path'):
+            file_move_safe(content.temporary_file_path(), blob_path, allow_overwrite=True)
+        else:
+            # Content with a known hash that only exists in memory
+            with open(blob_path + '.tmp', 'wb') as f:
+                for chunk in content.chunks():
+                    f.write(chunk)
+            os.replace(blob_path + '.tmp', blob_path)
+        if self.file_permissions_mode is not None:
+            os.chmod(blob_path, self.file_permissions_mode)
+
+    def _save(self, name, content):
+        sha256 = getattr(content, 'sha256', None)
+        spooled = None
+        if sha256 is None:
+            sha256, spooled = self._spool(content)
+        blob_path = self.path(self.blob_name(sha256))
+
+        try:
+            with transaction.atomic():
+                blob, _ = Blob.objects.select_for_update().get_or_create(
+                    sha256=sha256, defaults={'size': content.size}
+                )
+                if not os.path.exists(blob_path):
+                    self._place_blob(blob_path, content, spooled)
+                    spooled = None
+
+                full_path = self.path(name)
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                while True:
+                    try:
+                        os.link(blob_path, full_path)
+                        break
+                    except FileExistsError:
+                        name = self.get_available_name(name)
+                        full_path = self.path(name)
+
+                name = os.path.relpath(full_path, self.location).replace('\\', '/')
+                StoredFile.objects.create(name=name, blob=blob)
+                Blob.objects.filter(pk=sha256).update(refcount=F('refcount') + 1)
+        finally:
+            if spooled is not None:
+                os.unlink(spooled)
+        return name
+
+    def delete(self, name):
+        if not name:
+            raise ValueError("The name must be given to delete().")
+        with transaction.atomic():
+            stored = StoredFile.objects.select_for_update().filter(name=name).first()
+            if stored is None:
+                return super().delete(name)
+            super().delete(name)
+            stored.delete()
+            Blob.objects.filter(pk=stored.blob_id).update(refcount=F('refcount') - 1)
+            blob = Blob.objects.select_for_update().get(pk=stored.blob_id)
+            if blob.refcount <= 0:
+                super().delete(self.blob_name(blob.sha256))
+                blob.delete()
@@ -0,0 +1,8 @@
+from django.urls import path
+from . import views
+
+urlpatterns = [
+    path('', views.create_upload, name='create_upload'),
+    path('<uuid:upload_id>/', views.upload_chunk, name='upload_chunk'),
+    path('<uuid:upload_id>/complete/', views.complete_upload, name='complete_upload'),
+]
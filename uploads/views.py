@@ -0,0 +1,138 @@
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes, authentication_classes
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.response import Response
+from django.conf import settings
+from django.shortcuts import get_object_or_404
+from users.authentication import CsrfExemptSessionAuthentication
+from chat.serializers import MessageSerializer
+from posts.serializers import PostSerializer
+from .chunks import UploadError, discard, finalize, parse_checksum, skip_known_content, write_chunk
+from .models import UploadSession
+from .serializers import UploadCreateSerializer, UploadSessionSerializer
+
+
+def _error(exc):
+    return Response({
+        'success': False,
+        'message': str(exc)
+    }, status=exc.status)
+
+
+def _with_offset(response, session):
+    response['Upload-Offset'] = str(session.offset)
+    return response
+
+
+@api_view(['POST'])
+@authentication_classes([TokenAuthentication, CsrfExemptSessionAuthentication])
+@permission_classes([IsAuthenticated])
+def create_upload(request):
+    """
+    Start a resumable upload.
+    
+    Body: ``target`` (message or post), ``kind`` (image, video or file),
+    ``filename``, ``size`` in bytes and optionally the file's hex ``sha256``.
+    """
+    serializer = UploadCreateSerializer(data=request.data)
+    
+    if serializer.is_valid():
+        session = serializer.save(user=request.user)
+        skip_known_content(session)
+        return _with_offset(Response({
+            'success': True,
+            'upload': UploadSessionSerializer(session).data,
+            'chunk_max_bytes': settings.UPLOAD_CHUNK_MAX_BYTES
+        }, status=status.HTTP_201_CREATED), session)
+    
+    return Response({
+        'success': False,
+        'errors': serializer.errors
+    }, status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(['GET', 'PUT', 'DELETE'])
+@authentication_classes([TokenAuthentication, CsrfExemptSessionAuthentication])
+@permission_classes([IsAuthenticated])
+def upload_chunk(request, upload_id):
+    """
+    GET: how far the upload has got; resume from ``offset``.
+    PUT: raw bytes of the next chunk, starting at the ``Upload-Offset``
+    header, optionally checked against ``Upload-Checksum: sha256 <hex>``.
+    DELETE: abandon the upload.
+    """
+    session = get_object_or_404(UploadSession, id=upload_id, user=request.user)
+    
+    if request.method == 'DELETE':
+        if session.status == 'complete':
+            session.delete()
+        else:
+            discard(session)
+        return Response({
+            'success': True,
+            'message': 'Upload deleted'
+        })
+    
+    if request.method == 'PUT':
+        try:
+            start = int(request.headers['Upload-Offset'])
+        except (KeyError, ValueError):
+            return Response({
+                'success': False,
+                'message': 'Upload-Offset header is required'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if length < 1:
+            return Response({
+                'success': False,
+                'message': 'Content-Length is required'
+            }, status=status.HTTP_411_LENGTH_REQUIRED)
+        
+        try:
+            checksum = parse_checksum(request.headers.get('Upload-Checksum'))
+            # Read the body straight from the socket; request.data would buffer it
+            write_chunk(session, start, request.stream, length, checksum)
+        except UploadError as exc:
+            return _with_offset(_error(exc), session)
+    
+    return _with_offset(Response({
+        'success': True,
+        'upload': UploadSessionSerializer(session).data
+    }), session)
+
+
+@api_view(['POST'])
+@authentication_classes([TokenAuthentication, CsrfExemptSessionAuthentication])
+@permission_classes([IsAuthenticated])
+def complete_upload(request, upload_id):
+    """
+    Attach a fully received upload.
+    
+    Message uploads need ``conversation_id``; both kinds take an optional
+    ``content`` caption. Repeating the call returns the same message or post.
+    """
+    session = get_object_or_404(UploadSession, id=upload_id, user=request.user)
+    
+    try:
+        result = finalize(session, request.data)
+    except UploadError as exc:
+        return _with_offset(_error(exc), session)
+    
+    if result is None:
+        return Response({
+            'success': False,
+            'message': 'The message or post for this upload has been deleted'
+        }, status=status.HTTP_410_GONE)
+    
+    if session.target == 'message':
+        payload = {'message': MessageSerializer(result).data}
+    else:
+        payload = {'post': PostSerializer(result, context={'request': request}).data}
+    return Response({
+        'success': True,
+        **payload
+    }, status=status.HTTP_201_CREATED)
@@ -5,12 +5,12 @@ from .models import User, OTPVerification
 
 @admin.register(User)
 class CustomUserAdmin(UserAdmin):
-    list_display = ['username', 'display_name', 'user_type', 'mobile_number', 'is_online', 'created_at']
-    list_filter = ['user_type', 'is_online', 'created_at']
+    list_display = ['username', 'display_name', 'user_type', 'mobile_number', 'last_seen', 'created_at']
+    list_filter = ['user_type', 'created_at']
     search_fields = ['username', 'display_name', 'mobile_number']
     
     fieldsets = UserAdmin.fieldsets + (
-        ('Additional Info', {'fields': ('user_type', 'display_name', 'mobile_number', 'avatar', 'bio', 'is_online')}),
+        ('Additional Info', {'fields': ('user_type', 'display_name', 'mobile_number', 'avatar', 'bio', 'last_seen')}),
     )
 
 
@@ -1,4 +1,8 @@
+from urllib.parse import parse_qs
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
 from rest_framework.authentication import SessionAuthentication
+from rest_framework.authtoken.models import Token
 from django.utils.deprecation import MiddlewareMixin
 
 
@@ -23,3 +27,27 @@ class DisableCSRFForAPI(MiddlewareMixin):
         if request.path.startswith('/api/'):
             setattr(request, '_dont_enforce_csrf_checks', True)
         return None
+
+
+@database_sync_to_async
+def get_token_user(key):
+    token = Token.objects.select_related('user').filter(key=key).first()
+    if token is None or not token.user.is_active:
+        return None
+    return token.user
+
+
+class TokenAuthMiddleware(BaseMiddleware):
+    """
+    Authenticate WebSocket connections with the API token, passed as
+    ``?token=<key>`` since browsers cannot set headers on WebSockets.
+    Without a valid token the session user from AuthMiddlewareStack is kept.
+    """
+    
+    async def __call__(self, scope, receive, send):
+        query = parse_qs(scope.get('query_string', b'').decode())
+        if query.get('token'):
+            user = await get_token_user(query['token'][0])
+            if user is not None:
+                scope = dict(scope, user=user)
+        return await super().__call__(scope, receive, send)
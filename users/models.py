@@ -1,5 +1,6 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.utils import timezone
 import random
 import string
 
@@ -26,9 +27,11 @@ class User(AbstractUser):
     display_name = models.CharField(max_length=100, blank=True)
     mobile_number = models.CharField(max_length=15, blank=True, null=True, unique=True)
     avatar = models.ImageField(upload_to='avatars/', blank=True, null=True)
+    # Resized copies of avatar (see chatapp.imaging)
+    avatar_variants = models.JSONField(default=dict, blank=True, editable=False)
     bio = models.TextField(max_length=500, blank=True)
-    is_online = models.BooleanField(default=False)
-    last_seen = models.DateTimeField(auto_now=True)
+    # Online state is ephemeral (see users.presence); last_seen is flushed there in batches
+    last_seen = models.DateTimeField(default=timezone.now)
     created_at = models.DateTimeField(auto_now_add=True)
     
     def save(self, *args, **kwargs):
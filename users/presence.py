@@ -0,0 +1,134 @@
+"""
+Ephemeral presence tracking.
+
+Online state lives in Django's cache with a TTL instead of in the users table.
+WebSocket connections mark their user online and refresh the entry with
+heartbeats; an entry that is not refreshed within PRESENCE_TTL seconds expires
+on its own, so a dropped socket cannot leave a user online forever.
+
+The number of open connections per user is kept in the same cache, so with a
+shared cache a user only goes offline when their last socket on any worker
+closes. A process that dies without closing its sockets leaves the count too
+high; the user then goes offline once heartbeats stop and the entry expires.
+
+last_seen timestamps are collected in memory and written to users_user in a
+single UPDATE at most every PRESENCE_FLUSH_INTERVAL seconds.
+
+With a local-memory cache presence and connection counts are per process;
+point PRESENCE_CACHE at a shared cache backend when running several workers.
+"""
+
+import atexit
+import threading
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Case, DateTimeField, Value, When
+from .models import User
+
+
+_lock = threading.Lock()
+_pending_last_seen = {}
+_last_flush = time.monotonic()
+
+
+def _cache():
+    return caches[settings.PRESENCE_CACHE]
+
+
+def _key(user_id):
+    return f'presence:{user_id}'
+
+
+def _connections_key(user_id):
+    return f'presence-connections:{user_id}'
+
+
+def touch(user_id):
+    """Mark a user as online for another PRESENCE_TTL seconds"""
+    now = time.time()
+    cache = _cache()
+    cache.set(_key(user_id), now, settings.PRESENCE_TTL)
+    cache.touch(_connections_key(user_id), settings.PRESENCE_TTL)
+    with _lock:
+        _pending_last_seen[user_id] = now
+
+
+def connect(user_id):
+    """Register a new connection; returns True if the user just came online"""
+    cache = _cache()
+    key = _connections_key(user_id)
+    # add() never resets a counter another worker has already started
+    cache.add(key, 0, settings.PRESENCE_TTL)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # Expired between add() and incr()
+        cache.set(key, 1, settings.PRESENCE_TTL)
+        count = 1
+    touch(user_id)
+    return count == 1
+
+
+def heartbeat(user_id):
+    touch(user_id)
+
+
+def disconnect(user_id):
+    """Drop a connection; returns True if it was the user's last one anywhere"""
+    cache = _cache()
+    with _lock:
+        _pending_last_seen[user_id] = time.time()
+    try:
+        count = cache.decr(_connections_key(user_id))
+    except ValueError:
+        count = 0
+    if count <= 0:
+        cache.delete(_key(user_id))
+        return True
+    return False
+
+
+def is_online(user_id):
+    return _cache().get(_key(user_id)) is not None
+
+
+def last_seen(user_id):
+    """Most recent activity we know of, or None to fall back to the database"""
+    with _lock:
+        timestamp = _pending_last_seen.get(user_id)
+    if timestamp is None:
+        timestamp = _cache().get(_key(user_id))
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+
+def flush_last_seen():
+    """Write pending last_seen values to the users table in one UPDATE"""
+    global _last_flush
+    with _lock:
+        pending = dict(_pending_last_seen)
+        _pending_last_seen.clear()
+        _last_flush = time.monotonic()
+    if not pending:
+        return
+
+    User.objects.filter(pk__in=pending).update(last_seen=Case(
+        *[
+            When(pk=user_id, then=Value(datetime.fromtimestamp(timestamp, tz=timezone.utc)))
+            for user_id, timestamp in pending.items()
+        ],
+        output_field=DateTimeField(),
+    ))
+
+
+def maybe_flush_last_seen():
+    """Flush if PRESENCE_FLUSH_INTERVAL has passed since the last flush"""
+    if time.monotonic() - _last_flush >= settings.PRESENCE_FLUSH_INTERVAL:
+        flush_last_seen()
+
+
+atexit.register(flush_last_seen)
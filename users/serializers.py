@@ -1,15 +1,29 @@
 from rest_framework import serializers
+from chatapp.imaging import ImageVariantsField
+from . import presence
 from .models import User, OTPVerification
 
 
 class UserSerializer(serializers.ModelSerializer):
     """Serializer for User model"""
     
+    is_online = serializers.SerializerMethodField()
+    last_seen = serializers.SerializerMethodField()
+    avatar_variants = ImageVariantsField('avatar')
+    
     class Meta:
         model = User
         fields = ['id', 'username', 'display_name', 'user_type', 'mobile_number', 
-                  'avatar', 'bio', 'is_online', 'last_seen', 'created_at']
+                  'avatar', 'avatar_variants', 'bio', 'is_online', 'last_seen', 'created_at']
         read_only_fields = ['id', 'created_at', 'is_online', 'last_seen']
+    
+    def get_is_online(self, obj):
+        return presence.is_online(obj.id)
+    
+    def get_last_seen(self, obj):
+        # Prefer the in-memory value, which is newer than the last flush
+        last_seen = presence.last_seen(obj.id) or obj.last_seen
+        return serializers.DateTimeField().to_representation(last_seen)
 
 
 class UserCreateSerializer(serializers.ModelSerializer):
@@ -6,6 +6,7 @@ from rest_framework.authtoken.models import Token
 from rest_framework.response import Response
 from django.contrib.auth import authenticate, login, logout
 from django.conf import settings
+from chatapp.imaging import schedule_variants
 import requests
 import os
 from .models import User, generate_random_id
@@ -105,8 +106,6 @@ def user_login(request):
     
     if user is not None:
         login(request, user)
-        user.is_online = True
-        user.save()
         
         # Create or get token
         token, _ = Token.objects.get_or_create(user=user)
@@ -185,9 +184,6 @@ def get_recaptcha_site_key(request):
 @permission_classes([AllowAny])
 def user_logout(request):
     """Logout user"""
-    if request.user.is_authenticated:
-        request.user.is_online = False
-        request.user.save()
     logout(request)
     
     return Response({
@@ -216,6 +212,8 @@ def update_profile(request):
     
     if serializer.is_valid():
         serializer.save()
+        if 'avatar' in serializer.validated_data:
+            schedule_variants(request.user, 'avatar')
         return Response({
             'success': True,
             'message': 'Profile updated',